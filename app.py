@@ -11,13 +11,25 @@ import string
 import base64
 import io
 import numpy as np
+import plotly.express as px
 from fpdf import FPDF
+try: from fpdf.image_parsing import get_img_info  # Interno de fpdf2 (vía rápida de RecursosPDF); opcional
+except ImportError: get_img_info = None
 from streamlit_drawable_canvas import st_canvas
-from PIL import Image
+from PIL import Image, ImageOps
 import hashlib
 import os
 import shutil
 import threading
+import queue
+import atexit
+import json
+import zlib
+import zipfile
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -107,6 +119,8 @@ DOCS_INFO = {
     }
 }
 LISTA_DOCTORES = list(DOCS_INFO.keys())
+# RECURSOS DE AGENDA: cada doctor y cada sillón tiene su propio calendario
+LISTA_SILLONES = ["Sillón 1", "Sillón 2"]
 
 # LISTAS MAESTRAS
 LISTA_OCUPACIONES = ["Estudiante", "Empleado/a", "Empresario/a", "Hogar", "Comerciante", "Docente", "Sector Salud", "Jubilado/a", "Desempleado/a", "Otro"]
@@ -180,65 +194,503 @@ RIESGOS_DB = {
 # ==========================================
 # 2. MOTOR DE BASE DE DATOS
 # ==========================================
-DB_FILE = "royal_dental_db.sqlite"
+# ROYAL_DENTAL_DB permite apuntar a otra base (benchmark.py, pruebas de carga) sin tocar la real
+DB_FILE = os.environ.get("ROYAL_DENTAL_DB", "royal_dental_db.sqlite")
+# Los procesos de la cola de documentos importan este módulo: no arrancan planificador ni migraciones
+PROCESO_TRABAJADOR = multiprocessing.parent_process() is not None
+
+# POOL DE CONEXIONES (WAL + PRAGMAS AFINADOS)
+# Cada hilo de Streamlit recibe SU conexión del pool y la reutiliza en todo el rerun.
+# close() ya no cierra: devuelve la conexión al pool cuando el hilo deja de usarla.
+DB_TIMEOUT_SEG = 15
+DB_POOL_MAX = 8
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # Lectores y escritores no se bloquean entre sí
+    "PRAGMA synchronous=NORMAL",     # Seguro en WAL, evita fsync en cada commit
+    "PRAGMA cache_size=-16000",      # ~16 MB de caché de páginas por conexión
+    "PRAGMA mmap_size=268435456",    # 256 MB mapeados en memoria
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={DB_TIMEOUT_SEG * 1000}",
+)
+
+class ConexionPool(sqlite3.Connection):
+    """Conexión SQLite que regresa al pool en lugar de cerrarse."""
+    pool = None
+
+    def close(self):
+        if self.pool is not None: self.pool.liberar(self)
+        else: super().close()
+
+    def cerrar_definitivo(self):
+        self.pool = None
+        super().close()
+
+class _PrestamoHilo:
+    """Conexión prestada a un hilo. Si un script no la cierra (st.rerun, st.stop), sigue prestada a ese hilo:
+    st.rerun vuelve a correr en el mismo hilo del ScriptRunner y la reutiliza. Solo regresa al pool cuando
+    el hilo termina y threading.local suelta el préstamo."""
+    def __init__(self, pool, conn):
+        self.pool = pool; self.conn = conn; self.usos = 0; self.activo = True
+
+    def devolver(self):
+        if self.activo:
+            self.activo = False
+            self.pool._regresar(self.conn)
+
+    def __del__(self):
+        try: self.devolver()
+        except Exception: pass
+
+class PoolConexiones:
+    """Pool de conexiones por proceso. get_db_connection() entrega la conexión del hilo actual."""
+    def __init__(self, db_file, max_libres=DB_POOL_MAX):
+        self.db_file = db_file
+        self.max_libres = max_libres
+        self._libres = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _abrir(self):
+        conn = sqlite3.connect(self.db_file, timeout=DB_TIMEOUT_SEG, check_same_thread=False, factory=ConexionPool)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS: conn.execute(pragma)
+        conn.pool = self
+        return conn
+
+    def obtener(self):
+        prestamo = getattr(self._local, 'prestamo', None)
+        if prestamo is None or not prestamo.activo:
+            with self._lock:
+                conn = self._libres.pop() if self._libres else None
+            prestamo = _PrestamoHilo(self, conn or self._abrir())
+            self._local.prestamo = prestamo
+        prestamo.usos += 1
+        return prestamo.conn
+
+    def liberar(self, conn):
+        prestamo = getattr(self._local, 'prestamo', None)
+        if prestamo is None or prestamo.conn is not conn: return  # Cerrada desde otro hilo: la devuelve su dueño
+        prestamo.usos -= 1
+        if prestamo.usos <= 0:
+            self._local.prestamo = None
+            prestamo.devolver()
+
+    def _regresar(self, conn):
+        # Igual que un close() real: lo no confirmado se descarta
+        if conn.in_transaction: conn.rollback()
+        with self._lock:
+            if len(self._libres) < self.max_libres:
+                self._libres.append(conn); return
+        conn.cerrar_definitivo()
+
+    def cerrar_todo(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conn in libres: conn.cerrar_definitivo()
+
+@st.cache_resource
+def get_pool_db():
+    """Un solo pool por proceso (sobrevive a los reruns y se comparte entre sesiones)"""
+    return PoolConexiones(DB_FILE)
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row 
-    return conn
+    return get_pool_db().obtener()
 
 # GESTOR DE TRANSACCIONES SEGURO
 @contextmanager
 def db_transaction():
     """Maneja transacciones de forma segura (Auto-Commit / Auto-Rollback)"""
     conn = get_db_connection()
+    # Si el hilo ya tiene una transacción abierta, anidamos con SAVEPOINT para no confirmarla a medias
+    anidada = conn.in_transaction
+    if anidada: conn.execute("SAVEPOINT db_tx")
     try:
         yield conn
-        conn.commit()
+        if anidada: conn.execute("RELEASE SAVEPOINT db_tx")
+        else: conn.commit()
     except Exception as e:
-        conn.rollback()
+        if anidada: conn.execute("ROLLBACK TO SAVEPOINT db_tx"); conn.execute("RELEASE SAVEPOINT db_tx")
+        else: conn.rollback()
         raise e
     finally:
         conn.close()
 
-def migrar_tablas():
+# ==========================================
+# MIGRACIONES VERSIONADAS (PRAGMA user_version)
+# ==========================================
+# Cada migración corre UNA sola vez. Al arrancar solo se lee user_version:
+# si el esquema ya está al día no se ejecuta ningún DDL.
+def _columnas_tabla(c, tabla):
+    return {row[1] for row in c.execute(f"PRAGMA table_info({tabla})")}
+
+def _agregar_columnas(c, tabla, columnas):
+    """ALTER TABLE solo para las columnas que falten (bases creadas con versiones anteriores)"""
+    existentes = _columnas_tabla(c, tabla)
+    for col, tipo in columnas:
+        if col not in existentes: c.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} {tipo}")
+
+# Columnas de las tablas principales (fuente única para CREATE y para completar bases antiguas)
+COLUMNAS_PACIENTES = [(col, 'TEXT') for col in ['fecha_registro', 'nombre', 'apellido_paterno', 'apellido_materno', 'telefono', 'email', 'rfc', 'regimen', 'uso_cfdi', 'cp', 'nota_fiscal', 'sexo', 'estado', 'fecha_nacimiento', 'antecedentes_medicos', 'ahf', 'app', 'apnp', 'domicilio', 'tutor', 'parentesco_tutor', 'contacto_emergencia', 'telefono_emergencia', 'ocupacion', 'estado_civil', 'motivo_consulta', 'exploracion_fisica', 'diagnostico', 'nota_administrativa']]
+COLUMNAS_CITAS = [('timestamp', 'INTEGER'), ('fecha', 'TEXT'), ('hora', 'TEXT'), ('id_paciente', 'TEXT'), ('nombre_paciente', 'TEXT'), ('tipo', 'TEXT'), ('tratamiento', 'TEXT'), ('diente', 'TEXT'), ('doctor_atendio', 'TEXT'), ('precio_lista', 'REAL'), ('precio_final', 'REAL'), ('porcentaje', 'REAL'), ('tiene_factura', 'TEXT'), ('iva', 'REAL'), ('subtotal', 'REAL'), ('metodo_pago', 'TEXT'), ('estado_pago', 'TEXT'), ('requiere_factura', 'TEXT'), ('notas', 'TEXT'), ('monto_pagado', 'REAL'), ('saldo_pendiente', 'REAL'), ('fecha_pago', 'TEXT'), ('costo_laboratorio', 'REAL'), ('categoria', 'TEXT'), ('duracion', 'INTEGER'), ('estatus_asistencia', 'TEXT'), ('observaciones', 'TEXT')]
+COLUMNAS_SERVICIOS = [('categoria', 'TEXT'), ('nombre_tratamiento', 'TEXT'), ('precio_lista', 'REAL'), ('costo_laboratorio_base', 'REAL'), ('consent_level', 'TEXT'), ('duracion', 'INTEGER')]
+
+def _definicion(columnas): return ", ".join(f"{col} {tipo}" for col, tipo in columnas)
+
+def migracion_001_esquema_base(c):
+    # Tablas base (Pacientes, Citas, Auditoria, Asistencia, Servicios, Odontograma)
+    c.execute(f"CREATE TABLE IF NOT EXISTS pacientes (id_paciente TEXT PRIMARY KEY, {_definicion(COLUMNAS_PACIENTES)})")
+    c.execute(f"CREATE TABLE IF NOT EXISTS citas ({_definicion(COLUMNAS_CITAS)})")
+    c.execute(f"CREATE TABLE IF NOT EXISTS servicios ({_definicion(COLUMNAS_SERVICIOS)})")
+    c.execute('''CREATE TABLE IF NOT EXISTS auditoria (id_evento INTEGER PRIMARY KEY AUTOINCREMENT, fecha_evento TEXT, usuario TEXT, accion TEXT, detalle TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS asistencia (id_registro INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, doctor TEXT, hora_entrada TEXT, hora_salida TEXT, horas_totales REAL, estado TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS odontograma (id_paciente TEXT, diente TEXT, estado TEXT, fecha_actualizacion TEXT, PRIMARY KEY (id_paciente, diente))''')
+
+    # Bases anteriores a V48: columnas agregadas con el tiempo (semáforo, observaciones, historial médico...)
+    _agregar_columnas(c, 'pacientes', COLUMNAS_PACIENTES)
+    _agregar_columnas(c, 'citas', COLUMNAS_CITAS)
+    _agregar_columnas(c, 'servicios', COLUMNAS_SERVICIOS)
+
+def migracion_002_indices(c):
+    # Agenda del día: WHERE fecha = ? AND estado_pago != 'CANCELADO' ORDER BY hora
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_agenda ON citas(fecha, estado_pago, hora)")
+    # Historial del paciente: WHERE id_paciente = ? ORDER BY timestamp
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_paciente_ts ON citas(id_paciente, timestamp)")
+    # Deudas / abonos: WHERE id_paciente = ? AND saldo_pendiente > 0 AND estado_pago != 'CANCELADO' (índice cubriente)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_paciente_saldo ON citas(id_paciente, saldo_pendiente, estado_pago)")
+    # Buscador global: ORDER BY timestamp DESC LIMIT 50 recorre el índice y se detiene en 50 coincidencias
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_timestamp ON citas(timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pacientes_nombre ON pacientes(apellido_paterno, nombre)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_usuario_fecha ON auditoria(usuario, fecha_evento)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asistencia_doctor_fecha ON asistencia(doctor, fecha)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_servicios_categoria ON servicios(categoria, nombre_tratamiento)")
+    c.execute("ANALYZE")
+
+# fecha dd/mm/YYYY -> YYYY-MM-DD (NULL si el texto no tiene el formato esperado)
+SQL_FECHA_ISO = "CASE WHEN fecha GLOB '[0-3][0-9]/[0-1][0-9]/[0-9][0-9][0-9][0-9]' THEN substr(fecha, 7, 4) || '-' || substr(fecha, 4, 2) || '-' || substr(fecha, 1, 2) END"
+
+def migracion_003_fecha_iso(c):
+    # Columna generada: SQLite la calcula desde 'fecha' en cada INSERT/UPDATE, así que
+    # nunca se desincroniza y los lectores de 'fecha' (texto latino) siguen igual.
+    if 'fecha_iso' not in _columnas_tabla(c, 'citas'):
+        c.execute(f"ALTER TABLE citas ADD COLUMN fecha_iso TEXT GENERATED ALWAYS AS ({SQL_FECHA_ISO}) VIRTUAL")
+    # Rangos (semana, mes, vencidas) y filtros por paciente + fecha resueltos por índice
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_fecha_iso ON citas(fecha_iso)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_citas_paciente_fecha_iso ON citas(id_paciente, fecha_iso)")
+
+def migracion_004_sillon(c):
+    # Recurso físico de la cita (los conflictos se revisan por doctor y por sillón)
+    _agregar_columnas(c, 'citas', [('sillon', 'TEXT')])
+
+# Búsqueda de pacientes: FTS5 sin acentos ni mayúsculas (equivale a formato_nombre_legal), rowid = pacientes.rowid
+SQL_FTS_PACIENTE = "new.id_paciente, trim(ifnull(new.nombre,'') || ' ' || ifnull(new.apellido_paterno,'') || ' ' || ifnull(new.apellido_materno,'')), new.telefono, new.rfc, new.email"
+
+def migracion_005_busqueda_pacientes(c):
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS pacientes_fts USING fts5(
+        id_paciente, nombre_completo, telefono, rfc, email,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_pacientes_fts_ai AFTER INSERT ON pacientes BEGIN INSERT INTO pacientes_fts(rowid, id_paciente, nombre_completo, telefono, rfc, email) VALUES (new.rowid, {SQL_FTS_PACIENTE}); END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_pacientes_fts_au AFTER UPDATE ON pacientes BEGIN DELETE FROM pacientes_fts WHERE rowid = old.rowid; INSERT INTO pacientes_fts(rowid, id_paciente, nombre_completo, telefono, rfc, email) VALUES (new.rowid, {SQL_FTS_PACIENTE}); END")
+    c.execute("CREATE TRIGGER IF NOT EXISTS trg_pacientes_fts_ad AFTER DELETE ON pacientes BEGIN DELETE FROM pacientes_fts WHERE rowid = old.rowid; END")
+    c.execute("DELETE FROM pacientes_fts")
+    c.execute(f"INSERT INTO pacientes_fts(rowid, id_paciente, nombre_completo, telefono, rfc, email) SELECT new.rowid, {SQL_FTS_PACIENTE} FROM pacientes AS new")
+    c.execute("INSERT INTO pacientes_fts(pacientes_fts) VALUES ('optimize')")
+
+# Saldos por paciente: mismo criterio que el semáforo (toda fila no cancelada cuenta)
+SQL_SALDOS_DESDE_CITAS = """
+    SELECT id_paciente,
+           ROUND(SUM(ifnull(precio_final, 0)), 2) AS cargos,
+           ROUND(SUM(ifnull(monto_pagado, 0)), 2) AS abonos,
+           ROUND(SUM(ifnull(saldo_pendiente, 0)), 2) AS saldo,
+           MAX(CASE WHEN ifnull(precio_final, 0) > 0 OR ifnull(monto_pagado, 0) > 0 THEN timestamp END) AS ultimo_movimiento
+    FROM citas
+    WHERE estado_pago != 'CANCELADO' AND id_paciente IS NOT NULL
+    GROUP BY id_paciente
+"""
+
+def migracion_006_saldos_pacientes(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS saldos_pacientes (
+        id_paciente TEXT PRIMARY KEY, cargos REAL NOT NULL DEFAULT 0, abonos REAL NOT NULL DEFAULT 0,
+        saldo REAL NOT NULL DEFAULT 0, ultimo_movimiento INTEGER)""")
+    # Índice parcial: el reporte de cuentas por cobrar solo recorre a los deudores
+    c.execute("CREATE INDEX IF NOT EXISTS idx_saldos_deudores ON saldos_pacientes(saldo) WHERE saldo > 0.005")
+    c.execute("DELETE FROM saldos_pacientes")
+    c.execute(f"INSERT INTO saldos_pacientes (id_paciente, cargos, abonos, saldo, ultimo_movimiento) {SQL_SALDOS_DESDE_CITAS}")
+
+# Resumen financiero: una fila por día, doctor, categoría y método de pago con lo que suman las citas no
+# canceladas que mueven dinero. Los nulos se agrupan como '-' porque forman parte de la llave.
+SQL_CLAVE_RESUMEN = "fecha_iso, ifnull(doctor_atendio, '-') AS doctor, ifnull(categoria, '-') AS categoria, ifnull(metodo_pago, '-') AS metodo_pago"
+SQL_FILTRO_RESUMEN = """estado_pago != 'CANCELADO' AND fecha_iso IS NOT NULL
+    AND (ifnull(precio_final, 0) != 0 OR ifnull(monto_pagado, 0) != 0 OR ifnull(saldo_pendiente, 0) != 0 OR ifnull(costo_laboratorio, 0) != 0)"""
+SQL_RESUMEN_DESDE_CITAS = f"""
+    SELECT {SQL_CLAVE_RESUMEN},
+           ROUND(SUM(ifnull(precio_final, 0)), 2) AS cargos,
+           ROUND(SUM(ifnull(monto_pagado, 0)), 2) AS cobrado,
+           ROUND(SUM(ifnull(saldo_pendiente, 0)), 2) AS saldo,
+           ROUND(SUM(ifnull(costo_laboratorio, 0)), 2) AS costo_lab,
+           COUNT(*) AS movimientos
+    FROM citas
+    WHERE {SQL_FILTRO_RESUMEN}
+    GROUP BY 1, 2, 3, 4
+"""
+
+# Auditoría encadenada: cada evento guarda el hash del anterior, así que editar, borrar o reordenar
+# cualquier fila rompe la cadena desde ese punto y se detecta en una sola pasada.
+AUDITORIA_GENESIS = "0" * 64
+
+def hash_evento_auditoria(previo, fecha, usuario, accion, detalle):
+    campos = (previo, fecha, usuario, accion, detalle)
+    return hashlib.sha256("\x1f".join("" if x is None else str(x) for x in campos).encode("utf-8")).hexdigest()
+
+def encadenar_eventos(previo, eventos):
+    """(fecha, usuario, accion, detalle) -> filas con hash_previo y hash. Regresa (filas, último hash)."""
+    filas = []
+    for fecha, usuario, accion, detalle in eventos:
+        actual = hash_evento_auditoria(previo, fecha, usuario, accion, detalle)
+        filas.append((fecha, usuario, accion, detalle, previo, actual)); previo = actual
+    return filas, previo
+
+def ultimo_hash_auditoria(c):
+    fila = c.execute("SELECT hash FROM auditoria ORDER BY id_evento DESC LIMIT 1").fetchone()
+    return fila[0] if fila and fila[0] else AUDITORIA_GENESIS
+
+def migracion_007_auditoria_encadenada(c):
+    _agregar_columnas(c, 'auditoria', [('hash_previo', 'TEXT'), ('hash', 'TEXT')])
+    # Eventos existentes: se encadenan en orden de id, por lotes y sin cargar la tabla completa
+    previo, ultimo_id = AUDITORIA_GENESIS, 0
+    while True:
+        lote = c.execute("SELECT id_evento, fecha_evento, usuario, accion, detalle FROM auditoria WHERE id_evento > ? ORDER BY id_evento LIMIT 50000", (ultimo_id,)).fetchall()
+        if not lote: break
+        filas, previo = encadenar_eventos(previo, [tuple(f[1:]) for f in lote])
+        c.executemany("UPDATE auditoria SET hash_previo = ?, hash = ? WHERE id_evento = ?", [(f[4], f[5], ev[0]) for f, ev in zip(filas, lote)])
+        ultimo_id = lote[-1][0]
+    # Solo adición: la base rechaza UPDATE y DELETE sobre la bitácora
+    c.execute("CREATE TRIGGER IF NOT EXISTS trg_auditoria_sin_update BEFORE UPDATE ON auditoria BEGIN SELECT RAISE(ABORT, 'La auditoría es de solo adición'); END")
+    c.execute("CREATE TRIGGER IF NOT EXISTS trg_auditoria_sin_delete BEFORE DELETE ON auditoria BEGIN SELECT RAISE(ABORT, 'La auditoría es de solo adición'); END")
+    # Filtros del visor: (usuario, fecha_evento) ya existe desde la migración 2. Todos terminan en
+    # fecha_evento (+ rowid implícito), así la página ORDER BY fecha_evento DESC, id_evento DESC sale del índice sin ordenar
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_accion ON auditoria(accion, fecha_evento)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_fecha ON auditoria(fecha_evento)")
+
+def migracion_008_historial_odontograma(c):
+    # Cada cambio de un diente es un evento; odontograma queda como el estado vigente (lectura rápida)
+    c.execute('''CREATE TABLE IF NOT EXISTS odontograma_historial (id_evento INTEGER PRIMARY KEY AUTOINCREMENT, id_paciente TEXT NOT NULL,
+                 diente TEXT NOT NULL, estado TEXT NOT NULL, fecha_evento TEXT NOT NULL, usuario TEXT)''')
+    # El estado actual entra como primer evento de cada diente (fecha_actualizacion viene en DD/MM/YYYY)
+    c.execute("""INSERT INTO odontograma_historial (id_paciente, diente, estado, fecha_evento, usuario)
+                 SELECT id_paciente, diente, estado,
+                        CASE WHEN fecha_actualizacion GLOB '[0-3][0-9]/[0-1][0-9]/[0-9][0-9][0-9][0-9]'
+                             THEN substr(fecha_actualizacion, 7, 4) || '-' || substr(fecha_actualizacion, 4, 2) || '-' || substr(fecha_actualizacion, 1, 2) || ' 00:00:00'
+                             ELSE '1970-01-01 00:00:00' END, 'MIGRACION'
+                 FROM odontograma""")
+    # Cubre la consulta "al día X": por paciente y diente, eventos hasta la fecha, sin tocar la tabla
+    c.execute("CREATE INDEX IF NOT EXISTS idx_odontograma_historial ON odontograma_historial(id_paciente, diente, fecha_evento, estado)")
+    # Los eventos no se corrigen; solo el reseteo de la base los borra
+    c.execute("CREATE TRIGGER IF NOT EXISTS trg_odontograma_historial_sin_update BEFORE UPDATE ON odontograma_historial BEGIN SELECT RAISE(ABORT, 'El historial del odontograma es de solo adición'); END")
+
+def migracion_009_examenes_periodontales(c):
+    # Un examen = una fila con el arreglo completo empaquetado (ver FORMATOS_EXAMEN), no una fila por sitio
+    c.execute('''CREATE TABLE IF NOT EXISTS examenes_periodontales (id_examen INTEGER PRIMARY KEY AUTOINCREMENT, id_paciente TEXT NOT NULL,
+                 fecha_examen TEXT NOT NULL, doctor TEXT, formato INTEGER NOT NULL, datos BLOB NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_examenes_perio_paciente ON examenes_periodontales(id_paciente, fecha_examen)")
+
+# ==========================================
+# ALMACÉN DE ARCHIVOS DEL PACIENTE (DIRECCIONADO POR CONTENIDO)
+# ==========================================
+# Cada archivo se guarda una vez con su sha256 como nombre (objetos/ab/abcd....jpg) y al subirlo se genera
+# su miniatura. La tabla archivos_paciente es el índice: la galería pagina sobre ella y muestra miniaturas;
+# el original solo se lee cuando se pide.
+CARPETA_OBJETOS = os.path.join(CARPETA_PACIENTES, "objetos")
+CARPETA_MINIATURAS = os.path.join(CARPETA_PACIENTES, "miniaturas")
+MINIATURA_PX = 256
+EXTENSIONES_IMAGEN = {"png", "jpg", "jpeg", "webp", "bmp", "tif", "tiff"}
+TIPOS_ARCHIVO = ["Fotografía", "Radiografía", "Documento", "Otro"]
+
+def ruta_objeto(sha, ext): return os.path.join(CARPETA_OBJETOS, sha[:2], f"{sha}.{ext}")
+
+def ruta_miniatura(sha): return os.path.join(CARPETA_MINIATURAS, sha[:2], f"{sha}.jpg")
+
+def _escribir_atomico(ruta, datos):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temporal, "wb") as f: f.write(datos)
+    os.replace(temporal, ruta)
+
+def _crear_miniatura(sha, datos):
+    """JPEG de MINIATURA_PX por lado (orientación EXIF aplicada). Regresa (ancho, alto) del original o None."""
+    try:
+        img = Image.open(io.BytesIO(datos)); ancho, alto = img.size
+        img.draft("RGB", (MINIATURA_PX, MINIATURA_PX))  # JPEG: decodifica ya reducido
+        # Misma conversión que la pirámide y la vista previa: 16 bits se reescalan a 8 (convert("RGB") los satura a blanco)
+        arr = _a_arreglo(ImageOps.exif_transpose(img))
+        img = Image.fromarray(arr[:, :, 0] if arr.shape[2] == 1 else arr); img.thumbnail((MINIATURA_PX, MINIATURA_PX), Image.LANCZOS)
+        buf = io.BytesIO(); img.save(buf, "JPEG", quality=80, optimize=True)
+        _escribir_atomico(ruta_miniatura(sha), buf.getvalue())
+        return ancho, alto
+    except Exception as e:
+        print(f"⚠️ Sin miniatura para {sha[:12]}: {e}"); return None
+
+# PIRÁMIDE DE MOSAICOS (RADIOGRAFÍAS Y PANORÁMICAS GRANDES)
+# Al subirla, la imagen se decodifica una sola vez y se guarda por niveles (cada uno la mitad del anterior) en
+# piramides/ab/<sha256>/nivel_<k>.npy con forma (mosaicos_y, mosaicos_x, 256, 256, canales): cada mosaico queda
+# contiguo en disco. El visor abre los niveles con mmap y solo copia los mosaicos que caen en la vista.
+CARPETA_PIRAMIDES = os.path.join(CARPETA_PACIENTES, "piramides")
+MOSAICO_PX = 256
+PIRAMIDE_MIN_PX = 4_000_000  # Desde 4 MP (y toda radiografía) se genera la pirámide
+VISOR_ANCHO, VISOR_ALTO = 1024, 640
+
+def ruta_piramide(sha): return os.path.join(CARPETA_PIRAMIDES, sha[:2], sha)
+
+def tiene_piramide(sha): return os.path.exists(os.path.join(ruta_piramide(sha), "manifiesto.json"))
+
+def _a_arreglo(img):
+    """(alto, ancho, canales) uint8: escalas de grises (16 bits reescalados a 8) con un canal, lo demás RGB"""
+    if img.mode in ("I;16", "I;16B", "I;16L", "I", "F"):
+        arr = np.asarray(img, dtype=np.float32); bajo, alto = float(arr.min()), float(arr.max())
+        return np.clip((arr - bajo) * (255.0 / max(alto - bajo, 1.0)), 0, 255).astype(np.uint8)[:, :, None]
+    if img.mode in ("1", "L", "LA"): return np.asarray(img.convert("L"))[:, :, None]
+    return np.asarray(img.convert("RGB"))
+
+def construir_piramide(sha, datos):
+    """Decodifica una vez y escribe todos los niveles en formato de mosaicos. Regresa el manifiesto."""
+    nivel = _a_arreglo(ImageOps.exif_transpose(Image.open(io.BytesIO(datos))))
+    destino = ruta_piramide(sha); temporal = f"{destino}.{uuid.uuid4().hex[:8]}.tmp"; os.makedirs(temporal)
+    T = MOSAICO_PX; niveles = []
+    while True:
+        alto, ancho, canales = nivel.shape; my, mx = -(-alto // T), -(-ancho // T)
+        relleno = np.zeros((my * T, mx * T, canales), np.uint8); relleno[:alto, :ancho] = nivel
+        mosaicos = np.lib.format.open_memmap(os.path.join(temporal, f"nivel_{len(niveles)}.npy"), mode="w+", dtype=np.uint8, shape=(my, mx, T, T, canales))
+        mosaicos[:] = relleno.reshape(my, T, mx, T, canales).swapaxes(1, 2); mosaicos.flush(); del mosaicos, relleno
+        niveles.append({"ancho": ancho, "alto": alto, "mosaicos_x": mx, "mosaicos_y": my})
+        if max(alto, ancho) <= T: break
+        reducida = np.asarray(Image.fromarray(nivel[:, :, 0] if canales == 1 else nivel).reduce(2))
+        nivel = reducida[:, :, None] if canales == 1 else reducida
+    manifiesto = {"mosaico": T, "canales": int(nivel.shape[2]), "niveles": niveles}
+    with open(os.path.join(temporal, "manifiesto.json"), "w", encoding="utf-8") as f: json.dump(manifiesto, f)
+    # Se publica completa o no se publica (otro proceso pudo haberla generado mientras tanto)
+    if tiene_piramide(sha): shutil.rmtree(temporal, ignore_errors=True)
+    else:
+        os.makedirs(os.path.dirname(destino), exist_ok=True); shutil.rmtree(destino, ignore_errors=True); os.replace(temporal, destino)
+    return manifiesto
+
+@st.cache_data(show_spinner=False)
+def leer_manifiesto_piramide(sha):
+    # El contenido de una pirámide no cambia nunca (la clave es el hash)
+    with open(os.path.join(ruta_piramide(sha), "manifiesto.json"), encoding="utf-8") as f: return json.load(f)
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def abrir_nivel_piramide(sha, nivel):
+    """Nivel mapeado en memoria: no se lee nada hasta que se toca un mosaico"""
+    return np.load(os.path.join(ruta_piramide(sha), f"nivel_{nivel}.npy"), mmap_mode="r")
+
+def leer_region_piramide(sha, nivel, x, y, ancho, alto):
+    """Recorte (alto, ancho, canales) del nivel pedido copiando solo los mosaicos que lo cubren"""
+    info = leer_manifiesto_piramide(sha)["niveles"][nivel]; T = MOSAICO_PX
+    x0, y0 = max(0, min(x, info["ancho"] - 1)), max(0, min(y, info["alto"] - 1))
+    x1, y1 = min(x0 + ancho, info["ancho"]), min(y0 + alto, info["alto"])
+    mx0, mx1, my0, my1 = x0 // T, (x1 - 1) // T, y0 // T, (y1 - 1) // T
+    bloque = np.ascontiguousarray(abrir_nivel_piramide(sha, nivel)[my0:my1 + 1, mx0:mx1 + 1])
+    region = bloque.swapaxes(1, 2).reshape((my1 - my0 + 1) * T, (mx1 - mx0 + 1) * T, -1)
+    return region[y0 - my0 * T:y1 - my0 * T, x0 - mx0 * T:x1 - mx0 * T]
+
+def registrar_archivo(c, id_paciente, nombre, datos, tipo, fecha_subida=None):
+    """Guarda el contenido (si es nuevo) y lo indexa para el paciente. Regresa (id_archivo, nuevo).
+    Subir otra vez el mismo contenido al mismo paciente no duplica nada."""
+    sha = hashlib.sha256(datos).hexdigest()
+    ext = os.path.splitext(nombre)[1].lower().lstrip(".").replace("jpeg", "jpg") or "bin"
+    previo = c.execute("SELECT id_archivo FROM archivos_paciente WHERE id_paciente = ? AND sha256 = ?", (id_paciente, sha)).fetchone()
+    if previo: return previo[0], False
+    if not os.path.exists(ruta_objeto(sha, ext)): _escribir_atomico(ruta_objeto(sha, ext), datos)
+    dims = None
+    if ext in EXTENSIONES_IMAGEN:
+        # Mismo contenido ya subido para otro paciente: la miniatura existe, solo se leen las dimensiones del encabezado
+        if os.path.exists(ruta_miniatura(sha)):
+            with Image.open(io.BytesIO(datos)) as img: dims = img.size
+        else: dims = _crear_miniatura(sha, datos)
+        if dims and (dims[0] * dims[1] >= PIRAMIDE_MIN_PX or tipo == "Radiografía") and not tiene_piramide(sha):
+            try: construir_piramide(sha, datos)
+            except Exception as e: print(f"⚠️ Sin pirámide para {sha[:12]}: {e}")
+    c.execute("""INSERT INTO archivos_paciente (id_paciente, nombre, tipo, extension, fecha_subida, bytes, sha256, ancho, alto, miniatura)
+                 VALUES (?,?,?,?,?,?,?,?,?,?)""",
+              (id_paciente, nombre, tipo, ext, fecha_subida or datetime.now(TZ_MX).strftime("%Y-%m-%d %H:%M:%S"), len(datos), sha,
+               dims[0] if dims else None, dims[1] if dims else None, int(os.path.exists(ruta_miniatura(sha)))))
+    return c.lastrowid, True
+
+def migracion_010_archivos_paciente(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS archivos_paciente (id_archivo INTEGER PRIMARY KEY AUTOINCREMENT, id_paciente TEXT NOT NULL,
+                 nombre TEXT, tipo TEXT, extension TEXT, fecha_subida TEXT NOT NULL, bytes INTEGER, sha256 TEXT NOT NULL,
+                 ancho INTEGER, alto INTEGER, miniatura INTEGER DEFAULT 0, UNIQUE (id_paciente, sha256))''')
+    # Galería: más recientes primero con cursor (fecha_subida, id_archivo)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_archivos_paciente_fecha ON archivos_paciente(id_paciente, fecha_subida, id_archivo)")
+    # Archivos sueltos de la versión anterior (pacientes_files/<id>/<nombre>): se copian al almacén y se indexan;
+    # los originales se quedan donde estaban
+    if not os.path.isdir(CARPETA_PACIENTES): return
+    for id_p in sorted(os.listdir(CARPETA_PACIENTES)):
+        carpeta = os.path.join(CARPETA_PACIENTES, id_p)
+        if not os.path.isdir(carpeta) or carpeta in (CARPETA_OBJETOS, CARPETA_MINIATURAS): continue
+        for nombre in sorted(os.listdir(carpeta)):
+            ruta = os.path.join(carpeta, nombre)
+            if not os.path.isfile(ruta): continue
+            with open(ruta, "rb") as f: datos = f.read()
+            ext = os.path.splitext(nombre)[1].lower().lstrip(".")
+            fecha = datetime.fromtimestamp(os.path.getmtime(ruta), TZ_MX).strftime("%Y-%m-%d %H:%M:%S")
+            registrar_archivo(c, id_p, nombre, datos, "Fotografía" if ext in EXTENSIONES_IMAGEN else "Documento", fecha)
+
+def migracion_011_piramides_imagenes(c):
+    # Sin cambio de esquema: la pirámide vive junto al almacén y se reconoce por su manifiesto.
+    # Se generan las de imágenes grandes y radiografías que ya estaban indexadas.
+    filas = c.execute("SELECT DISTINCT sha256, extension FROM archivos_paciente WHERE ancho * alto >= ? OR (tipo = 'Radiografía' AND ancho IS NOT NULL)", (PIRAMIDE_MIN_PX,)).fetchall()
+    for sha, ext in filas:
+        if tiene_piramide(sha) or not os.path.exists(ruta_objeto(sha, ext)): continue
+        with open(ruta_objeto(sha, ext), "rb") as f: construir_piramide(sha, f.read())
+
+def migracion_012_resumen_financiero(c):
+    # Sin ROWID: la llave compuesta es el índice agrupado y el tablero lee rangos de fecha_iso en orden
+    c.execute("""CREATE TABLE IF NOT EXISTS resumen_financiero (
+        fecha_iso TEXT NOT NULL, doctor TEXT NOT NULL, categoria TEXT NOT NULL, metodo_pago TEXT NOT NULL,
+        cargos REAL NOT NULL DEFAULT 0, cobrado REAL NOT NULL DEFAULT 0, saldo REAL NOT NULL DEFAULT 0,
+        costo_lab REAL NOT NULL DEFAULT 0, movimientos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (fecha_iso, doctor, categoria, metodo_pago)) WITHOUT ROWID""")
+    c.execute("DELETE FROM resumen_financiero")
+    c.execute(f"INSERT INTO resumen_financiero (fecha_iso, doctor, categoria, metodo_pago, cargos, cobrado, saldo, costo_lab, movimientos) {SQL_RESUMEN_DESDE_CITAS}")
+
+# (versión, descripción, función). Solo se agregan al final; nunca se editan las ya publicadas.
+MIGRACIONES = [
+    (1, "Esquema base y columnas legadas", migracion_001_esquema_base),
+    (2, "Índices de agenda, deudas, historial, auditoría y asistencia", migracion_002_indices),
+    (3, "Columna fecha_iso ordenable (YYYY-MM-DD) en citas", migracion_003_fecha_iso),
+    (4, "Sillón (recurso) en citas", migracion_004_sillon),
+    (5, "Índice FTS5 de pacientes (id, nombre, teléfono, RFC, email)", migracion_005_busqueda_pacientes),
+    (6, "Libro de saldos por paciente", migracion_006_saldos_pacientes),
+    (7, "Auditoría encadenada por hash, solo adición, índices de consulta", migracion_007_auditoria_encadenada),
+    (8, "Historial de estados por diente (odontograma al día)", migracion_008_historial_odontograma),
+    (9, "Exámenes periodontales y de superficies empaquetados", migracion_009_examenes_periodontales),
+    (10, "Índice de archivos del paciente (almacén por contenido con miniaturas)", migracion_010_archivos_paciente),
+    (11, "Pirámides de mosaicos para imágenes grandes ya indexadas", migracion_011_piramides_imagenes),
+    (12, "Resumen financiero diario por doctor, categoría y método de pago", migracion_012_resumen_financiero),
+]
+ESQUEMA_VERSION = MIGRACIONES[-1][0]
+
+def aplicar_migraciones():
+    """Aplica en orden las migraciones pendientes. Retorna cuántas se aplicaron."""
     conn = get_db_connection()
-    c = conn.cursor()
-    
-    # [NUEVO V48.0] COLUMNAS PARA EL SEMÁFORO Y OBSERVACIONES
-    # Estas son OBLIGATORIAS para que funcionen las mejoras visuales que pediste
-    try: c.execute("ALTER TABLE pacientes ADD COLUMN nota_administrativa TEXT")
-    except: pass
-    try: c.execute("ALTER TABLE citas ADD COLUMN observaciones TEXT")
-    except: pass
-
-    # [V41.0] MIGRACIÓN DE TABLA CITAS (NUEVO STATUS) Y ODONTOGRAMA
-    try: c.execute(f"ALTER TABLE citas ADD COLUMN estatus_asistencia TEXT")
-    except: pass
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS odontograma (
-        id_paciente TEXT, diente TEXT, estado TEXT, fecha_actualizacion TEXT,
-        PRIMARY KEY (id_paciente, diente))''')
-
-    # Migraciones previas (Seguridad y Mantenimiento)
-    try: c.execute(f"ALTER TABLE servicios ADD COLUMN duracion INTEGER")
-    except: pass
-    try: c.execute(f"ALTER TABLE citas ADD COLUMN duracion INTEGER")
-    except: pass
-    
-    # Columnas pacientes (Historial médico completo)
-    for col in ['parentesco_tutor', 'telefono_emergencia', 'antecedentes_medicos', 'ahf', 'app', 'apnp', 'sexo', 'domicilio', 'tutor', 'contacto_emergencia', 'ocupacion', 'estado_civil', 'motivo_consulta', 'exploracion_fisica', 'diagnostico']:
-        try: c.execute(f"ALTER TABLE pacientes ADD COLUMN {col} TEXT")
-        except: pass
-    
-    # Columnas citas (Financiero y Categorías)
-    for col in ['costo_laboratorio', 'categoria']:
-        try: c.execute(f"ALTER TABLE citas ADD COLUMN {col} REAL" if col == 'costo_laboratorio' else f"ALTER TABLE citas ADD COLUMN {col} TEXT")
-        except: pass
-    
-    try: c.execute(f"ALTER TABLE servicios ADD COLUMN consent_level TEXT")
-    except: pass
-    conn.commit(); conn.close()
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= ESQUEMA_VERSION: return 0
+        aplicadas = 0
+        for version, descripcion, migracion in MIGRACIONES:
+            # BEGIN IMMEDIATE: si otro proceso está migrando, esperamos y volvemos a leer la versión
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    conn.rollback(); continue
+                migracion(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit(); aplicadas += 1
+                print(f"🧱 Migración {version} aplicada: {descripcion}")
+            except Exception:
+                conn.rollback(); raise
+        return aplicadas
+    finally:
+        conn.close()
 
 # [V41 RESTAURADO] FUNCIONES DE MANTENIMIENTO (No las borres, son útiles)
 def actualizar_duraciones():
@@ -252,23 +704,6 @@ def actualizar_niveles_riesgo():
     c.execute("UPDATE servicios SET consent_level = 'LOW_RISK' WHERE consent_level IS NULL")
     conn.commit(); conn.close()
 
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Tablas base (Pacientes, Citas, Auditoria, Asistencia, Servicios, Odontograma)
-    
-    # [V48.0] INCLUIMOS nota_administrativa EN LA CREACIÓN
-    c.execute('''CREATE TABLE IF NOT EXISTS pacientes (id_paciente TEXT PRIMARY KEY, fecha_registro TEXT, nombre TEXT, apellido_paterno TEXT, apellido_materno TEXT, telefono TEXT, email TEXT, rfc TEXT, regimen TEXT, uso_cfdi TEXT, cp TEXT, nota_fiscal TEXT, sexo TEXT, estado TEXT, fecha_nacimiento TEXT, antecedentes_medicos TEXT, ahf TEXT, app TEXT, apnp TEXT, domicilio TEXT, tutor TEXT, parentesco_tutor TEXT, contacto_emergencia TEXT, telefono_emergencia TEXT, ocupacion TEXT, estado_civil TEXT, motivo_consulta TEXT, exploracion_fisica TEXT, diagnostico TEXT, nota_administrativa TEXT)''')
-    
-    # [V48.0] INCLUIMOS observaciones EN LA CREACIÓN
-    c.execute('''CREATE TABLE IF NOT EXISTS citas (timestamp INTEGER, fecha TEXT, hora TEXT, id_paciente TEXT, nombre_paciente TEXT, tipo TEXT, tratamiento TEXT, diente TEXT, doctor_atendio TEXT, precio_lista REAL, precio_final REAL, porcentaje REAL, tiene_factura TEXT, iva REAL, subtotal REAL, metodo_pago TEXT, estado_pago TEXT, requiere_factura TEXT, notas TEXT, monto_pagado REAL, saldo_pendiente REAL, fecha_pago TEXT, costo_laboratorio REAL, categoria TEXT, duracion INTEGER, estatus_asistencia TEXT, observaciones TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS auditoria (id_evento INTEGER PRIMARY KEY AUTOINCREMENT, fecha_evento TEXT, usuario TEXT, accion TEXT, detalle TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS asistencia (id_registro INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, doctor TEXT, hora_entrada TEXT, hora_salida TEXT, horas_totales REAL, estado TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS servicios (categoria TEXT, nombre_tratamiento TEXT, precio_lista REAL, costo_laboratorio_base REAL, consent_level TEXT, duracion INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS odontograma (id_paciente TEXT, diente TEXT, estado TEXT, fecha_actualizacion TEXT, PRIMARY KEY (id_paciente, diente))''')
-    conn.commit(); conn.close()
-
 def seed_data():
     conn = get_db_connection()
     c = conn.cursor()
@@ -284,7 +719,7 @@ def seed_data():
 # ==========================================
 
 # Guardaremos en la carpeta de usuario para evitar errores de ruta
-BACKUP_FOLDER = Path.home() / "RoyalDental_Backups"
+BACKUP_FOLDER = Path(os.environ.get("ROYAL_DENTAL_BACKUPS", Path.home() / "RoyalDental_Backups"))
 
 def crear_carpeta_respaldo():
     """Asegura que existe la carpeta de respaldos"""
@@ -295,54 +730,221 @@ def crear_carpeta_respaldo():
         print(f"⚠️ Error creando carpeta respaldo: {e}")
         return False
 
+# Respaldos con la API de backup de SQLite: copia consistente aunque haya escrituras en curso.
+# Cada instantánea se parte en bloques alineados a páginas; los bloques se guardan comprimidos y
+# por contenido (sha256), así que lo que no cambió entre respaldos no vuelve a ocupar disco.
+RESPALDO_PAGINAS_POR_PASO = 512   # Páginas copiadas por paso (entre pasos los escritores pueden avanzar)
+RESPALDO_PAUSA_SEG = 0.01         # Pausa entre pasos para no acaparar el disco
+RESPALDO_BLOQUE_BYTES = 256 * 1024
+RESPALDOS_MAX = 30
+CARPETA_BLOQUES = BACKUP_FOLDER / "bloques"
+CARPETA_INSTANTANEAS = BACKUP_FOLDER / "instantaneas"
+
+@st.cache_resource
+def get_lock_respaldo():
+    """Un solo respaldo a la vez por proceso"""
+    return threading.Lock()
+
+def _ruta_bloque(digest): return CARPETA_BLOQUES / digest[:2] / f"{digest}.zz"
+
+def copiar_db_en_linea(destino):
+    """Copia DB_FILE a `destino` con sqlite3.Connection.backup, por pasos y con pausas"""
+    origen = sqlite3.connect(DB_FILE, timeout=DB_TIMEOUT_SEG); copia = sqlite3.connect(destino)
+    try:
+        origen.backup(copia, pages=RESPALDO_PAGINAS_POR_PASO, progress=lambda estado, restantes, total: time.sleep(RESPALDO_PAUSA_SEG) if restantes else None)
+        copia.execute("PRAGMA journal_mode=DELETE")  # La instantánea queda en un solo archivo
+    finally:
+        copia.close(); origen.close()
+
+def _guardar_bloques(archivo):
+    """Parte el archivo en bloques, guarda los que no existían. Regresa (hashes, sha256 total, bytes nuevos)."""
+    hashes, total, nuevos = [], hashlib.sha256(), 0
+    with open(archivo, "rb") as f:
+        while bloque := f.read(RESPALDO_BLOQUE_BYTES):
+            total.update(bloque); digest = hashlib.sha256(bloque).hexdigest(); hashes.append(digest)
+            ruta = _ruta_bloque(digest)
+            if not ruta.exists():
+                ruta.parent.mkdir(parents=True, exist_ok=True)
+                temporal = ruta.with_suffix(".tmp"); temporal.write_bytes(zlib.compress(bloque, 6)); temporal.replace(ruta)
+                nuevos += len(bloque)
+    return hashes, total.hexdigest(), nuevos
+
+def listar_respaldos():
+    """Manifiestos de las instantáneas, del más reciente al más antiguo"""
+    if not CARPETA_INSTANTANEAS.exists(): return []
+    manifiestos = []
+    for ruta in sorted(CARPETA_INSTANTANEAS.glob("royal_dental_*.json"), reverse=True):
+        try: manifiestos.append(json.loads(ruta.read_text(encoding="utf-8")))
+        except Exception: pass
+    return manifiestos
+
+def aplicar_retencion_respaldos():
+    """Deja las últimas RESPALDOS_MAX instantáneas íntegras y borra los bloques que ya nadie referencia.
+    Las que no pasaron integrity_check no cuentan: una base dañada nunca desplaza a los respaldos buenos."""
+    manifiestos = listar_respaldos()
+    conservar = {m.get("nombre") for m in [m for m in manifiestos if m.get("integridad") == "ok"][:RESPALDOS_MAX]}
+    en_uso = set()
+    for m in manifiestos:
+        if m.get("nombre") in conservar: en_uso.update(m.get("bloques", [])); continue
+        try: (CARPETA_INSTANTANEAS / f"{m.get('nombre')}.json").unlink()
+        except Exception: pass
+    for ruta in CARPETA_BLOQUES.glob("*/*.zz"):
+        if ruta.stem not in en_uso:
+            try: ruta.unlink()
+            except Exception: pass
+
+def restaurar_respaldo(nombre, destino):
+    """Reconstruye la instantánea `nombre` en el archivo `destino` (verifica el sha256 completo)"""
+    manifiesto = json.loads((CARPETA_INSTANTANEAS / f"{nombre}.json").read_text(encoding="utf-8"))
+    total = hashlib.sha256()
+    with open(destino, "wb") as f:
+        for digest in manifiesto["bloques"]:
+            bloque = zlib.decompress(_ruta_bloque(digest).read_bytes()); total.update(bloque); f.write(bloque)
+    if total.hexdigest() != manifiesto["sha256"]: raise ValueError(f"Respaldo {nombre} corrupto (sha256 no coincide)")
+    return destino
+
 def auto_backup_db():
-    """Crea copia de seguridad y limpia las antiguas (mantiene últimas 30)"""
+    """Instantánea en línea + verificación + almacenamiento deduplicado. Corre en el hilo de respaldos, nunca en un rerun."""
+    if not get_lock_respaldo().acquire(blocking=False): return False  # Ya hay un respaldo en curso
+    temporal = None
     try:
-        if not crear_carpeta_respaldo():
+        if not crear_carpeta_respaldo() or not os.path.exists(DB_FILE):
             return False
-        
-        # Nombre del respaldo con fecha/hora
-        timestamp = datetime.now(TZ_MX).strftime("%Y-%m-%d_%H%M")
-        backup_name = f"royal_dental_backup_{timestamp}.db"
-        backup_path = BACKUP_FOLDER / backup_name
-        
-        # Copiar DB actual
-        if os.path.exists(DB_FILE):
-            shutil.copy2(DB_FILE, backup_path)
-            print(f"✅ Respaldo creado exitosamente: {backup_name}") # <--- CAMBIO AQUÍ
-            
-            # Limpieza: Mantener solo últimos 30 respaldos
-            backups = sorted(BACKUP_FOLDER.glob("royal_dental_backup_*.db"))
-            if len(backups) > 30:
-                for old_backup in backups[:-30]:
-                    try:
-                        old_backup.unlink()
-                    except: pass
-            
-            return True
+        CARPETA_INSTANTANEAS.mkdir(parents=True, exist_ok=True)
+        nombre = f"royal_dental_{datetime.now(TZ_MX).strftime('%Y-%m-%d_%H%M%S')}"
+        while (CARPETA_INSTANTANEAS / f"{nombre}.json").exists(): nombre += "b"  # Dos respaldos en el mismo segundo
+        temporal = BACKUP_FOLDER / f"{nombre}.tmp"
+        t0 = time.time()
+        copiar_db_en_linea(temporal)
+        # La verificación se hace sobre la copia: no bloquea a la base en uso
+        conn_copia = sqlite3.connect(temporal)
+        try: integridad = conn_copia.execute("PRAGMA integrity_check").fetchone()[0]
+        finally: conn_copia.close()
+        # Una copia dañada no se guarda: ni manifiesto ni bloques, y la retención no se toca
+        if integridad != "ok":
+            print(f"❌ Respaldo {nombre} descartado por errores de integridad: {integridad}"); return False
+        hashes, sha_total, bytes_nuevos = _guardar_bloques(temporal)
+        manifiesto = {"nombre": nombre, "fecha": datetime.now(TZ_MX).strftime("%Y-%m-%d %H:%M:%S"), "bytes": os.path.getsize(temporal),
+                      "bytes_nuevos": bytes_nuevos, "bloque_bytes": RESPALDO_BLOQUE_BYTES, "bloques": hashes, "sha256": sha_total,
+                      "integridad": integridad, "segundos": round(time.time() - t0, 2)}
+        (CARPETA_INSTANTANEAS / f"{nombre}.json").write_text(json.dumps(manifiesto), encoding="utf-8")
+        aplicar_retencion_respaldos()
+        print(f"✅ Respaldo creado exitosamente: {nombre} ({bytes_nuevos / 1e6:.1f} MB nuevos de {manifiesto['bytes'] / 1e6:.1f} MB)")
+        return True
     except Exception as e:
-        print(f"❌ Error en respaldo: {e}") # <--- CAMBIO AQUÍ
+        print(f"❌ Error en respaldo: {e}")
         return False
+    finally:
+        if temporal is not None and temporal.exists():
+            try: temporal.unlink()
+            except Exception: pass
+        get_lock_respaldo().release()
     
-def backup_periodico():
-    """Ejecuta respaldo cada 4 horas en segundo plano"""
-    while True:
-        time.sleep(4 * 3600)  # 4 horas
-        auto_backup_db()
-
-def iniciar_respaldo_background():
-    """Inicia el hilo de respaldo automático"""
-    # 1. Hacemos un respaldo inmediato al abrir la app
-    auto_backup_db()
-    
-    # 2. Iniciamos el cronómetro para los siguientes
-    backup_thread = threading.Thread(target=backup_periodico, daemon=True)
-    backup_thread.start()
+def verificar_integridad_db():
+    """PRAGMA quick_check sobre la base en uso (conexión propia, fuera del pool de la UI)"""
+    conn = sqlite3.connect(DB_FILE, timeout=DB_TIMEOUT_SEG)
+    try: resultado = conn.execute("PRAGMA quick_check").fetchone()[0]
+    finally: conn.close()
+    if resultado != "ok": raise RuntimeError(f"quick_check: {resultado}")
+    return resultado
+
+def limpiar_respaldos():
+    """Retención de instantáneas + temporales que haya dejado un respaldo interrumpido"""
+    for temporal in list(BACKUP_FOLDER.glob("*.tmp")) + list(CARPETA_BLOQUES.glob("*/*.tmp")):
+        if time.time() - temporal.stat().st_mtime > 3600:
+            try: temporal.unlink()
+            except Exception: pass
+    aplicar_retencion_respaldos()
+    return len(listar_respaldos())
+
+def calentar_caches():
+    """Deja listos el directorio de pacientes y la ocupación de hoy antes de que alguien los pida"""
+    etiquetas = get_directorio_pacientes().etiquetas()
+    obtener_ocupacion_dia(get_fecha_mx())
+    return len(etiquetas)
 
-# Ejecución de inicialización completa
-init_db(); migrar_tablas(); seed_data(); actualizar_niveles_riesgo(); actualizar_duraciones()
-# INICIAR RESPALDOS
-iniciar_respaldo_background()
+# ==========================================
+# PLANIFICADOR DE TAREAS (UN SOLO HILO POR PROCESO)
+# ==========================================
+# Streamlit re-ejecuta el script en cada interacción: las tareas periódicas viven en un
+# objeto de st.cache_resource con un único hilo, no en el cuerpo del módulo.
+TAREAS_PROGRAMADAS = [
+    # (nombre, función, cada cuántos segundos, retraso del primer disparo)
+    ("respaldo", lambda: auto_backup_db() or "falló", 4 * 3600, 5),
+    ("integridad", verificar_integridad_db, 24 * 3600, 15 * 60),
+    ("retencion", limpiar_respaldos, 24 * 3600, 30 * 60),
+    ("calentar_caches", calentar_caches, 10 * 60, 1),
+    ("cadena_auditoria", lambda: tarea_verificar_auditoria(), 24 * 3600, 45 * 60),
+]
+
+class PlanificadorTareas:
+    """Ejecuta en serie las tareas vencidas y guarda el estado de cada una para la vista de administración"""
+    def __init__(self):
+        self._tareas = {}
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def registrar(self, nombre, funcion, intervalo_seg, retraso_seg=0):
+        with self._lock:
+            self._tareas[nombre] = {"funcion": funcion, "intervalo": intervalo_seg, "proxima": time.time() + retraso_seg,
+                                    "ultima": None, "duracion": None, "resultado": None, "error": None, "ejecuciones": 0, "corriendo": False}
+
+    def iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._bucle, daemon=True, name="planificador")
+            self._hilo.start()
+
+    def ejecutar_ahora(self, nombre):
+        with self._lock: self._tareas[nombre]["proxima"] = 0
+        self._despertar.set()
+
+    def _correr(self, nombre, tarea):
+        tarea["corriendo"] = True; t0 = time.time()
+        try: tarea["resultado"] = str(tarea["funcion"]())[:200]; tarea["error"] = None
+        except Exception as e:
+            tarea["error"] = str(e)[:200]; print(f"❌ Tarea {nombre}: {e}")
+        with self._lock:
+            tarea.update(corriendo=False, ultima=t0, duracion=time.time() - t0, ejecuciones=tarea["ejecuciones"] + 1,
+                         proxima=time.time() + tarea["intervalo"])
+
+    def _bucle(self):
+        while True:
+            with self._lock: vencidas = [(n, t) for n, t in self._tareas.items() if t["proxima"] <= time.time()]
+            for nombre, tarea in vencidas: self._correr(nombre, tarea)
+            with self._lock: espera = min((t["proxima"] for t in self._tareas.values()), default=time.time() + 60) - time.time()
+            self._despertar.wait(timeout=max(0.5, espera)); self._despertar.clear()
+
+    def estado(self):
+        """Una fila por tarea: última ejecución, duración, resultado y próxima ejecución"""
+        fecha = lambda ts: datetime.fromtimestamp(ts, TZ_MX).strftime("%d/%m/%Y %H:%M:%S") if ts else "-"
+        with self._lock:
+            return pd.DataFrame([{"Tarea": n, "Cada (min)": t["intervalo"] // 60, "Última": fecha(t["ultima"]),
+                                  "Duración (s)": round(t["duracion"], 2) if t["duracion"] is not None else None,
+                                  "Resultado": "⏳ En curso" if t["corriendo"] else (f"❌ {t['error']}" if t["error"] else t["resultado"] or "-"),
+                                  "Próxima": fecha(t["proxima"]), "Ejecuciones": t["ejecuciones"]} for n, t in self._tareas.items()])
+
+    def activo(self): return self._hilo is not None and self._hilo.is_alive()
+
+@st.cache_resource
+def get_planificador():
+    """Único planificador del proceso: se crea y arranca la primera vez, los reruns lo reutilizan"""
+    planificador = PlanificadorTareas()
+    for nombre, funcion, intervalo, retraso in TAREAS_PROGRAMADAS: planificador.registrar(nombre, funcion, intervalo, retraso)
+    planificador.iniciar()
+    return planificador
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_bd(db_file, esquema_version):
+    """Migraciones, catálogo base y mantenimiento de servicios. Corre una vez por proceso y por
+    (archivo, versión de esquema); los reruns reciben el resultado guardado y van directo a la pantalla."""
+    t0 = time.time()
+    aplicadas = aplicar_migraciones(); seed_data(); actualizar_niveles_riesgo(); actualizar_duraciones()
+    return {"archivo": db_file, "esquema": esquema_version, "migraciones": aplicadas,
+            "segundos": round(time.time() - t0, 3), "fecha": datetime.now(TZ_MX).strftime("%d/%m/%Y %H:%M:%S")}
+
+# Ejecución de inicialización (una sola vez por proceso; los trabajadores de documentos encuentran la BD ya lista)
+ARRANQUE_BD = bootstrap_bd(DB_FILE, ESQUEMA_VERSION) if not PROCESO_TRABAJADOR else None
 
 # ==========================================
 # 3. HELPERS (FUNCIONES DE AYUDA)
@@ -359,6 +961,9 @@ def get_fecha_larga_mx():
 # 3. Resto de funciones normales
 def get_hora_mx(): return datetime.now(TZ_MX).strftime("%H:%M:%S")
 def format_date_latino(date_obj): return date_obj.strftime("%d/%m/%Y")
+# Formato ISO (columna citas.fecha_iso) para filtros y rangos en SQL
+def format_date_iso(date_obj): return date_obj.strftime("%Y-%m-%d")
+def get_fecha_iso_mx(): return datetime.now(TZ_MX).strftime("%Y-%m-%d")
 
 def normalizar_texto_pdf(texto):
     if not texto: return ""
@@ -407,6 +1012,13 @@ def generar_id_unico(nombre, paterno, nacimiento):
 
 def formatear_telefono_db(numero): return re.sub(r'\D', '', str(numero))
 
+def formato_moneda(valores):
+    """Columna numérica -> '$1,234.56' (formato contable). Un solo map de str.format sobre el arreglo de floats:
+    sin apply fila por fila ni los métodos .str de pandas (más lentos que esto en columnas cortas y largas)."""
+    serie = pd.Series(valores)
+    numeros = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float, na_value=0.0)
+    return pd.Series(list(map("${:,.2f}".format, numeros.tolist())), index=serie.index, dtype=object)
+
 def generar_slots_tiempo():
     slots = []
     hora_actual = datetime.strptime("08:00", "%H:%M")
@@ -419,30 +1031,487 @@ def generar_slots_tiempo():
 def get_regimenes_fiscales(): return ["605 - Sueldos y Salarios", "612 - PFAEP (Actividad Empresarial)", "626 - RESICO", "616 - Sin obligaciones fiscales", "601 - General de Ley Personas Morales"]
 def get_usos_cfdi(): return ["D01 - Honorarios médicos, dentales", "S01 - Sin efectos fiscales", "G03 - Gastos en general", "CP01 - Pagos"]
 
-def verificar_disponibilidad(fecha_str, hora_str, duracion_minutos=30):
-    conn = get_db_connection(); c = conn.cursor()
-    c.execute("SELECT hora, duracion FROM citas WHERE fecha=? AND estado_pago != 'CANCELADO' AND (estatus_asistencia IS NULL OR estatus_asistencia != 'Canceló') AND (precio_final IS NULL OR precio_final = 0)", (fecha_str,))
-    citas_dia = c.fetchall()
-    conn.close()
-    
+# ==========================================
+# CACHÉS POR VERSIÓN (INVALIDACIÓN PUNTUAL)
+# ==========================================
+class VersionesCache:
+    """Contadores por clave. Las funciones con st.cache_data reciben la versión como argumento:
+    al invalidar una clave, la siguiente lectura ya no encuentra la entrada vieja y consulta la BD."""
+    def __init__(self):
+        self._versiones = {}
+        self._lock = threading.Lock()
+
+    def version(self, clave): return self._versiones.get(clave, 0)
+
+    def invalidar(self, clave):
+        with self._lock: self._versiones[clave] = self._versiones.get(clave, 0) + 1
+
+@st.cache_resource
+def get_versiones_cache():
+    """Compartido por todas las sesiones: lo que invalida recepción lo ve el consultorio"""
+    return VersionesCache()
+
+# AGENDA DEL DÍA: una sola consulta (índice idx_citas_agenda) para la lista y el visualizador
+QUERY_AGENDA_DIA = """
+    SELECT rowid, fecha, hora, nombre_paciente, tratamiento,
+           estatus_asistencia, duracion, estado_pago, id_paciente, notas,
+           doctor_atendio, sillon, precio_final
+    FROM citas
+    WHERE fecha = ? AND estado_pago != 'CANCELADO'
+    ORDER BY hora ASC
+"""
+
+# ttl: red de seguridad por si otro proceso (scripts de carga, otra instancia) escribe en la BD
+@st.cache_data(max_entries=90, ttl=600, show_spinner=False)
+def _cargar_citas_dia(fecha_str, version):
+    conn = get_db_connection()
+    try: return pd.read_sql(QUERY_AGENDA_DIA, conn, params=(fecha_str,))
+    finally: conn.close()
+
+def obtener_citas_dia(fecha_str):
+    """Citas (no canceladas) de una fecha dd/mm/YYYY, en caché hasta que algo cambie ese día"""
+    return _cargar_citas_dia(fecha_str, get_versiones_cache().version(f"agenda:{fecha_str}"))
+
+def invalidar_agenda(*fechas):
+    """Llamar después de cualquier INSERT/UPDATE en citas, con la(s) fecha(s) afectada(s)"""
+    versiones = get_versiones_cache()
+    for fecha in set(fechas):
+        if fecha: versiones.invalidar(f"agenda:{fecha}")
+
+# ==========================================
+# MOTOR DE OCUPACIÓN (BITMAP POR MINUTO)
+# ==========================================
+# Cada día se representa como un entero de Python usado como bitmap de 1440 bits
+# (un bit por minuto). Empalme = (bitmap & máscara) != 0: microsegundos, sin strptime.
+HORA_CIERRE = "19:00"  # Las sugerencias no deben terminar después del cierre
+MINUTOS_DIA = 24 * 60
+
+def hora_a_minutos(hora_str):
+    """'HH:MM' -> minutos desde medianoche. None si no es hora de agenda (p.ej. cobros 'HH:MM:SS')"""
+    partes = str(hora_str).strip().split(":")
+    if len(partes) != 2: return None
+    try: h, m = int(partes[0]), int(partes[1])
+    except ValueError: return None
+    return h * 60 + m if (0 <= h < 24 and 0 <= m < 60) else None
+
+def minutos_a_hora(minutos): return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+def duracion_valida(duracion):
+    """Duración en minutos; vacía, NaN o <= 0 cuenta como 30 (igual que la agenda)"""
+    try: d = int(duracion)
+    except (TypeError, ValueError): return 30
+    return d if d > 0 else 30
+
+def _mascara(inicio, fin): return ((1 << (fin - inicio)) - 1) << inicio
+
+def texto_o_none(valor):
+    """Normaliza celdas vacías de pandas (None, NaN, '') a None"""
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)): return None
+    valor = str(valor).strip()
+    return valor or None
+
+class OcupacionDia:
+    """Ocupación de una fecha por recurso (doctor y sillón). Se construye una vez desde la
+    consulta del día y se actualiza en memoria al agendar, mover o cancelar."""
+    CLINICA = "clinica"  # Unión de todos los recursos (cuando no se indica doctor ni sillón)
+
+    def __init__(self, fecha_str):
+        self.fecha = fecha_str
+        self.construido = time.time()
+        self.citas = {}        # rowid -> (inicio, fin, doctor, sillon, bloquea)
+        self._bitmaps = {}     # recurso -> int; se vacía después de una baja y se recalcula perezosamente
+        self._lock = threading.Lock()
+
+    @classmethod
+    def desde_citas(cls, fecha_str, df_dia):
+        ocupacion = cls(fecha_str)
+        for r in df_dia.itertuples(index=False):
+            # Solo bloquean citas de agenda (sin cobro) que no fueron canceladas, como en la V41
+            bloquea = (r.estatus_asistencia != 'Canceló') and (pd.isna(r.precio_final) or r.precio_final == 0)
+            ocupacion.agregar(r.rowid, r.hora, r.duracion, r.doctor_atendio, r.sillon, bloquea)
+        return ocupacion
+
+    @staticmethod
+    def _recursos(doctor, sillon):
+        # Una cita sin doctor asignado se guarda como ('doctor', None) y bloquea a todos los doctores
+        recursos = [OcupacionDia.CLINICA, ("doctor", doctor)]
+        if sillon: recursos.append(("sillon", sillon))
+        return recursos
+
+    def agregar(self, rowid, hora, duracion, doctor=None, sillon=None, bloquea=True):
+        inicio = hora_a_minutos(hora)
+        if inicio is None: return
+        fin = min(inicio + duracion_valida(duracion), MINUTOS_DIA)
+        doctor = texto_o_none(doctor); sillon = texto_o_none(sillon)
+        with self._lock:
+            if rowid in self.citas: self._bitmaps = {}
+            self.citas[rowid] = (inicio, fin, doctor, sillon, bloquea)
+            if bloquea:
+                for recurso in self._recursos(doctor, sillon):
+                    if recurso in self._bitmaps: self._bitmaps[recurso] |= _mascara(inicio, fin)
+
+    def quitar(self, rowid):
+        with self._lock:
+            if self.citas.pop(rowid, None) is not None: self._bitmaps = {}
+
+    def _copia_citas(self):
+        """Foto de las citas bajo el candado: otra sesión puede agregar/quitar mientras se recorre"""
+        with self._lock: return list(self.citas.items())
+
+    def _calcular_bitmap(self, citas, recurso, excluir=None):
+        bitmap = 0
+        for rowid, (inicio, fin, doctor, sillon, bloquea) in citas:
+            if bloquea and rowid != excluir and recurso in self._recursos(doctor, sillon):
+                bitmap |= _mascara(inicio, fin)
+        return bitmap
+
+    def bitmap(self, recurso=CLINICA, excluir=None):
+        if excluir is not None: return self._calcular_bitmap(self._copia_citas(), recurso, excluir)
+        with self._lock:
+            if recurso not in self._bitmaps: self._bitmaps[recurso] = self._calcular_bitmap(self.citas.items(), recurso)
+            return self._bitmaps[recurso]
+
+    def bitmap_conflictos(self, doctor=None, sillon=None, excluir=None):
+        """Minutos en los que una cita de ese doctor/sillón chocaría con otra"""
+        doctor = texto_o_none(doctor); sillon = texto_o_none(sillon)
+        if not doctor and not sillon: return self.bitmap(self.CLINICA, excluir)
+        bitmap = 0
+        if doctor: bitmap |= self.bitmap(("doctor", doctor), excluir) | self.bitmap(("doctor", None), excluir)
+        if sillon: bitmap |= self.bitmap(("sillon", sillon), excluir)
+        return bitmap
+
+    def ocupado(self, hora_str, duracion_minutos=30, doctor=None, sillon=None, excluir=None):
+        inicio = hora_a_minutos(hora_str)
+        if inicio is None: return True
+        fin = min(inicio + duracion_valida(duracion_minutos), MINUTOS_DIA)
+        return (self.bitmap_conflictos(doctor, sillon, excluir) & _mascara(inicio, fin)) != 0
+
+    def sillon_libre(self, hora_str, duracion_minutos=30, doctor=None, preferido=None, excluir=None):
+        """Primer sillón donde cabe la cita (respetando el preferido si está libre). None si no hay."""
+        preferido = texto_o_none(preferido)
+        candidatos = ([preferido] if preferido else []) + [x for x in LISTA_SILLONES if x != preferido]
+        for sillon in candidatos:
+            if not self.ocupado(hora_str, duracion_minutos, doctor, sillon, excluir): return sillon
+        return None
+
+    def horarios_libres(self, duracion_minutos=30, n=5, desde=None, excluir=None, doctor=None, sillon=None):
+        """Primeros n horarios de la agenda donde cabe una cita de esa duración para ese doctor/sillón.
+        Con doctor y sin sillón basta con que quede algún sillón libre."""
+        dur = duracion_valida(duracion_minutos); cierre = hora_a_minutos(HORA_CIERRE)
+        if doctor and not sillon:
+            b_doc = self.bitmap_conflictos(doctor, None, excluir)
+            b_sillones = [self.bitmap(("sillon", x), excluir) for x in LISTA_SILLONES]
+        else:
+            b_doc = self.bitmap_conflictos(doctor, sillon, excluir); b_sillones = [0]
+        libres = []
+        for slot in generar_slots_tiempo():
+            inicio = hora_a_minutos(slot)
+            if desde is not None and inicio < desde: continue
+            if inicio + dur > cierre: break
+            mascara = _mascara(inicio, inicio + dur)
+            if not b_doc & mascara and any(not b & mascara for b in b_sillones):
+                libres.append(slot)
+                if len(libres) >= n: break
+        return libres
+
+    def bloques(self, slots, paso=30, recurso=None):
+        """slot -> {'tipo': 'inicio', 'rowid', 'dur'} o {'tipo': 'bloqueado', 'rowid'} para el visualizador.
+        recurso=('doctor', nombre) o ('sillon', nombre) limita a las citas de ese recurso."""
+        mapa = {}
+        ordenadas = sorted(self._copia_citas(), key=lambda kv: (kv[1][0], kv[0]))
+        if recurso is not None:
+            tipo, nombre = recurso
+            ordenadas = [kv for kv in ordenadas if (kv[1][2] if tipo == "doctor" else kv[1][3]) == nombre]
+        for slot in slots:
+            s_ini = hora_a_minutos(slot)
+            for rowid, (inicio, fin, _, _, _) in ordenadas:
+                if s_ini <= inicio < s_ini + paso:
+                    mapa[slot] = {"tipo": "inicio", "rowid": rowid, "dur": fin - inicio}; break
+                if inicio < s_ini < fin and slot not in mapa:
+                    mapa[slot] = {"tipo": "bloqueado", "rowid": rowid}
+        return mapa
+
+    def recursos_en_uso(self, tipo):
+        """Nombres de doctor/sillón presentes en el día (incluye None si hay citas sin asignar)"""
+        idx = 2 if tipo == "doctor" else 3
+        return {datos[idx] for _, datos in self._copia_citas()}
+
+class AgendaOcupacion:
+    """Mapas de ocupación por fecha, compartidos por todas las sesiones del proceso"""
+    TTL_SEG = 600      # Igual que la caché de la consulta del día
+    MAX_DIAS = 120
+
+    def __init__(self):
+        self._dias = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, fecha_str):
+        with self._lock: ocupacion = self._dias.get(fecha_str)
+        if ocupacion is None or time.time() - ocupacion.construido > self.TTL_SEG:
+            ocupacion = OcupacionDia.desde_citas(fecha_str, obtener_citas_dia(fecha_str))
+            with self._lock:
+                if len(self._dias) >= self.MAX_DIAS: self._dias.pop(next(iter(self._dias)))
+                self._dias[fecha_str] = ocupacion
+        return ocupacion
+
+    def si_existe(self, fecha_str):
+        with self._lock: return self._dias.get(fecha_str)
+
+@st.cache_resource
+def get_agenda_ocupacion():
+    return AgendaOcupacion()
+
+def obtener_ocupacion_dia(fecha_str): return get_agenda_ocupacion().obtener(fecha_str)
+
+# Notificaciones de escritura: invalidan la consulta del día y ajustan el bitmap sin releer la BD
+def agenda_cita_agregada(fecha_str, rowid, hora, duracion, doctor=None, sillon=None):
+    invalidar_agenda(fecha_str)
+    ocupacion = get_agenda_ocupacion().si_existe(fecha_str)
+    if ocupacion: ocupacion.agregar(rowid, hora, duracion, doctor, sillon)
+
+def agenda_cita_cancelada(fecha_str, rowid):
+    invalidar_agenda(fecha_str)
+    ocupacion = get_agenda_ocupacion().si_existe(fecha_str)
+    if ocupacion: ocupacion.quitar(rowid)
+
+def agenda_cita_movida(rowid, fecha_anterior, fecha_nueva, hora, duracion, doctor=None, sillon=None):
+    agenda_cita_cancelada(fecha_anterior, rowid)
+    agenda_cita_agregada(fecha_nueva, rowid, hora, duracion, doctor, sillon)
+
+def verificar_disponibilidad(fecha_str, hora_str, duracion_minutos=30, doctor=None, sillon=None, excluir=None):
+    """True si el horario se empalma con otra cita del mismo doctor o del mismo sillón.
+    Sin doctor ni sillón revisa la clínica completa (comportamiento anterior)."""
+    try: return obtener_ocupacion_dia(fecha_str).ocupado(hora_str, duracion_minutos, doctor, sillon, excluir)
+    except Exception: return True
+
+def asignar_sillon(fecha_str, hora_str, duracion_minutos=30, doctor=None, preferido=None, excluir=None):
+    """Sillón libre para la cita (None si todos están ocupados a esa hora)"""
+    # Igual que verificar_disponibilidad: ante un error se responde lo seguro (sin sillón = no se agenda encima)
+    try: return obtener_ocupacion_dia(fecha_str).sillon_libre(hora_str, duracion_minutos, doctor, preferido, excluir)
+    except Exception: return None
+
+def sugerir_horarios(fecha_str, duracion_minutos=30, n=5, excluir=None, doctor=None, sillon=None):
+    """Próximos n horarios libres para la duración pedida (en el día de hoy, solo a partir de la hora actual)"""
+    desde = None
+    if fecha_str == get_fecha_mx():
+        ahora = datetime.now(TZ_MX); desde = ahora.hour * 60 + ahora.minute
+    try: return obtener_ocupacion_dia(fecha_str).horarios_libres(duracion_minutos, n=n, desde=desde, excluir=excluir, doctor=doctor, sillon=sillon)
+    except Exception: return []
+
+# ==========================================
+# DIRECTORIO DE PACIENTES (CACHÉ COMPARTIDA)
+# ==========================================
+QUERY_DIRECTORIO = "SELECT id_paciente, nombre, apellido_paterno FROM pacientes"
+
+def _etiquetas_pacientes(df):
+    """'ID - Nombre Paterno' vectorizado (misma etiqueta que usaban los selectbox)"""
+    return (df['id_paciente'].astype(str) + " - " + df['nombre'].fillna("").astype(str) + " " + df['apellido_paterno'].fillna("").astype(str)).tolist()
+
+class DirectorioPacientes:
+    """Proyección ligera (id, nombre, paterno) y etiquetas de todos los pacientes, compartida por las sesiones.
+    Solo el alta, la edición y la nota administrativa la tocan, y lo hacen fila por fila."""
+    def __init__(self):
+        self._df = None
+        self._etiquetas = []
+        self._lock = threading.Lock()
+
+    def _cargar(self):
+        conn = get_db_connection()
+        try: df = pd.read_sql(QUERY_DIRECTORIO, conn)
+        finally: conn.close()
+        self._df = df.set_index('id_paciente', drop=False); self._etiquetas = _etiquetas_pacientes(df)
+
+    def tabla(self):
+        with self._lock:
+            if self._df is None: self._cargar()
+            return self._df
+
+    def etiquetas(self):
+        with self._lock:
+            if self._df is None: self._cargar()
+            return self._etiquetas
+
+    def actualizar(self, id_paciente):
+        """Re-lee un paciente y lo inserta/reemplaza en la proyección sin recargar todo"""
+        with self._lock:
+            if self._df is None: return
+            conn = get_db_connection()
+            try: fila = pd.read_sql(QUERY_DIRECTORIO + " WHERE id_paciente = ?", conn, params=(id_paciente,))
+            finally: conn.close()
+            df = self._df.drop(index=id_paciente, errors='ignore')
+            if not fila.empty: df = pd.concat([df, fila.set_index('id_paciente', drop=False)])
+            self._df = df; self._etiquetas = _etiquetas_pacientes(df)
+
+    def invalidar(self):
+        with self._lock: self._df = None; self._etiquetas = []
+
+@st.cache_resource
+def get_directorio_pacientes():
+    return DirectorioPacientes()
+
+def obtener_etiquetas_pacientes():
+    """Lista 'ID - Nombre Paterno' para los selectores de paciente"""
+    return get_directorio_pacientes().etiquetas()
+
+@st.cache_data(max_entries=256, ttl=600, show_spinner=False)
+def _cargar_paciente(id_paciente, version):
+    conn = get_db_connection()
+    try: return pd.read_sql("SELECT * FROM pacientes WHERE id_paciente = ?", conn, params=(id_paciente,))
+    finally: conn.close()
+
+def obtener_paciente(id_paciente):
+    """Expediente completo de un paciente (carga perezosa, en caché hasta que se edite). None si no existe."""
+    df = _cargar_paciente(str(id_paciente), get_versiones_cache().version(f"paciente:{id_paciente}"))
+    return None if df.empty else df.iloc[0]
+
+def consulta_fts(texto):
+    """Texto libre -> consulta FTS5: cada palabra como prefijo ('ana gar' -> "ANA"* "GAR"*)"""
+    palabras = re.findall(r"\w+", formato_nombre_legal(texto))
+    return " ".join(f'"{p}"*' for p in palabras)
+
+BUSQUEDA_CANDIDATOS = 1000  # Solo se ordenan por relevancia los primeros N aciertos (apellidos muy comunes)
+
+def buscar_pacientes(texto, limite=20, desplazamiento=0):
+    """Top-k pacientes por id, nombre, teléfono, RFC o email. Regresa (etiquetas, hay_mas)."""
+    consulta = consulta_fts(texto)
+    if not consulta: return [], False
+    candidatos = max(BUSQUEDA_CANDIDATOS, desplazamiento + limite + 1)
+    conn = get_db_connection()
     try:
-        req_start = datetime.strptime(hora_str, "%H:%M")
-        req_end = req_start + timedelta(minutes=duracion_minutos)
-        req_start_min = req_start.hour * 60 + req_start.minute
-        req_end_min = req_end.hour * 60 + req_end.minute
-        
-        for cit in citas_dia:
-            h_inicio = cit['hora']
-            d_duracion = cit['duracion'] if cit['duracion'] else 30 
-            c_start = datetime.strptime(h_inicio, "%H:%M")
-            c_end = c_start + timedelta(minutes=d_duracion)
-            c_start_min = c_start.hour * 60 + c_start.minute
-            c_end_min = c_end.hour * 60 + c_end.minute
-            
-            if (req_start_min < c_end_min) and (req_end_min > c_start_min):
-                return True 
-        return False 
-    except: return True 
+        filas = conn.execute("""SELECT p.id_paciente, p.nombre, p.apellido_paterno
+                                FROM (SELECT rowid, rank FROM pacientes_fts WHERE pacientes_fts MATCH ? LIMIT ?) AS f
+                                JOIN pacientes p ON p.rowid = f.rowid
+                                ORDER BY f.rank LIMIT ? OFFSET ?""", (consulta, candidatos, limite + 1, desplazamiento)).fetchall()
+    except sqlite3.OperationalError: return [], False
+    finally: conn.close()
+    etiquetas = [f"{i} - {n or ''} {p or ''}" for i, n, p in filas[:limite]]
+    return etiquetas, len(filas) > limite
+
+def paciente_actualizado(id_paciente):
+    """Llamar después de INSERT/UPDATE en pacientes (alta, edición, nota administrativa)"""
+    get_versiones_cache().invalidar(f"paciente:{id_paciente}")
+    get_directorio_pacientes().actualizar(id_paciente)
+
+# ==========================================
+# LIBRO DE SALDOS POR PACIENTE
+# ==========================================
+# Se mueve con deltas dentro de la MISMA transacción que el INSERT/UPDATE en citas
+# (cobro, abono, cancelación), así que nunca queda desfasado de lo que se confirmó.
+def saldo_aplicar(c, id_paciente, cargo=0.0, abono=0.0, saldo=0.0, ts=None):
+    """Suma deltas al saldo del paciente (crea la fila si no existe)"""
+    c.execute("""INSERT INTO saldos_pacientes (id_paciente, cargos, abonos, saldo, ultimo_movimiento) VALUES (?, ROUND(?, 2), ROUND(?, 2), ROUND(?, 2), ?)
+                 ON CONFLICT(id_paciente) DO UPDATE SET cargos = ROUND(cargos + excluded.cargos, 2), abonos = ROUND(abonos + excluded.abonos, 2),
+                     saldo = ROUND(saldo + excluded.saldo, 2), ultimo_movimiento = max(ifnull(ultimo_movimiento, 0), ifnull(excluded.ultimo_movimiento, 0))""",
+              (id_paciente, float(cargo or 0), float(abono or 0), float(saldo or 0), ts))
+
+def saldo_cancelar_cita(c, rowid):
+    """Antes de marcar una cita como CANCELADO: retira del libro lo que esa fila aportaba"""
+    fila = c.execute("SELECT id_paciente, precio_final, monto_pagado, saldo_pendiente FROM citas WHERE rowid = ? AND estado_pago != 'CANCELADO'", (rowid,)).fetchone()
+    if fila and any(fila[1:]): saldo_aplicar(c, fila[0], -(fila[1] or 0), -(fila[2] or 0), -(fila[3] or 0))
+
+def obtener_saldo_paciente(id_paciente):
+    """{'cargos', 'abonos', 'saldo', 'ultimo_movimiento'} en una sola búsqueda por llave primaria"""
+    conn = get_db_connection()
+    try: fila = conn.execute("SELECT cargos, abonos, saldo, ultimo_movimiento FROM saldos_pacientes WHERE id_paciente = ?", (id_paciente,)).fetchone()
+    finally: conn.close()
+    if not fila: return {"cargos": 0.0, "abonos": 0.0, "saldo": 0.0, "ultimo_movimiento": None}
+    return {"cargos": fila[0], "abonos": fila[1], "saldo": fila[2], "ultimo_movimiento": fila[3]}
+
+def verificar_saldos():
+    """Compara el libro contra la suma real de citas. Regresa las diferencias (vacío = cuadra)."""
+    conn = get_db_connection()
+    try:
+        return pd.read_sql(f"""
+            WITH real AS ({SQL_SALDOS_DESDE_CITAS}),
+                 ids AS (SELECT id_paciente FROM real UNION SELECT id_paciente FROM saldos_pacientes)
+            SELECT ids.id_paciente, l.saldo AS saldo_libro, r.saldo AS saldo_real, l.cargos AS cargos_libro, r.cargos AS cargos_real,
+                   l.abonos AS abonos_libro, r.abonos AS abonos_real
+            FROM ids LEFT JOIN saldos_pacientes l ON l.id_paciente = ids.id_paciente LEFT JOIN real r ON r.id_paciente = ids.id_paciente
+            WHERE abs(ifnull(l.saldo, 0) - ifnull(r.saldo, 0)) > 0.005 OR abs(ifnull(l.cargos, 0) - ifnull(r.cargos, 0)) > 0.005
+               OR abs(ifnull(l.abonos, 0) - ifnull(r.abonos, 0)) > 0.005""", conn)
+    finally: conn.close()
+
+def reconstruir_saldos():
+    """Recalcula todo el libro desde citas (después de cargas masivas o si verificar_saldos encuentra diferencias)"""
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM saldos_pacientes")
+        conn.execute(f"INSERT INTO saldos_pacientes (id_paciente, cargos, abonos, saldo, ultimo_movimiento) {SQL_SALDOS_DESDE_CITAS}")
+
+def reporte_cuentas_por_cobrar(limite=200):
+    """Deudores ordenados por saldo (índice parcial idx_saldos_deudores) y total por cobrar"""
+    conn = get_db_connection()
+    try:
+        total, deudores = conn.execute("SELECT ifnull(ROUND(SUM(saldo), 2), 0), COUNT(*) FROM saldos_pacientes WHERE saldo > 0.005").fetchone()
+        df = pd.read_sql("""SELECT s.id_paciente, p.nombre, p.apellido_paterno, p.telefono, s.cargos, s.abonos, s.saldo, s.ultimo_movimiento
+                            FROM saldos_pacientes s LEFT JOIN pacientes p ON p.id_paciente = s.id_paciente
+                            WHERE s.saldo > 0.005 ORDER BY s.saldo DESC LIMIT ?""", conn, params=(limite,))
+    finally: conn.close()
+    return total, deudores, df
+
+# ==========================================
+# RESUMEN FINANCIERO (TABLERO DE ADMINISTRACIÓN)
+# ==========================================
+# Igual que el libro de saldos: cobro, abono, cancelación y cambio de fecha mueven el resumen con deltas
+# en la misma transacción que tocan citas. Antes de un UPDATE se retira la fila y después se vuelve a sumar.
+COLUMNAS_RESUMEN = ["cargos", "cobrado", "saldo", "costo_lab", "movimientos"]
+# Inicio de cada periodo a partir de fecha_iso (las semanas empiezan en lunes)
+PERIODOS_TABLERO = {"Día": "fecha_iso", "Semana": "date(fecha_iso, '-' || ((strftime('%w', fecha_iso) + 6) % 7) || ' days')",
+                    "Mes": "substr(fecha_iso, 1, 7) || '-01'"}
+DESGLOSES_TABLERO = {"Doctor": "doctor", "Categoría": "categoria", "Método de pago": "metodo_pago"}
+
+def resumen_aplicar_cita(c, rowid, signo=1):
+    """Suma (signo=1) o retira (signo=-1) lo que una fila de citas aporta al resumen; las que no mueven dinero no cuentan"""
+    fila = c.execute(f"""SELECT {SQL_CLAVE_RESUMEN}, CAST(ifnull(precio_final, 0) AS REAL), CAST(ifnull(monto_pagado, 0) AS REAL),
+                                CAST(ifnull(saldo_pendiente, 0) AS REAL), CAST(ifnull(costo_laboratorio, 0) AS REAL)
+                         FROM citas WHERE rowid = ? AND {SQL_FILTRO_RESUMEN}""", (rowid,)).fetchone()
+    if not fila: return
+    c.execute("""INSERT INTO resumen_financiero (fecha_iso, doctor, categoria, metodo_pago, cargos, cobrado, saldo, costo_lab, movimientos)
+                 VALUES (?, ?, ?, ?, ROUND(?, 2), ROUND(?, 2), ROUND(?, 2), ROUND(?, 2), ?)
+                 ON CONFLICT(fecha_iso, doctor, categoria, metodo_pago) DO UPDATE SET cargos = ROUND(cargos + excluded.cargos, 2),
+                     cobrado = ROUND(cobrado + excluded.cobrado, 2), saldo = ROUND(saldo + excluded.saldo, 2),
+                     costo_lab = ROUND(costo_lab + excluded.costo_lab, 2), movimientos = movimientos + excluded.movimientos""",
+              (*fila[:4], *(signo * v for v in fila[4:]), signo))
+    # Un grupo que se quedó sin filas (cita cancelada o movida de día) se borra en lugar de dejarlo en ceros
+    if signo < 0: c.execute("DELETE FROM resumen_financiero WHERE fecha_iso = ? AND doctor = ? AND categoria = ? AND metodo_pago = ? AND movimientos <= 0", fila[:4])
+
+def verificar_resumen_financiero():
+    """Compara el resumen contra la suma real de citas. Regresa las diferencias (vacío = cuadra)."""
+    conn = get_db_connection()
+    try:
+        return pd.read_sql(f"""
+            WITH real AS ({SQL_RESUMEN_DESDE_CITAS}),
+                 llaves AS (SELECT fecha_iso, doctor, categoria, metodo_pago FROM real
+                            UNION SELECT fecha_iso, doctor, categoria, metodo_pago FROM resumen_financiero)
+            SELECT k.fecha_iso, k.doctor, k.categoria, k.metodo_pago, l.cargos AS cargos_resumen, r.cargos AS cargos_real,
+                   l.cobrado AS cobrado_resumen, r.cobrado AS cobrado_real, l.saldo AS saldo_resumen, r.saldo AS saldo_real,
+                   l.costo_lab AS costo_lab_resumen, r.costo_lab AS costo_lab_real
+            FROM llaves k LEFT JOIN resumen_financiero l USING (fecha_iso, doctor, categoria, metodo_pago)
+                          LEFT JOIN real r USING (fecha_iso, doctor, categoria, metodo_pago)
+            WHERE abs(ifnull(l.cargos, 0) - ifnull(r.cargos, 0)) > 0.005 OR abs(ifnull(l.cobrado, 0) - ifnull(r.cobrado, 0)) > 0.005
+               OR abs(ifnull(l.saldo, 0) - ifnull(r.saldo, 0)) > 0.005 OR abs(ifnull(l.costo_lab, 0) - ifnull(r.costo_lab, 0)) > 0.005""", conn)
+    finally: conn.close()
+
+def reconstruir_resumen_financiero():
+    """Recalcula todo el resumen desde citas (después de cargas masivas o si la verificación encuentra diferencias)"""
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM resumen_financiero")
+        conn.execute(f"INSERT INTO resumen_financiero (fecha_iso, doctor, categoria, metodo_pago, cargos, cobrado, saldo, costo_lab, movimientos) {SQL_RESUMEN_DESDE_CITAS}")
+
+def obtener_resumen_financiero(desde_iso, hasta_iso, periodo="Día", desglose=None):
+    """Totales por periodo (y por doctor/categoría/método si se pide) en el rango. SQLite suma primero por día
+    recorriendo la llave primaria y luego por periodo: a pandas solo llegan unos cientos de filas."""
+    expr = PERIODOS_TABLERO[periodo]; col = f", {DESGLOSES_TABLERO[desglose]}" if desglose in DESGLOSES_TABLERO else ""
+    sumas = ", ".join(f"SUM({x}) AS {x}" for x in COLUMNAS_RESUMEN)
+    conn = get_db_connection()
+    try:
+        df = pd.read_sql(f"""SELECT {expr} AS periodo{col}, {sumas}
+                             FROM (SELECT fecha_iso{col}, {sumas} FROM resumen_financiero WHERE fecha_iso BETWEEN ? AND ? GROUP BY fecha_iso{col})
+                             GROUP BY 1{', 2' if col else ''} ORDER BY 1""", conn, params=(desde_iso, hasta_iso))
+    finally: conn.close()
+    df[COLUMNAS_RESUMEN[:-1]] = df[COLUMNAS_RESUMEN[:-1]].round(2)
+    df['margen'] = (df['cargos'] - df['costo_lab']).round(2)
+    df['periodo'] = pd.to_datetime(df['periodo'], format="%Y-%m-%d")
+    return df
 
 def calcular_rfc_10(nombre, paterno, materno, nacimiento):
     try:
@@ -457,37 +1526,322 @@ def calcular_rfc_10(nombre, paterno, materno, nacimiento):
     except: return ""
 
 # [V41.0] GESTOR DE ODONTOGRAMA
-def actualizar_diente(id_paciente, diente):
+# Ciclo de estados: Sano -> Caries -> Resina -> Ausente -> Corona -> Sano
+ESTADOS_DIENTE = ["Sano", "Caries", "Resina", "Ausente", "Corona"]
+
+def siguiente_estado_diente(estado):
+    return ESTADOS_DIENTE[(ESTADOS_DIENTE.index(estado) + 1) % len(ESTADOS_DIENTE)]
+
+def guardar_odontograma(id_paciente, cambios, usuario="CONSULTORIO"):
+    """Confirma una sesión de captura {diente: estado}: UPSERT del estado vigente y un evento por diente
+    en el historial, todo en una transacción. Regresa cuántos dientes cambiaron."""
+    if not cambios: return 0
+    ahora = datetime.now(TZ_MX); fecha = ahora.strftime("%d/%m/%Y"); fecha_evento = ahora.strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaction() as conn:
+        conn.executemany("""INSERT INTO odontograma (id_paciente, diente, estado, fecha_actualizacion) VALUES (?,?,?,?)
+                            ON CONFLICT(id_paciente, diente) DO UPDATE SET estado = excluded.estado, fecha_actualizacion = excluded.fecha_actualizacion""",
+                         [(id_paciente, str(d), e, fecha) for d, e in cambios.items()])
+        conn.executemany("INSERT INTO odontograma_historial (id_paciente, diente, estado, fecha_evento, usuario) VALUES (?,?,?,?,?)",
+                         [(id_paciente, str(d), e, fecha_evento, usuario) for d, e in cambios.items()])
+    return len(cambios)
+
+def obtener_estado_dientes(id_paciente, hasta_iso=None):
+    """{diente: estado} vigente, o al cierre del día hasta_iso (YYYY-MM-DD) según el historial"""
     conn = get_db_connection()
-    c = conn.cursor()
-    # Ciclo de estados: Sano -> Caries -> Resina -> Ausente -> Corona -> Sano
-    estados = ["Sano", "Caries", "Resina", "Ausente", "Corona"]
-    # Obtener estado actual
-    c.execute("SELECT estado FROM odontograma WHERE id_paciente=? AND diente=?", (id_paciente, diente))
-    row = c.fetchone()
-    estado_actual = row[0] if row else "Sano"
-    
-    idx = estados.index(estado_actual)
-    nuevo_estado = estados[(idx + 1) % len(estados)]
-    
-    c.execute("INSERT OR REPLACE INTO odontograma (id_paciente, diente, estado, fecha_actualizacion) VALUES (?,?,?,?)", (id_paciente, diente, nuevo_estado, get_fecha_mx()))
-    conn.commit()
-    conn.close()
+    try:
+        if hasta_iso is None: filas = conn.execute("SELECT diente, estado FROM odontograma WHERE id_paciente=?", (id_paciente,)).fetchall()
+        # MAX(id_evento) por diente: SQLite regresa el estado de esa misma fila (último evento hasta la fecha)
+        else: filas = [f[:2] for f in conn.execute("""SELECT diente, estado, MAX(id_evento) FROM odontograma_historial
+                                                      WHERE id_paciente = ? AND fecha_evento < date(?, '+1 day') GROUP BY diente""", (id_paciente, hasta_iso))]
+    finally: conn.close()
+    return dict(filas)
+
+ARCHIVOS_POR_PAGINA = 24
+
+def guardar_archivo_paciente(id_paciente, nombre, datos, tipo):
+    """Alta de un archivo subido. Regresa (id_archivo, nuevo); nuevo=False si el paciente ya tenía ese contenido."""
+    with db_transaction() as conn: return registrar_archivo(conn.cursor(), id_paciente, nombre, datos, tipo)
 
-def obtener_estado_dientes(id_paciente):
+def listar_archivos_paciente(id_paciente, antes_de=None, limite=ARCHIVOS_POR_PAGINA):
+    """Página de la galería, lo más reciente primero. Regresa (df, hay_mas, cursor) como el resto de historiales."""
+    condicion, params = "id_paciente = ?", [id_paciente]
+    if antes_de: condicion += " AND (fecha_subida, id_archivo) < (?, ?)"; params += list(antes_de)
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT diente, estado FROM odontograma WHERE id_paciente=?", (id_paciente,))
-    data = dict(c.fetchall())
-    conn.close()
-    return data
+    try: df = pd.read_sql(f"SELECT id_archivo, nombre, tipo, extension, fecha_subida, bytes, sha256, ancho, alto, miniatura FROM archivos_paciente WHERE {condicion} ORDER BY fecha_subida DESC, id_archivo DESC LIMIT ?", conn, params=params + [limite + 1])
+    finally: conn.close()
+    hay_mas = len(df) > limite; df = df.head(limite)
+    cursor = (df['fecha_subida'].iloc[-1], int(df['id_archivo'].iloc[-1])) if hay_mas else None
+    return df, hay_mas, cursor
+
+def leer_archivo(sha, ext):
+    """Bytes del original (solo cuando se pide verlo o descargarlo)"""
+    with open(ruta_objeto(sha, ext), "rb") as f: return f.read()
+
+# PERIODONTOGRAMA Y SUPERFICIES: UN BLOB DE FORMATO FIJO POR EXAMEN
+# 32 piezas permanentes x 6 sitios. Cada examen pesa lo mismo (472 bytes) y se decodifica con np.frombuffer;
+# varios exámenes se leen de una vez como un arreglo (n, 32, 6) para compararlos.
+DIENTES_PERMANENTES = [18,17,16,15,14,13,12,11,21,22,23,24,25,26,27,28,48,47,46,45,44,43,42,41,31,32,33,34,35,36,37,38]
+SITIOS_PERIO = ["MV", "V", "DV", "ML", "L", "DL"]  # 3 vestibulares y 3 linguales/palatinos
+SUPERFICIES = "MODVL"  # Bit i de 'superficies' = superficie restaurada
+FORMATOS_EXAMEN = {
+    1: np.dtype([("estado", "u1", (32,)),          # Índice en ESTADOS_DIENTE al momento del examen
+                 ("superficies", "u1", (32,)),     # Máscara de bits MODVL
+                 ("profundidad", "u1", (32, 6)),   # Bolsa en mm
+                 ("recesion", "i1", (32, 6)),      # mm; negativo = margen coronal a la unión amelocementaria
+                 ("sangrado", "u1", (24,))]),      # 192 sitios en bits (np.packbits)
+}
+FORMATO_EXAMEN_ACTUAL = 1
+
+def codificar_examen(estado, superficies, profundidad, recesion, sangrado):
+    """Arreglos (32,) y (32, 6) -> bytes del formato actual"""
+    reg = np.zeros((), FORMATOS_EXAMEN[FORMATO_EXAMEN_ACTUAL])
+    reg["estado"] = estado; reg["superficies"] = superficies
+    reg["profundidad"] = np.clip(profundidad, 0, 255); reg["recesion"] = np.clip(recesion, -128, 127)
+    reg["sangrado"] = np.packbits(np.asarray(sangrado, dtype=bool).ravel())
+    return reg.tobytes()
+
+def decodificar_examenes(blobs, formato=FORMATO_EXAMEN_ACTUAL):
+    """Lista de BLOB (mismo formato) -> dict de arreglos con un eje de exámenes al frente"""
+    arr = np.frombuffer(b"".join(blobs), FORMATOS_EXAMEN[formato])
+    n = len(arr)
+    return {"estado": arr["estado"], "superficies": arr["superficies"], "profundidad": arr["profundidad"],
+            "recesion": arr["recesion"].astype(np.int16),
+            "sangrado": np.unpackbits(arr["sangrado"], axis=1)[:, :32 * 6].reshape(n, 32, 6).astype(bool)}
+
+def guardar_examen_periodontal(id_paciente, doctor, superficies, profundidad, recesion, sangrado):
+    """Nuevo examen; el estado de cada pieza se toma del odontograma vigente"""
+    estados = obtener_estado_dientes(id_paciente)
+    estado = [ESTADOS_DIENTE.index(estados.get(str(d), "Sano")) for d in DIENTES_PERMANENTES]
+    datos = codificar_examen(estado, superficies, profundidad, recesion, sangrado)
+    with db_transaction() as conn:
+        conn.execute("INSERT INTO examenes_periodontales (id_paciente, fecha_examen, doctor, formato, datos) VALUES (?,?,?,?,?)",
+                     (id_paciente, datetime.now(TZ_MX).strftime("%Y-%m-%d %H:%M:%S"), doctor, FORMATO_EXAMEN_ACTUAL, datos))
+
+def obtener_examenes_periodontales(id_paciente):
+    """(df con id_examen, fecha_examen y doctor en orden cronológico, arreglos decodificados o None)"""
+    conn = get_db_connection()
+    try: filas = conn.execute("SELECT id_examen, fecha_examen, doctor, formato, datos FROM examenes_periodontales WHERE id_paciente = ? ORDER BY fecha_examen, id_examen", (id_paciente,)).fetchall()
+    finally: conn.close()
+    meta = pd.DataFrame([tuple(f[:3]) for f in filas], columns=["id_examen", "fecha_examen", "doctor"])
+    if not filas: return meta, None
+    formatos = {f[3] for f in filas}
+    if len(formatos) > 1: raise ValueError(f"Exámenes con formatos mezclados: {sorted(formatos)}")
+    return meta, decodificar_examenes([f[4] for f in filas], formatos.pop())
+
+def resumen_periodontal(ex):
+    """Una fila por examen: % de sitios con sangrado, bolsas >= 4 y >= 6 mm, promedios (sin piezas ausentes)"""
+    presentes = np.broadcast_to((ex["estado"] != ESTADOS_DIENTE.index("Ausente"))[:, :, None], ex["profundidad"].shape)
+    sitios = presentes.sum(axis=(1, 2)).clip(min=1)
+    prof = np.where(presentes, ex["profundidad"], 0); nic = np.where(presentes, ex["profundidad"] + ex["recesion"], 0)
+    return pd.DataFrame({"Sangrado %": (100 * (ex["sangrado"] & presentes).sum(axis=(1, 2)) / sitios).round(1),
+                         "Sitios ≥4 mm": (prof >= 4).sum(axis=(1, 2)), "Sitios ≥6 mm": (prof >= 6).sum(axis=(1, 2)),
+                         "Prof. media": (prof.sum(axis=(1, 2)) / sitios).round(2), "NIC media": (nic.sum(axis=(1, 2)) / sitios).round(2)})
+
+def comparar_examenes(ex, antes, despues, umbral=2):
+    """Sitios cuya bolsa aumentó al menos 'umbral' mm entre dos exámenes (índices en el arreglo)"""
+    delta = ex["profundidad"][despues].astype(np.int16) - ex["profundidad"][antes]
+    dientes, sitios = np.nonzero(delta >= umbral)
+    return pd.DataFrame({"Diente": np.array(DIENTES_PERMANENTES)[dientes], "Sitio": np.array(SITIOS_PERIO)[sitios],
+                         "Antes": ex["profundidad"][antes][dientes, sitios], "Después": ex["profundidad"][despues][dientes, sitios],
+                         "Δ mm": delta[dientes, sitios]})
+
+# FILTRADO ESTRICTO DE EJECUCIÓN (MOTOR V47.6) - Resuelto en SQL con fecha_iso
+PALABRAS_ADMINISTRATIVAS = ['ABONO', 'PAGO', 'MENSUALIDAD', 'ANTICIPO', 'DEUDA', 'SALDO', 'COTIZACION', 'PRESUPUESTO']
+
+def obtener_historia_clinica(id_paciente, hasta_iso=None):
+    """Notas de evolución para la Historia Clínica: solo tratamientos realizados (Asistió), sin movimientos financieros ni citas futuras"""
+    filtro_txt = " AND ".join(["IFNULL(tratamiento, '') NOT LIKE ?"] * len(PALABRAS_ADMINISTRATIVAS))
+    query = f"""
+        SELECT fecha, tratamiento, notas
+        FROM citas
+        WHERE id_paciente = ?
+          AND fecha_iso <= ?
+          AND estatus_asistencia = 'Asistió'
+          AND IFNULL(categoria, '') != 'Financiero'
+          AND {filtro_txt}
+        ORDER BY timestamp ASC
+    """
+    params = [id_paciente, hasta_iso or get_fecha_iso_mx()] + [f"%{p}%" for p in PALABRAS_ADMINISTRATIVAS]
+    conn = get_db_connection()
+    try: df = pd.read_sql(query, conn, params=params)
+    finally: conn.close()
+    # Relleno de notas vacías
+    df['notas'] = df['notas'].fillna("Procedimiento realizado sin incidencias.")
+    df.loc[df['notas'] == "", 'notas'] = "Procedimiento realizado sin incidencias."
+    return df
+
+# HISTORIAL POR PACIENTE (PAGINACIÓN POR LLAVE)
+# Recorren idx_citas_paciente_ts de lo más reciente hacia atrás; el cursor es (timestamp, rowid) de la
+# última fila entregada, así la página 20 cuesta lo mismo que la primera.
+HISTORIAL_POR_PAGINA = 25
+FILTRO_MOVIMIENTOS = "estado_pago != 'CANCELADO' AND (precio_final > 0 OR monto_pagado > 0)"
+
+def _pagina_historial(columnas, condicion, params, antes_de, limite):
+    """Regresa (df, hay_mas, cursor para la siguiente página)"""
+    if antes_de: condicion += " AND (timestamp, rowid) < (?, ?)"; params = list(params) + list(antes_de)
+    conn = get_db_connection()
+    try: df = pd.read_sql(f"SELECT rowid, timestamp, {columnas} FROM citas WHERE {condicion} ORDER BY timestamp DESC, rowid DESC LIMIT ?", conn, params=list(params) + [limite + 1])
+    finally: conn.close()
+    hay_mas = len(df) > limite; df = df.head(limite)
+    cursor = (int(df['timestamp'].iloc[-1]), int(df['rowid'].iloc[-1])) if hay_mas else None
+    return df, hay_mas, cursor
+
+def obtener_notas_clinicas(id_paciente, hasta_iso=None, antes_de=None, limite=HISTORIAL_POR_PAGINA):
+    """Notas del expediente (sin citas futuras), de la más reciente a la más antigua"""
+    return _pagina_historial("fecha, tratamiento, notas", "id_paciente = ? AND fecha_iso <= ?", (id_paciente, hasta_iso or get_fecha_iso_mx()), antes_de, limite)
+
+def obtener_movimientos_financieros(id_paciente, antes_de=None, limite=HISTORIAL_POR_PAGINA):
+    """Cargos y abonos (no cancelados) del paciente, del más reciente al más antiguo"""
+    return _pagina_historial("fecha, tratamiento, doctor_atendio, precio_final, monto_pagado, saldo_pendiente, metodo_pago",
+                             f"id_paciente = ? AND {FILTRO_MOVIMIENTOS}", (id_paciente,), antes_de, limite)
+
+def movimientos_para_recibo(id_paciente, fecha_corte):
+    """Para el recibo: movimientos del día de corte y deudas abiertas de otros días (sin importar qué páginas se hayan cargado)"""
+    conn = get_db_connection()
+    try:
+        columnas = "rowid, fecha, tratamiento, doctor_atendio, precio_final, monto_pagado, saldo_pendiente, metodo_pago"
+        hoy = pd.read_sql(f"SELECT {columnas} FROM citas WHERE id_paciente = ? AND {FILTRO_MOVIMIENTOS} AND fecha = ? ORDER BY timestamp DESC", conn, params=(id_paciente, fecha_corte))
+        deuda = pd.read_sql(f"SELECT {columnas} FROM citas WHERE id_paciente = ? AND {FILTRO_MOVIMIENTOS} AND saldo_pendiente > 0 AND fecha != ? ORDER BY timestamp DESC", conn, params=(id_paciente, fecha_corte))
+    finally: conn.close()
+    return hoy.to_dict('records'), deuda.to_dict('records')
+
+# ==========================================
+# AUDITORÍA (COLA ACOTADA + ESCRITOR EN LOTES)
+# ==========================================
+# Los eventos normales (login, PIN) se encolan y un hilo los inserta en lotes, una transacción por lote.
+# Los que acompañan a un movimiento de dinero se insertan en la transacción del llamador (parámetro conn).
+AUDITORIA_COLA_MAX = 10000
+AUDITORIA_LOTE = 500
+AUDITORIA_REINTENTOS = 3
+SQL_INSERT_AUDITORIA = "INSERT INTO auditoria (fecha_evento, usuario, accion, detalle, hash_previo, hash) VALUES (?,?,?,?,?,?)"
+AUDITORIA_POR_PAGINA = 50
+
+def insertar_eventos_auditoria(conn, eventos):
+    """Encadena e inserta eventos. El candado de escritura se toma antes de leer el último hash,
+    así dos escritores nunca encadenan sobre el mismo evento."""
+    if not conn.in_transaction: conn.execute("BEGIN IMMEDIATE")
+    filas, _ = encadenar_eventos(ultimo_hash_auditoria(conn), eventos)
+    conn.executemany(SQL_INSERT_AUDITORIA, filas)
+
+class EscritorAuditoria:
+    """Hilo único que vacía la cola de auditoría. Cuenta eventos escritos, descartados (cola llena) y fallidos."""
+    def __init__(self, max_cola=AUDITORIA_COLA_MAX):
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._lock = threading.Lock()
+        self.escritos = 0; self.descartados = 0; self.fallidos = 0; self.ultimo_error = None
+        self._hilo = threading.Thread(target=self._bucle, daemon=True, name="auditoria")
+        self._hilo.start()
+
+    def encolar(self, evento):
+        try:
+            self._cola.put_nowait(evento); return True
+        except queue.Full:
+            with self._lock: self.descartados += 1; descartados = self.descartados
+            if descartados == 1 or descartados % 100 == 0: print(f"⚠️ Auditoría: cola llena, {descartados} eventos descartados")
+            return False
 
-def registrar_auditoria(usuario, accion, detalle):
+    def _escribir(self, lote):
+        for intento in range(AUDITORIA_REINTENTOS):
+            try:
+                with db_transaction() as conn: insertar_eventos_auditoria(conn, lote)
+                with self._lock: self.escritos += len(lote)
+                return
+            except Exception as e:
+                error = e; time.sleep(0.2 * (intento + 1))  # Típicamente 'database is locked': se reintenta
+        with self._lock: self.fallidos += len(lote); self.ultimo_error = str(error)
+        print(f"❌ Auditoría: {len(lote)} eventos no se pudieron escribir: {error}")
+
+    def _bucle(self):
+        while True:
+            evento = self._cola.get()
+            lote = [] if evento is None else [evento]
+            # Todo lo que ya esté esperando entra en la misma transacción
+            while len(lote) < AUDITORIA_LOTE:
+                try: siguiente = self._cola.get_nowait()
+                except queue.Empty: break
+                if siguiente is None: evento = None; break
+                lote.append(siguiente)
+            if lote: self._escribir(lote)
+            if evento is None: return
+
+    def cerrar(self, timeout=10):
+        """Al apagar el proceso: escribe lo pendiente y detiene el hilo"""
+        if not self._hilo.is_alive(): return
+        try: self._cola.put(None, timeout=timeout)
+        except queue.Full: pass
+        self._hilo.join(timeout)
+
+    def estado(self):
+        with self._lock:
+            return {"en_cola": self._cola.qsize(), "escritos": self.escritos, "descartados": self.descartados,
+                    "fallidos": self.fallidos, "ultimo_error": self.ultimo_error, "activo": self._hilo.is_alive()}
+
+@st.cache_resource
+def get_escritor_auditoria():
+    """Un escritor por proceso; se vacía al terminar el intérprete"""
+    escritor = EscritorAuditoria()
+    atexit.register(escritor.cerrar)
+    return escritor
+
+def registrar_auditoria(usuario, accion, detalle, conn=None):
+    """Registra un evento. Sin conn se encola (no bloquea la pantalla). Con conn (la de un db_transaction)
+    se inserta en esa transacción: se confirma o se revierte junto con el cambio financiero."""
+    evento = (datetime.now(TZ_MX).strftime("%Y-%m-%d %H:%M:%S"), usuario, accion, formato_nombre_legal(detalle))
+    if conn is not None:
+        insertar_eventos_auditoria(conn, [evento]); return True
+    return get_escritor_auditoria().encolar(evento)
+
+def verificar_cadena_auditoria():
+    """Recorre la bitácora completa en orden (cursor, sin DataFrame) y recalcula la cadena.
+    Regresa (eventos revisados, id del primer evento alterado o None)."""
+    conn = get_db_connection()
     try:
-        conn = get_db_connection(); c = conn.cursor()
-        c.execute("INSERT INTO auditoria (fecha_evento, usuario, accion, detalle) VALUES (?,?,?,?)", (datetime.now(TZ_MX).strftime("%Y-%m-%d %H:%M:%S"), usuario, accion, formato_nombre_legal(detalle)))
-        conn.commit(); conn.close()
-    except: pass
+        previo, revisados = AUDITORIA_GENESIS, 0
+        for id_evento, fecha, usuario, accion, detalle, hash_previo, hash_guardado in conn.execute(
+                "SELECT id_evento, fecha_evento, usuario, accion, detalle, hash_previo, hash FROM auditoria ORDER BY id_evento"):
+            if hash_previo != previo or hash_evento_auditoria(previo, fecha, usuario, accion, detalle) != hash_guardado:
+                return revisados, id_evento
+            previo = hash_guardado; revisados += 1
+        return revisados, None
+    finally:
+        conn.close()
+
+def tarea_verificar_auditoria():
+    revisados, roto = verificar_cadena_auditoria()
+    if roto is not None: raise RuntimeError(f"Cadena de auditoría rota en el evento {roto}")
+    return f"{revisados} eventos íntegros"
+
+@st.cache_data(ttl=300, show_spinner=False)
+def valores_auditoria(columna):
+    """Valores distintos de usuario/accion saltando por el índice (no recorre los millones de filas)"""
+    if columna not in ("usuario", "accion"): raise ValueError(columna)
+    conn = get_db_connection()
+    try:
+        return [r[0] for r in conn.execute(f"""WITH RECURSIVE v(x) AS (
+            SELECT MIN({columna}) FROM auditoria
+            UNION ALL SELECT (SELECT MIN({columna}) FROM auditoria WHERE {columna} > x) FROM v WHERE x IS NOT NULL)
+            SELECT x FROM v WHERE x IS NOT NULL""")]
+    finally:
+        conn.close()
+
+def consultar_auditoria(usuario=None, accion=None, desde=None, hasta=None, antes_de=None, limite=AUDITORIA_POR_PAGINA):
+    """Una página de eventos, del más reciente al más antiguo. Paginación por llave: antes_de es el
+    (fecha_evento, id_evento) del último evento de la página anterior, así cada página cuesta lo mismo
+    sin importar qué tan atrás esté. Regresa (DataFrame, hay_mas)."""
+    condiciones, params = [], []
+    if usuario: condiciones.append("usuario = ?"); params.append(usuario)
+    if accion: condiciones.append("accion = ?"); params.append(accion)
+    if desde: condiciones.append("fecha_evento >= ?"); params.append(f"{desde} 00:00:00")
+    if hasta: condiciones.append("fecha_evento <= ?"); params.append(f"{hasta} 23:59:59")
+    if antes_de: condiciones.append("(fecha_evento, id_evento) < (?, ?)"); params.extend(antes_de)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    conn = get_db_connection()
+    try:
+        df = pd.read_sql(f"SELECT id_evento, fecha_evento, usuario, accion, detalle, substr(hash, 1, 12) AS hash FROM auditoria {where} ORDER BY fecha_evento DESC, id_evento DESC LIMIT ?",
+                         conn, params=params + [limite + 1])
+    finally:
+        conn.close()
+    return df.head(limite), len(df) > limite
 
 def registrar_movimiento(doctor, tipo):
     conn = get_db_connection(); c = conn.cursor(); hoy = get_fecha_mx(); hora_actual = get_hora_mx()
@@ -531,14 +1885,99 @@ def validar_abono(monto, saldo):
 # ==========================================
 # 4. GENERADOR DE PDF PROFESIONALES (LEGAL SUITE)
 # ==========================================
+# ==========================================
+# MOTOR PDF: RECURSOS COMPARTIDOS POR PROCESO
+# ==========================================
+PDF_DPI_IMAGENES = 300  # Resolución de impresión: el logo original (1411 px para 30 mm, ~1200 dpi) se reduce una sola vez
+FIRMA_ANCHO_MM, FIRMA_ALTO_MM = 45, 30  # Recuadro de cada firma en el consentimiento
+FIRMA_MARGEN_PX = 4  # Aire que se deja alrededor del trazo al recortar el lienzo vacío
+
+# Bloques legales fijos: se arman y normalizan a latin-1 una vez al importar, no en cada documento
+TXT_SENALES_ALERTA = "Contacte al consultorio si presenta: Sangrado que no cede tras 40 min de presion, Fiebre >38 C, Dificultad para respirar/tragar, o Reaccion alergica (ronchas/hinchazon)."
+TXT_DESLINDE_RECETA = "El exito del tratamiento depende del seguimiento profesional. El consultorio NO se hace responsable por complicaciones, infecciones o fracasos derivados de negligencia en estos cuidados, automedicacion o la INASISTENCIA a las citas de control programadas. La falta de seguimiento exime al clinico de garantias."
+TXT_PIE_RECIBO = "Este documento es un comprobante interno. Si requiere factura fiscal (CFDI), favor de solicitarla dentro del mes en curso."
+TXT_AVISO_PRIVACIDAD = f"""En cumplimiento estricto con lo dispuesto por la Ley Federal de Protección de Datos Personales en Posesión de los Particulares (la "Ley"), su Reglamento y los Lineamientos del Aviso de Privacidad, se emite el presente documento:
+
+IDENTIDAD Y DOMICILIO DEL RESPONSABLE
+La clínica dental denominada comercialmente ROYAL DENTAL (en adelante "El Responsable"), con domicilio en {DIRECCION_CONSULTORIO}, es la entidad responsable del uso, manejo, almacenamiento y confidencialidad de sus datos personales.
+
+{TXT_DATOS_SENSIBLES}
+
+FINALIDADES DEL TRATAMIENTO
+A) Prestación de servicios odontológicos. B) Creación y conservación del expediente clínico. C) Facturación y cobranza. D) Contacto para seguimiento.
+Finalidades Secundarias: Envío de promociones y encuestas de calidad.
+
+TRANSFERENCIA DE DATOS
+Sus datos pueden ser compartidos con: Laboratorios dentales y gabinetes radiológicos (para prótesis/estudios), Especialistas interconsultantes, Compañías Aseguradoras y Autoridades sanitarias.
+
+DERECHOS ARCO
+Usted tiene derecho a Acceder, Rectificar, Cancelar u Oponerse al tratamiento de sus datos presentando solicitud en recepción.
+
+{TXT_CONSENTIMIENTO_EXPRESO}""".encode('latin-1', 'replace').decode('latin-1')
+
+class RecursosPDF:
+    """Imágenes ya decodificadas, reducidas y comprimidas (formato interno de fpdf2), una vez por proceso.
+    Cada documento solo copia la referencia: header() ya no abre ni comprime logo.png en cada PDF.
+    Si la versión de fpdf2 no expone ese formato, se guarda la imagen ya reducida y se inserta por la vía normal."""
+    def __init__(self):
+        self._imagenes = {}
+        self._lock = threading.Lock()
+
+    def imagen(self, ruta, ancho_mm):
+        """Regresa (clave, info) de la imagen al ancho impreso; info es None si el archivo no existe
+        y una imagen PIL si fpdf2 no permite precomprimirla"""
+        clave = f"{ruta}@{ancho_mm}mm"
+        with self._lock:
+            if clave not in self._imagenes:
+                info = None
+                if os.path.exists(ruta):
+                    img = Image.open(ruta); img.load(); img.info.pop("icc_profile", None)
+                    ancho_px = round(ancho_mm / 25.4 * PDF_DPI_IMAGENES)
+                    if img.width > ancho_px: img = img.resize((ancho_px, max(1, round(img.height * ancho_px / img.width))), Image.LANCZOS)
+                    try: info = get_img_info(clave, img)
+                    except Exception: info = img
+                self._imagenes[clave] = info
+            return clave, self._imagenes[clave]
+
+@st.cache_resource
+def get_recursos_pdf():
+    return RecursosPDF()
+
 class PDFGenerator(FPDF):
     def __init__(self): 
         super().__init__() 
         self.set_auto_page_break(auto=True, margin=15) # 
+        self.recursos = get_recursos_pdf()
+
+    def set_font(self, family=None, style='', size=0):
+        # 'Arial' es la fuente base helvetica (mismas métricas): se resuelve aquí y no por la sustitución obsoleta de fpdf2
+        if family and family.lower() == 'arial': family = 'helvetica'
+        super().set_font(family, style, size)
+
+    def imagen_cacheada(self, ruta, x, y, w):
+        """Coloca una imagen del caché del proceso (sin decodificar ni comprimir otra vez)"""
+        clave, info = self.recursos.imagen(ruta, w)
+        if info is None: return
+        if isinstance(info, Image.Image): self.image(info, x, y, w); return
+        try:
+            if clave not in self.image_cache.images:
+                copia = type(info)(info); copia.update(i=len(self.image_cache.images) + 1, usages=0, iccp_i=None)
+                self.image_cache.images[clave] = copia
+            self.image(clave, x, y, w)
+        except Exception:
+            # Internos de fpdf2 distintos a los probados (2.8): se quita la entrada y se usa la vía pública
+            self.image_cache.images.pop(clave, None)
+            self.image(ruta, x, y, w)
+
+    def firma(self, img, x, y):
+        """Coloca una firma (imagen en memoria) dentro del recuadro, sin deformarla"""
+        if not isinstance(img, Image.Image): img = procesar_firma_digital(img)
+        if img is None: return
+        self.image(img, x=x, y=y, w=FIRMA_ANCHO_MM, h=FIRMA_ALTO_MM, keep_aspect_ratio=True)
+
     def header(self):
-        if os.path.exists(LOGO_FILE):
-            try: self.image(LOGO_FILE, 10, 8, 30)
-            except: pass
+        try: self.imagen_cacheada(LOGO_FILE, 10, 8, 30)
+        except: pass
         
         self.set_font('Arial', 'B', 14); self.set_text_color(0, 43, 91)
         self.cell(0, 10, 'ROYAL DENTAL', 0, 1, 'C'); self.ln(1)
@@ -557,13 +1996,21 @@ class PDFGenerator(FPDF):
     def chapter_body(self, body, style=''):
         self.set_font('Arial', style, 10); self.set_text_color(0, 0, 0); self.multi_cell(0, 5, body); self.ln(2)
 
-def procesar_firma_digital(firma_img_data):
+def procesar_firma_digital(firma):
+    """Lienzo RGBA (o PNG base64 heredado) -> imagen en memoria recortada al trazo y reducida a resolución
+    de impresión. Regresa None si el lienzo está vacío. Sin archivos temporales."""
     try:
-        img_data = re.sub('^data:image/.+;base64,', '', firma_img_data)
-        img = Image.open(io.BytesIO(base64.b64decode(img_data)))
-        temp_filename = f"temp_sig_{int(time.time())}_{random.randint(1,1000)}.png"
-        img.save(temp_filename)
-        return temp_filename
+        if isinstance(firma, str):
+            firma = Image.open(io.BytesIO(base64.b64decode(re.sub('^data:image/.+;base64,', '', firma))))
+        arr = np.asarray(firma.convert('RGBA') if isinstance(firma, Image.Image) else firma).astype(np.uint8)
+        filas = np.flatnonzero(arr[:, :, 3].any(axis=1)); cols = np.flatnonzero(arr[:, :, 3].any(axis=0))
+        if filas.size == 0: return None
+        m = FIRMA_MARGEN_PX
+        arr = arr[max(0, filas[0] - m):filas[-1] + m + 1, max(0, cols[0] - m):cols[-1] + m + 1]
+        img = Image.fromarray(np.ascontiguousarray(arr), 'RGBA')
+        max_px = (round(FIRMA_ANCHO_MM / 25.4 * PDF_DPI_IMAGENES), round(FIRMA_ALTO_MM / 25.4 * PDF_DPI_IMAGENES))
+        img.thumbnail(max_px, Image.LANCZOS)
+        return img
     except: return None
 
 # [V42.0] PDF RECETA FIX (SIN EMOJIS)
@@ -625,14 +2072,14 @@ def crear_pdf_receta(datos):
     pdf.set_fill_color(255, 235, 238); pdf.set_text_color(200, 0, 0); pdf.set_font('Arial', 'B', 11)
     pdf.cell(0, 8, "SEÑALES DE ALERTA", 1, 1, 'L', 1)
     pdf.set_font('Arial', '', 10); pdf.set_text_color(0, 0, 0)
-    pdf.multi_cell(0, 6, "Contacte al consultorio si presenta: Sangrado que no cede tras 40 min de presion, Fiebre >38 C, Dificultad para respirar/tragar, o Reaccion alergica (ronchas/hinchazon).")
+    pdf.multi_cell(0, 6, TXT_SENALES_ALERTA)
     pdf.ln(5)
     
     # DESLINDE LEGAL
     pdf.set_fill_color(240, 240, 240); pdf.set_text_color(0, 0, 0); pdf.set_font('Arial', 'B', 9)
     pdf.cell(0, 8, "DESLINDE DE RESPONSABILIDAD Y SEGUIMIENTO", 1, 1, 'L', 1)
     pdf.set_font('Arial', 'I', 8)
-    pdf.multi_cell(0, 5, "El exito del tratamiento depende del seguimiento profesional. El consultorio NO se hace responsable por complicaciones, infecciones o fracasos derivados de negligencia en estos cuidados, automedicacion o la INASISTENCIA a las citas de control programadas. La falta de seguimiento exime al clinico de garantias.")
+    pdf.multi_cell(0, 5, TXT_DESLINDE_RECETA)
 
     val = pdf.output(dest='S'); return val.encode('latin-1', 'replace') if isinstance(val, str) else bytes(val)
 
@@ -705,7 +2152,7 @@ def crear_recibo_pago(datos_recibo):
     
     pdf.ln(10)
     pdf.set_y(-30); pdf.set_font('Arial', 'I', 7)
-    pdf.multi_cell(0, 4, "Este documento es un comprobante interno. Si requiere factura fiscal (CFDI), favor de solicitarla dentro del mes en curso.", 0, 'C')
+    pdf.multi_cell(0, 4, TXT_PIE_RECIBO, 0, 'C')
     val = pdf.output(dest='S'); return val.encode('latin-1', 'replace') if isinstance(val, str) else bytes(val)
 
 def crear_pdf_consentimiento(paciente_full, nombre_doctor, cedula_doctor, tipo_doc, tratamientos_str, riesgos_str, firma_pac, firma_doc, testigos_data, nivel_riesgo, edad_paciente, tutor_info):
@@ -716,26 +2163,7 @@ def crear_pdf_consentimiento(paciente_full, nombre_doctor, cedula_doctor, tipo_d
     
     if "Aviso" in tipo_doc:
         pdf.set_font('Arial', 'B', 12); pdf.cell(0, 10, "AVISO DE PRIVACIDAD INTEGRAL PARA PACIENTES", 0, 1, 'C'); pdf.ln(5)
-        texto = f"""En cumplimiento estricto con lo dispuesto por la Ley Federal de Protección de Datos Personales en Posesión de los Particulares (la "Ley"), su Reglamento y los Lineamientos del Aviso de Privacidad, se emite el presente documento:
-
-IDENTIDAD Y DOMICILIO DEL RESPONSABLE
-La clínica dental denominada comercialmente ROYAL DENTAL (en adelante "El Responsable"), con domicilio en {DIRECCION_CONSULTORIO}, es la entidad responsable del uso, manejo, almacenamiento y confidencialidad de sus datos personales.
-
-{TXT_DATOS_SENSIBLES}
-
-FINALIDADES DEL TRATAMIENTO
-A) Prestación de servicios odontológicos. B) Creación y conservación del expediente clínico. C) Facturación y cobranza. D) Contacto para seguimiento.
-Finalidades Secundarias: Envío de promociones y encuestas de calidad.
-
-TRANSFERENCIA DE DATOS
-Sus datos pueden ser compartidos con: Laboratorios dentales y gabinetes radiológicos (para prótesis/estudios), Especialistas interconsultantes, Compañías Aseguradoras y Autoridades sanitarias.
-
-DERECHOS ARCO
-Usted tiene derecho a Acceder, Rectificar, Cancelar u Oponerse al tratamiento de sus datos presentando solicitud en recepción.
-
-{TXT_CONSENTIMIENTO_EXPRESO}"""
-        try: pdf.chapter_body(texto.encode('latin-1', 'replace').decode('latin-1'))
-        except: pdf.chapter_body(texto)
+        pdf.chapter_body(TXT_AVISO_PRIVACIDAD)
 
     else:
         pdf.set_font('Arial', 'B', 12); pdf.cell(0, 10, "CARTA DE CONSENTIMIENTO INFORMADO", 0, 1, 'C'); pdf.ln(5)
@@ -776,15 +2204,13 @@ AUTORIZACIÓN: Autorizo la anestesia local y procedimientos necesarios, asumiend
         pdf.text(20, y_firmas + 45, paciente_full) 
     
     if firma_pac:
-        f_path = procesar_firma_digital(firma_pac)
-        if f_path: pdf.image(f_path, x=20, y=y_firmas, w=45, h=30); os.remove(f_path)
+        pdf.firma(firma_pac, 20, y_firmas)
     else: pdf.line(20, y_firmas + 35, 70, y_firmas + 35)
 
     if "Aviso" not in tipo_doc:
         pdf.text(110, y_firmas + 40, f"FIRMA ODONTOLOGO TRATANTE")
         if firma_doc:
-            f_path_d = procesar_firma_digital(firma_doc)
-            if f_path_d: pdf.image(f_path_d, x=110, y=y_firmas, w=45, h=30); os.remove(f_path_d)
+            pdf.firma(firma_doc, 110, y_firmas)
         else: pdf.line(110, y_firmas + 35, 160, y_firmas + 35)
 
         if nivel_riesgo == "HIGH_RISK":
@@ -792,19 +2218,17 @@ AUTORIZACIÓN: Autorizo la anestesia local y procedimientos necesarios, asumiend
             y_testigos = pdf.get_y()
             pdf.text(20, y_testigos + 40, f"TESTIGO 1: {formato_nombre_legal(testigos_data.get('n1',''))}")
             if testigos_data.get('img_t1'):
-                 f_path_t1 = procesar_firma_digital(testigos_data['img_t1'])
-                 if f_path_t1: pdf.image(f_path_t1, x=20, y=y_testigos, w=45, h=30); os.remove(f_path_t1)
+                 pdf.firma(testigos_data['img_t1'], 20, y_testigos)
             else: pdf.line(20, y_testigos + 35, 70, y_testigos + 35)
 
             pdf.text(110, y_testigos + 40, f"TESTIGO 2: {formato_nombre_legal(testigos_data.get('n2',''))}")
             if testigos_data.get('img_t2'):
-                 f_path_t2 = procesar_firma_digital(testigos_data['img_t2'])
-                 if f_path_t2: pdf.image(f_path_t2, x=110, y=y_testigos, w=45, h=30); os.remove(f_path_t2)
+                 pdf.firma(testigos_data['img_t2'], 110, y_testigos)
             else: pdf.line(110, y_testigos + 35, 160, y_testigos + 35)
         
     val = pdf.output(dest='S'); return val.encode('latin-1', 'replace') if isinstance(val, str) else bytes(val)
 
-def crear_pdf_historia(p, historial):
+def crear_pdf_historia(p, historial, odontograma=None, fecha_corte=None):
     pdf = PDFGenerator(); pdf.add_page()
     nombre_p = formato_nombre_legal(f"{p['nombre']} {p['apellido_paterno']} {p.get('apellido_materno','')}")
     edad, _ = calcular_edad_completa(p.get('fecha_nacimiento', ''))
@@ -838,19 +2262,17 @@ def crear_pdf_historia(p, historial):
         
         pdf.set_font('Arial', '', 8)
         
-        for _, row in historial.iterrows():
-            txt_fecha = str(row['fecha'])
-            txt_trat = str(row['tratamiento'])[:45] 
-            txt_nota = str(row['notas']) if row['notas'] else ""
+        for row in historial[['fecha', 'tratamiento', 'notas']].itertuples(index=False):
+            txt_fecha = str(row.fecha)
+            txt_trat = str(row.tratamiento)[:45] 
+            txt_nota = str(row.notas) if row.notas else ""
             txt_nota = formato_oracion(txt_nota) 
             
             x_curr = pdf.get_x()
             y_curr = pdf.get_y()
             
-            pdf.set_xy(x_curr + 85, y_curr) 
-            pdf.multi_cell(105, 5, txt_nota, 0, 'L') 
-            y_end = pdf.get_y()
-            h_row = y_end - y_curr
+            # Alto de la fila sin imprimir la nota (antes se imprimía dos veces)
+            h_row = pdf.multi_cell(105, 5, txt_nota, 0, 'L', dry_run=True, output="HEIGHT")
             
             if h_row < 6: h_row = 6
             
@@ -878,9 +2300,160 @@ def crear_pdf_historia(p, historial):
             pdf.multi_cell(105, 5, txt_nota, 0, 'L') 
             
             pdf.set_xy(x_curr, y_curr + h_row)
+    
+    if odontograma is not None:
+        # Hallazgos por estado (las piezas sin registro se consideran sanas)
+        por_estado = {e: sorted((d for d, est in odontograma.items() if est == e), key=lambda d: int(d) if d.isdigit() else 0) for e in ESTADOS_DIENTE[1:]}
+        lineas = [f"{e.upper()}: {', '.join(ds)}" for e, ds in por_estado.items() if ds] or ["Sin hallazgos registrados."]
+        pdf.ln(5); pdf.set_font('Arial', 'B', 10)
+        pdf.cell(0, 6, f"V. ODONTOGRAMA (AL {fecha_corte or get_fecha_mx()})", 1, 1, 'L', True)
+        pdf.set_font('Arial', '', 9); pdf.multi_cell(0, 5, "\n".join(lineas), 1)
             
     val = pdf.output(dest='S'); return val.encode('latin-1') if isinstance(val, str) else bytes(val)
 
+# ==========================================
+# COLA DE DOCUMENTOS (PROCESOS EN PARALELO)
+# ==========================================
+# Los PDF se arman en un ProcessPoolExecutor: la sesión recibe un id de trabajo y consulta el avance
+# sin congelar la pantalla. Los lotes (recibos del día, historias) se reparten entre núcleos y salen en un ZIP.
+# Los procesos entran por documentos.py: el script de Streamlit corre como __main__ y ahí no se puede resolver.
+DOCUMENTOS_PROCESOS = max(1, min(4, (os.cpu_count() or 2) - 1))
+DOCUMENTOS_RETENER = 50      # Trabajos terminados que se conservan para descarga
+DOCUMENTOS_SONDEO_SEG = 1    # Cada cuánto la pantalla pregunta por un trabajo en curso
+
+def armar_datos_recibo(id_paciente, fecha_corte, rowid, saldo_total=None):
+    """Datos del recibo de un día de corte: movimientos de ese día, deudas de otros días y saldo global"""
+    p = obtener_paciente(id_paciente)
+    if p is None: raise ValueError(f"Paciente {id_paciente} no existe")
+    items_hoy, items_deuda = movimientos_para_recibo(id_paciente, fecha_corte)
+    if saldo_total is None: saldo_total = obtener_saldo_paciente(id_paciente)['saldo']
+    return {"paciente": f"{p['nombre']} {p['apellido_paterno']} {p['apellido_materno']}", "rfc": p.get('rfc', 'XAXX010101000'),
+            "folio": f"RD-{int(time.time())}-{rowid}", "fecha": fecha_corte, "items_hoy": items_hoy, "items_deuda": items_deuda,
+            "total_tratamiento_hoy": sum(x['precio_final'] for x in items_hoy), "total_pagado_hoy": sum(x['monto_pagado'] for x in items_hoy),
+            "saldo_total_global": saldo_total}
+
+def generar_documento(tipo, params):
+    """Arma un documento a partir de parámetros serializables (lo que viaja al proceso). Regresa (nombre_archivo, pdf)."""
+    if tipo == "historia":
+        p = obtener_paciente(params['id_paciente'])
+        if p is None: raise ValueError(f"Paciente {params['id_paciente']} no existe")
+        hasta = params.get('hasta')  # YYYY-MM-DD: notas y odontograma al cierre de ese día
+        fecha_corte = datetime.strptime(hasta, "%Y-%m-%d").strftime("%d/%m/%Y") if hasta else None
+        pdf = crear_pdf_historia(p, obtener_historia_clinica(params['id_paciente'], hasta), obtener_estado_dientes(params['id_paciente'], hasta), fecha_corte)
+        return f"{p['id_paciente']}_HISTORIAL_CLINICO{'_' + hasta if hasta else ''}.pdf", pdf
+    if tipo == "recibo":
+        datos = armar_datos_recibo(params['id_paciente'], params['fecha'], params['rowid'], params.get('saldo_total'))
+        return f"RECIBO_{datos['folio']}.pdf", crear_recibo_pago(datos)
+    if tipo == "receta":
+        return params.get('nombre_archivo', "RECETA.pdf"), crear_pdf_receta(params['datos'])
+    if tipo == "consentimiento":
+        return params.get('nombre_archivo', "CONSENTIMIENTO.pdf"), crear_pdf_consentimiento(**params['argumentos'])
+    raise ValueError(f"Tipo de documento desconocido: {tipo}")
+
+def empaquetar_zip(resultados, errores):
+    """Un ZIP con los PDF (ya comprimidos, se guardan tal cual) y, si hubo fallas, ERRORES.txt"""
+    buf = io.BytesIO(); usados = set()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for nombre, datos in resultados:
+            base, n = nombre, 1
+            while nombre in usados: n += 1; nombre = f"{base[:-4]}_{n}.pdf"
+            usados.add(nombre); zf.writestr(nombre, datos)
+        if errores: zf.writestr("ERRORES.txt", "\n".join(errores))
+    return buf.getvalue()
+
+class ColaDocumentos:
+    """Trabajos de documentos (uno o un lote) sobre un pool de procesos compartido por todas las sesiones"""
+    def __init__(self, procesos=DOCUMENTOS_PROCESOS):
+        self._procesos = procesos
+        self._pool = None
+        self._trabajos = {}
+        self._lock = threading.Lock()
+
+    def _ejecutor(self):
+        # spawn: un proceso limpio que importa app.py, no una copia del servidor con sus hilos y conexiones
+        if self._pool is None:
+            import documentos
+            self._pool = ProcessPoolExecutor(max_workers=self._procesos, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=documentos.inicializar)
+        return self._pool
+
+    def _enviar_futuros(self, documentos):
+        import documentos as trabajador
+        try: return [self._ejecutor().submit(trabajador.generar, tipo, params) for tipo, params in documentos]
+        except BrokenProcessPool:
+            # Un proceso murió (memoria, señal): se levanta un pool nuevo una vez
+            self._pool = None
+            return [self._ejecutor().submit(trabajador.generar, tipo, params) for tipo, params in documentos]
+
+    def enviar(self, tipo, params, descripcion):
+        """Un documento. Regresa el id del trabajo."""
+        return self.enviar_lote([(tipo, params)], descripcion, nombre_zip=None)
+
+    def enviar_lote(self, documentos, descripcion, nombre_zip):
+        """Varios documentos en paralelo; al terminar se entregan en un ZIP. Regresa el id del trabajo."""
+        id_trabajo = uuid.uuid4().hex[:12]
+        trabajo = {"id": id_trabajo, "descripcion": descripcion, "nombre_zip": nombre_zip, "total": len(documentos), "hechos": 0,
+                   "creado": time.time(), "terminado": None, "resultado": None, "error": None, "futuros": []}
+        with self._lock:
+            trabajo["futuros"] = self._enviar_futuros(documentos)
+            self._trabajos[id_trabajo] = trabajo
+            self._podar()
+        for f in trabajo["futuros"]: f.add_done_callback(lambda _f, t=trabajo: self._al_terminar(t))
+        return id_trabajo
+
+    def _al_terminar(self, trabajo):
+        with self._lock:
+            trabajo["hechos"] += 1
+            if trabajo["hechos"] < trabajo["total"]: return
+        resultados, errores = [], []
+        for f, n in zip(trabajo["futuros"], range(1, trabajo["total"] + 1)):
+            try: resultados.append(f.result())
+            except Exception as e: errores.append(f"Documento {n}: {e}")
+        if trabajo["nombre_zip"] is None:
+            resultado, error = (resultados[0], None) if resultados else (None, errores[0])
+        else:
+            resultado = (trabajo["nombre_zip"], empaquetar_zip(resultados, errores)) if resultados else None
+            error = f"{len(errores)} de {trabajo['total']} documentos fallaron" if errores else None
+        with self._lock: trabajo.update(resultado=resultado, error=error, terminado=time.time(), futuros=[])
+
+    def _podar(self):
+        terminados = [t for t in self._trabajos.values() if t["terminado"]]
+        for t in sorted(terminados, key=lambda t: t["creado"])[:max(0, len(terminados) - DOCUMENTOS_RETENER)]:
+            del self._trabajos[t["id"]]
+
+    def estado(self, id_trabajo):
+        """{'descripcion', 'hechos', 'total', 'listo', 'error'} o None si el trabajo ya no existe"""
+        with self._lock:
+            t = self._trabajos.get(id_trabajo)
+            if t is None: return None
+            return {"descripcion": t["descripcion"], "hechos": t["hechos"], "total": t["total"],
+                    "listo": t["terminado"] is not None, "error": t["error"]}
+
+    def resultado(self, id_trabajo):
+        """(nombre_archivo, bytes) cuando el trabajo terminó con algo que descargar"""
+        with self._lock:
+            t = self._trabajos.get(id_trabajo)
+            return t["resultado"] if t else None
+
+    def tabla(self):
+        fecha = lambda ts: datetime.fromtimestamp(ts, TZ_MX).strftime("%H:%M:%S") if ts else "-"
+        with self._lock:
+            filas = [{"Trabajo": t["descripcion"], "Avance": f"{t['hechos']}/{t['total']}", "Creado": fecha(t["creado"]),
+                      "Segundos": round(t["terminado"] - t["creado"], 2) if t["terminado"] else None,
+                      "Estado": (f"⚠️ {t['error']}" if t["error"] else "✅ Listo") if t["terminado"] else "⏳ En curso"}
+                     for t in sorted(self._trabajos.values(), key=lambda t: -t["creado"])]
+        return pd.DataFrame(filas)
+
+    def cerrar(self):
+        if self._pool is not None: self._pool.shutdown(wait=False, cancel_futures=True)
+
+@st.cache_resource
+def get_cola_documentos():
+    """Un pool por proceso del servidor; los procesos se crean la primera vez que alguien pide un documento"""
+    cola = ColaDocumentos()
+    atexit.register(cola.cerrar)
+    return cola
+
 # ==========================================
 # 4.5 SISTEMA DE AUTENTICACIÓN HASHEADA
 # ==========================================
@@ -1014,10 +2587,200 @@ def cerrar_sesion_segura():
     st.session_state.perfil = None
     st.rerun()
 
+def html_columna_agenda(slots, ocupacion_map, df_dia):
+    """HTML del calendario de un recurso (doctor o sillón) para el visualizador de agenda"""
+    html_parts = ["<div style='height: 600px; overflow-y: auto; padding: 5px; background-color: white; border: 1px solid #eee; border-radius: 8px;'>"]
+    for slot in slots:
+        if slot in ocupacion_map and ocupacion_map[slot]["rowid"] in df_dia.index:
+            info = ocupacion_map[slot]
+            r = df_dia.loc[info["rowid"]]
+            if info["tipo"] == "inicio": 
+                color_border = "#FF5722" if "PROS" in str(r['id_paciente']) else "#002B5B"
+                bg_c = "#e3f2fd" if r['estatus_asistencia'] == 'Asistió' else "#f8f9fa"
+                html_parts.append(f"<div style='padding:8px; margin-bottom:4px; background-color:{bg_c}; border-left:5px solid {color_border}; border-radius:4px; font-size:0.9em; box-shadow: 0 1px 2px rgba(0,0,0,0.1);'><b>{r['hora']}</b> | {r['nombre_paciente']}<br><span style='color:#666; font-size:0.85em;'>{r['tratamiento']} ({info['dur']}m)</span></div>")
+            else: 
+                html_parts.append(f"<div style='padding:4px; margin-bottom:4px; background-color:#f1f1f1; color:#aaa; font-size:0.8em; margin-left: 15px; border-left: 2px solid #ddd;'>⬇️ <i>En tratamiento ({r['nombre_paciente']})</i></div>")
+        else: 
+            html_parts.append(f"<div style='padding:8px; margin-bottom:2px; border-bottom:1px dashed #eee; display:flex; align-items:center;'><span style='font-weight:bold; color:#4CAF50; width:60px;'>{slot}</span><span style='color:#81C784; font-size:0.9em;'>Disponible</span></div>")
+    html_parts.append("</div>")
+    return "".join(html_parts)
+
+def selector_paciente(etiqueta, key, vacia="Seleccionar...", por_pagina=20):
+    """Buscador type-ahead (FTS5) + selectbox con los primeros resultados; 'Más resultados' carga la siguiente página.
+    Regresa la etiqueta 'ID - Nombre Paterno' elegida, o `vacia` (None si no hay opción vacía y no hubo resultados)."""
+    texto = st.text_input(f"🔎 {etiqueta}", key=f"{key}_q", placeholder="Nombre, ID, teléfono, RFC o email")
+    clave_paginas = f"{key}_paginas"
+    if st.session_state.get(f"{key}_q_ant") != texto: st.session_state[clave_paginas] = 1; st.session_state[f"{key}_q_ant"] = texto
+    limite = por_pagina * st.session_state.get(clave_paginas, 1)
+    if texto.strip(): opciones, hay_mas = buscar_pacientes(texto, limite)
+    else:
+        directorio = obtener_etiquetas_pacientes(); opciones = directorio[:limite]; hay_mas = len(directorio) > limite
+    if vacia is None and not opciones:
+        st.caption("Sin coincidencias."); return None
+    sel = st.selectbox(etiqueta, ([vacia] if vacia is not None else []) + opciones, key=key)
+    if hay_mas and st.button("Más resultados ▸", key=f"{key}_mas"):
+        st.session_state[clave_paginas] = st.session_state.get(clave_paginas, 1) + 1; st.rerun()
+    return sel
+
+def historial_paginado(clave, consulta, *args):
+    """'Cargar más': junta las páginas pedidas hasta ahora, cada una con el cursor de la anterior.
+    Regresa (df, hay_mas). La clave debe incluir al paciente para reiniciar al cambiar de expediente."""
+    paginas = st.session_state.get(clave, 1); frames, cursor, hay_mas = [], None, False
+    for _ in range(paginas):
+        df, hay_mas, cursor = consulta(*args, antes_de=cursor); frames.append(df)
+        if not hay_mas: break
+    return pd.concat(frames, ignore_index=True), hay_mas
+
+def boton_cargar_mas(clave, hay_mas, mostrados):
+    if hay_mas and st.button(f"Cargar más ▾ ({mostrados} mostrados)", key=f"{clave}_mas"):
+        st.session_state[clave] = st.session_state.get(clave, 1) + 1; st.rerun()
+
+def panel_trabajo_documento(id_trabajo, etiqueta):
+    """Botón de descarga si el trabajo ya terminó; si no, un aviso que se refresca solo sin bloquear la sesión"""
+    cola = get_cola_documentos(); info = cola.estado(id_trabajo)
+    if info is None: st.caption("El documento ya no está disponible; vuelva a generarlo."); return
+    if not info["listo"]: _esperar_trabajo_documento(id_trabajo); return
+    if info["error"]: st.warning(f"⚠️ {info['error']}")
+    resultado = cola.resultado(id_trabajo)
+    if resultado:
+        nombre, datos = resultado
+        st.download_button(etiqueta, datos, nombre, "application/zip" if nombre.endswith(".zip") else "application/pdf", key=f"dl_{id_trabajo}")
+
+@st.fragment(run_every=DOCUMENTOS_SONDEO_SEG)
+def _esperar_trabajo_documento(id_trabajo):
+    info = get_cola_documentos().estado(id_trabajo)
+    # Al terminar se re-ejecuta la página completa para que aparezca el botón de descarga
+    if info is None or info["listo"]: st.rerun()
+    st.info(f"⏳ {info['descripcion']}: {info['hechos']}/{info['total']} documentos")
+
+COLORES_DIENTE = {"Sano": "⚪", "Caries": "🔴", "Resina": "🔵", "Ausente": "⚫", "Corona": "🟡"}
+
+def _ciclar_diente(clave, diente, guardado):
+    pendientes = st.session_state[clave]; nuevo = siguiente_estado_diente(pendientes.get(diente, guardado))
+    if nuevo == guardado: pendientes.pop(diente, None)
+    else: pendientes[diente] = nuevo
+
+def _guardar_odontograma_pendiente(clave, id_paciente):
+    n = guardar_odontograma(id_paciente, st.session_state[clave], usuario=str(st.session_state.get('perfil') or "CONSULTORIO").upper())
+    st.session_state[clave].clear(); st.toast(f"🦷 {n} dientes guardados")
+
+@st.fragment
+def editor_odontograma(id_paciente, dientes_sup, dientes_inf):
+    """Los clics solo re-ejecutan este fragmento y se acumulan en la sesión; 'Guardar' confirma todo en una transacción"""
+    clave = f"odo_pend_{id_paciente}"; pendientes = st.session_state.setdefault(clave, {})
+    hasta = st.date_input("Ver al día (vacío = actual)", value=None, max_value=datetime.now(TZ_MX).date(), format="DD/MM/YYYY", key=f"odo_hasta_{id_paciente}")
+    solo_lectura = hasta is not None
+    guardados = obtener_estado_dientes(id_paciente, hasta.strftime("%Y-%m-%d") if solo_lectura else None)
+    for fila in (dientes_sup, dientes_inf):
+        cols = st.columns(len(fila))
+        for idx, d in enumerate(fila):
+            guardado = guardados.get(str(d), "Sano"); est = guardado if solo_lectura else pendientes.get(str(d), guardado)
+            marca = "*" if not solo_lectura and str(d) in pendientes else ""
+            cols[idx].button(f"{COLORES_DIENTE[est]}\n{d}{marca}", key=f"d_{d}", disabled=solo_lectura, on_click=_ciclar_diente, args=(clave, str(d), guardado))
+        if fila is dientes_sup: st.divider()
+    if solo_lectura: st.caption(f"Odontograma al {hasta.strftime('%d/%m/%Y')} (solo lectura). Borre la fecha para editar."); return
+    st.caption("Clic para cambiar: ⚪Sano -> 🔴Caries -> 🔵Resina -> ⚫Ausente -> 🟡Corona · * = sin guardar")
+    c1, c2 = st.columns(2)
+    c1.button(f"💾 Guardar cambios ({len(pendientes)})", type="primary", disabled=not pendientes, use_container_width=True,
+              on_click=_guardar_odontograma_pendiente, args=(clave, id_paciente))
+    c2.button("↩️ Descartar", disabled=not pendientes, use_container_width=True, on_click=pendientes.clear)
+
+@st.fragment
+def panel_periodontograma(id_paciente):
+    """Captura en un formulario (editar celdas no re-ejecuta nada) que parte del examen anterior, y evolución entre exámenes"""
+    st.markdown("#### 📏 Periodontograma y superficies")
+    meta, ex = obtener_examenes_periodontales(id_paciente)
+    n = len(meta); filas = [str(d) for d in DIENTES_PERMANENTES]
+    cero = np.zeros((32, 6), np.int16)
+    base_p = ex["profundidad"][-1] if n else cero; base_r = ex["recesion"][-1] if n else cero
+    base_s = ex["sangrado"][-1] if n else cero.astype(bool)
+    base_sup = ((ex["superficies"][-1][:, None] >> np.arange(len(SUPERFICIES))) & 1).astype(bool) if n else np.zeros((32, len(SUPERFICIES)), bool)
+    mm = lambda minimo: {c: st.column_config.NumberColumn(c, min_value=minimo, max_value=15, step=1) for c in SITIOS_PERIO}
+    with st.form(f"perio_{id_paciente}"):
+        doctor = st.selectbox("Odontólogo", LISTA_DOCTORES, key=f"perio_doc_{id_paciente}")
+        t_p, t_r, t_s, t_sup = st.tabs(["Profundidad (mm)", "Recesión (mm)", "Sangrado", "Superficies restauradas"])
+        # La clave incluye el número de exámenes: al guardar, las tablas arrancan del examen recién guardado
+        with t_p: df_p = st.data_editor(pd.DataFrame(base_p, index=filas, columns=SITIOS_PERIO), column_config=mm(0), use_container_width=True, key=f"perio_p_{id_paciente}_{n}")
+        with t_r: df_r = st.data_editor(pd.DataFrame(base_r, index=filas, columns=SITIOS_PERIO), column_config=mm(-5), use_container_width=True, key=f"perio_r_{id_paciente}_{n}")
+        with t_s: df_s = st.data_editor(pd.DataFrame(base_s, index=filas, columns=SITIOS_PERIO), use_container_width=True, key=f"perio_s_{id_paciente}_{n}")
+        with t_sup: df_sup = st.data_editor(pd.DataFrame(base_sup, index=filas, columns=list(SUPERFICIES)), use_container_width=True, key=f"perio_sup_{id_paciente}_{n}")
+        if st.form_submit_button("💾 Guardar examen", type="primary"):
+            superficies = (df_sup.fillna(False).to_numpy(bool) * (1 << np.arange(len(SUPERFICIES)))).sum(axis=1)
+            guardar_examen_periodontal(id_paciente, doctor, superficies, df_p.fillna(0).to_numpy(), df_r.fillna(0).to_numpy(), df_s.fillna(False).to_numpy(bool))
+            st.toast("📏 Examen guardado"); meta, ex = obtener_examenes_periodontales(id_paciente); n = len(meta)
+    if not n: st.caption("Sin exámenes previos."); return
+    resumen = resumen_periodontal(ex); resumen.insert(0, "Fecha", meta["fecha_examen"].str[:16]); resumen.insert(1, "Doctor", meta["doctor"])
+    st.dataframe(resumen.iloc[::-1], use_container_width=True, hide_index=True)
+    if n > 1:
+        empeoran = comparar_examenes(ex, n - 2, n - 1)
+        if empeoran.empty: st.success("✅ Ningún sitio aumentó 2 mm o más respecto al examen anterior.")
+        else: st.warning(f"{len(empeoran)} sitios aumentaron 2 mm o más respecto al examen anterior."); st.dataframe(empeoran, use_container_width=True, hide_index=True)
+
+def visor_piramide(sha, clave):
+    """Zoom por niveles y encuadre; cada cambio solo lee los mosaicos del recuadro visible"""
+    niveles = leer_manifiesto_piramide(sha)["niveles"]
+    # Zoom inicial: el nivel más detallado en el que la imagen completa cabe en el visor
+    ajuste = next((k for k, n in enumerate(niveles) if n["ancho"] <= VISOR_ANCHO and n["alto"] <= VISOR_ALTO), len(niveles) - 1)
+    etiquetas = {k: f"{100 / 2 ** k:g}%" for k in range(len(niveles))}
+    c1, c2, c3, c4 = st.columns([2, 2, 2, 1])
+    nivel = c1.select_slider("Zoom", options=list(range(ajuste, -1, -1)), value=ajuste, format_func=etiquetas.get, key=f"{clave}_zoom")
+    cx = c2.slider("Horizontal", 0, 100, 50, key=f"{clave}_x"); cy = c3.slider("Vertical", 0, 100, 50, key=f"{clave}_y")
+    invertir = c4.checkbox("Invertir", key=f"{clave}_inv")
+    info = niveles[nivel]
+    x = max(0, min(int(info["ancho"] * cx / 100) - VISOR_ANCHO // 2, info["ancho"] - VISOR_ANCHO))
+    y = max(0, min(int(info["alto"] * cy / 100) - VISOR_ALTO // 2, info["alto"] - VISOR_ALTO))
+    region = leer_region_piramide(sha, nivel, x, y, VISOR_ANCHO, VISOR_ALTO)
+    if invertir: region = 255 - region
+    st.image(region[:, :, 0] if region.shape[2] == 1 else region, output_format="JPEG", use_container_width=True,
+             caption=f"{niveles[0]['ancho']}×{niveles[0]['alto']} px · vista {etiquetas[nivel]} · ({x}, {y})")
+
+@st.fragment
+def galeria_archivos(id_p):
+    """Subida con deduplicación y galería paginada de miniaturas; el original se carga solo al abrirlo"""
+    c1, c2 = st.columns([3, 1])
+    tipo = c2.selectbox("Tipo", TIPOS_ARCHIVO, key=f"tipo_arch_{id_p}")
+    subidos = c1.file_uploader("Subir Archivo", type=sorted(EXTENSIONES_IMAGEN | {"pdf"}), accept_multiple_files=True, key=f"subir_{id_p}")
+    # El uploader conserva los archivos entre reruns: cada uno se procesa una sola vez
+    procesados = st.session_state.setdefault("archivos_procesados", set())
+    for archivo in subidos or []:
+        if archivo.file_id in procesados: continue
+        _, nuevo = guardar_archivo_paciente(id_p, archivo.name, archivo.getvalue(), tipo); procesados.add(archivo.file_id)
+        if nuevo: st.toast(f"✅ {archivo.name} guardado")
+        else: st.toast(f"ℹ️ {archivo.name} ya estaba en el expediente")
+    clave = f"galeria_{id_p}"
+    df, hay_mas = historial_paginado(clave, listar_archivos_paciente, id_p)
+    if df.empty: st.info("Sin archivos."); return
+    abierto = st.session_state.get(f"{clave}_abierto")
+    cols = st.columns(4)
+    for i, a in enumerate(df.itertuples(index=False)):
+        with cols[i % 4]:
+            if a.miniatura: st.image(ruta_miniatura(a.sha256), use_container_width=True)
+            else: st.markdown("<div style='font-size:64px;text-align:center'>📄</div>", unsafe_allow_html=True)
+            st.caption(f"{a.nombre} · {a.tipo} · {a.fecha_subida[:10]} · {a.bytes / 1024:,.0f} KB")
+            if st.button("🔍 Abrir", key=f"abrir_{a.id_archivo}"): st.session_state[f"{clave}_abierto"] = abierto = a.id_archivo
+    boton_cargar_mas(clave, hay_mas, len(df))
+    sel = df[df['id_archivo'] == abierto]
+    if not sel.empty:
+        a = sel.iloc[0]
+        with st.container(border=True):
+            st.markdown(f"**{a['nombre']}** ({a['tipo']}, {a['fecha_subida']})")
+            if tiene_piramide(a['sha256']):
+                # Imagen grande: el visor lee mosaicos; el original solo se carga si se pide descargarlo
+                visor_piramide(a['sha256'], f"visor_{a['id_archivo']}")
+                if st.button("📥 Preparar descarga del original", key=f"prep_{a['id_archivo']}"):
+                    st.download_button("📥 Descargar original", leer_archivo(a['sha256'], a['extension']), a['nombre'], key=f"dl_arch_{a['id_archivo']}")
+            else:
+                datos = leer_archivo(a['sha256'], a['extension'])
+                if a['extension'] in EXTENSIONES_IMAGEN:
+                    # TIFF/BMP (radiografías de 16 bits, p.ej.) no se ven en el navegador: se muestran ya convertidas a 8 bits
+                    vista = datos if a['extension'] in ("png", "jpg", "jpeg", "webp") else _a_arreglo(ImageOps.exif_transpose(Image.open(io.BytesIO(datos))))
+                    st.image(vista[:, :, 0] if getattr(vista, "ndim", 0) == 3 and vista.shape[2] == 1 else vista, use_container_width=True)
+                st.download_button("📥 Descargar original", datos, a['nombre'], key=f"dl_arch_{a['id_archivo']}")
+
 def render_header(conn):
     if st.session_state.id_paciente_activo:
         try:
-            p = pd.read_sql(f"SELECT * FROM pacientes WHERE id_paciente='{st.session_state.id_paciente_activo}'", conn).iloc[0]
+            p = obtener_paciente(st.session_state.id_paciente_activo)
             edad, _ = calcular_edad_completa(p['fecha_nacimiento'])
             raw_app = str(p.get('app', '')).strip()
             tiene_alerta = len(raw_app) > 2 and not any(x in raw_app.upper() for x in ["NEGADO", "NINGUNO", "N/A", "SIN"])
@@ -1042,8 +2805,8 @@ def vista_consultorio():
         if st.button("🗑️ RESETEAR BASE DE DATOS (CUIDADO)", type="primary"):
             try:
                 conn_temp = get_db_connection(); c_temp = conn_temp.cursor()
-                c_temp.execute("DELETE FROM pacientes"); c_temp.execute("DELETE FROM citas"); c_temp.execute("DELETE FROM asistencia"); c_temp.execute("DELETE FROM odontograma")
-                conn_temp.commit(); conn_temp.close(); st.cache_data.clear()
+                c_temp.execute("DELETE FROM pacientes"); c_temp.execute("DELETE FROM citas"); c_temp.execute("DELETE FROM asistencia"); c_temp.execute("DELETE FROM odontograma"); c_temp.execute("DELETE FROM odontograma_historial"); c_temp.execute("DELETE FROM examenes_periodontales"); c_temp.execute("DELETE FROM saldos_pacientes"); c_temp.execute("DELETE FROM resumen_financiero")
+                conn_temp.commit(); conn_temp.close(); st.cache_data.clear(); get_directorio_pacientes().invalidar()
                 if 'perfil' in st.session_state: del st.session_state['perfil']
                 st.success("✅ Sistema y memoria limpiados."); time.sleep(1); st.rerun()
             except Exception as e: st.error(f"Error crítico: {e}")
@@ -1100,25 +2863,9 @@ def vista_consultorio():
         # ==============================================================================
         st.markdown(f"#### ⚡ Gestión Rápida: {fecha_ver_str}")
         
-        # Traemos datos (Carga optimizada)
-        query_agenda = f"""
-            SELECT rowid, fecha, hora, nombre_paciente, tratamiento, 
-                   estatus_asistencia, duracion, estado_pago, id_paciente, notas 
-            FROM citas 
-            WHERE fecha='{fecha_ver_str}' 
-            AND estado_pago != 'CANCELADO' 
-            ORDER BY hora ASC
-        """
         # 🛡️ CORRECCIÓN #1: SQL PARAMETRIZADO + OPTIMIZACIÓN (Agenda)
-        query_agenda = """
-            SELECT rowid, fecha, hora, nombre_paciente, tratamiento, 
-                   estatus_asistencia, duracion, estado_pago, id_paciente, notas 
-            FROM citas 
-            WHERE fecha = ? AND estado_pago != 'CANCELADO' 
-            ORDER BY hora ASC
-        """
-        # Nota la coma después de fecha_ver_str, es necesaria para crear una tupla
-        citas_dia = pd.read_sql(query_agenda, conn, params=(fecha_ver_str,))
+        # Consulta del día en caché (se invalida al modificar cualquier cita de esa fecha)
+        citas_dia = obtener_citas_dia(fecha_ver_str)
         
         if not citas_dia.empty:
             # [NUEVO] CAJA CON SCROLL (HEIGHT=400px)
@@ -1144,7 +2891,7 @@ def vista_consultorio():
                             <div class="cita-time">{r['hora']}</div>
                             <div style="padding-left: 10px;">
                                 <div class="cita-name">{r['nombre_paciente']}</div>
-                                <div class="cita-desc">{r['tratamiento']}</div>
+                                <div class="cita-desc">{r['tratamiento']} · {texto_o_none(r['doctor_atendio']) or 'Sin doctor'} · {texto_o_none(r['sillon']) or 'Sin sillón'}</div>
                             </div>
                         </div>
                     </div>
@@ -1158,10 +2905,10 @@ def vista_consultorio():
                     if es_hoy or fecha_ver_obj <= datetime.now(TZ_MX).date():
                         with c_btns[0]:
                             if st.button("✅", key=f"ok_{rowid}", help="Asistió"):
-                                c = conn.cursor(); c.execute("UPDATE citas SET estatus_asistencia='Asistió' WHERE rowid=?", (rowid,)); conn.commit(); st.rerun()
+                                c = conn.cursor(); c.execute("UPDATE citas SET estatus_asistencia='Asistió' WHERE rowid=?", (rowid,)); conn.commit(); invalidar_agenda(fecha_ver_str); st.rerun()
                         with c_btns[1]:
                             if st.button("❌", key=f"no_{rowid}", help="No Asistió"):
-                                c = conn.cursor(); nota = f"\n[SISTEMA]: Inasistencia {fecha_ver_str}."; c.execute("UPDATE citas SET estatus_asistencia='No Asistió', notas=ifnull(notas,'') || ? WHERE rowid=?", (nota, rowid)); conn.commit(); st.warning("Falta"); time.sleep(0.5); st.rerun()
+                                c = conn.cursor(); nota = f"\n[SISTEMA]: Inasistencia {fecha_ver_str}."; c.execute("UPDATE citas SET estatus_asistencia='No Asistió', notas=ifnull(notas,'') || ? WHERE rowid=?", (nota, rowid)); conn.commit(); invalidar_agenda(fecha_ver_str); st.warning("Falta"); time.sleep(0.5); st.rerun()
                     
                     # Botones de Gestión siempre disponibles
                     with c_btns[3]:
@@ -1183,16 +2930,16 @@ def vista_consultorio():
                             col_si, col_no = st.columns(2)
                             if col_si.button("Confirmar Cancelación", key=f"conf_del_{rowid}"):
                                 if len(motivo) > 4:
-                                    c = conn.cursor()
                                     nota_cancel = f" [CANCELADA: {motivo}]"
-                                    # Actualizamos estado y agregamos nota
-                                    c.execute("UPDATE citas SET estado_pago='CANCELADO', estatus_asistencia='Canceló', notas=ifnull(notas,'') || ? WHERE rowid=?", (nota_cancel, rowid))
-                                    
-                                    # Auditoría
                                     usuario_audit = st.session_state.get('perfil', 'SISTEMA')
-                                    registrar_auditoria(usuario_audit, "CANCELACION_CITA", f"ID {rowid} | Motivo: {motivo}")
-                                    
-                                    conn.commit()
+                                    with db_transaction() as conn_tx:
+                                        c = conn_tx.cursor()
+                                        saldo_cancelar_cita(c, rowid); resumen_aplicar_cita(c, rowid, -1)
+                                        # Actualizamos estado y agregamos nota
+                                        c.execute("UPDATE citas SET estado_pago='CANCELADO', estatus_asistencia='Canceló', notas=ifnull(notas,'') || ? WHERE rowid=?", (nota_cancel, rowid))
+                                        # Auditoría en la misma transacción que el cambio de saldo
+                                        registrar_auditoria(usuario_audit, "CANCELACION_CITA", f"ID {rowid} | Motivo: {motivo}", conn=conn_tx)
+                                    agenda_cita_cancelada(fecha_ver_str, rowid)
                                     del st.session_state[f"cancelar_mode_{rowid}"] # Limpiar
                                     st.success("Cancelada"); time.sleep(1); st.rerun()
                                 else:
@@ -1209,14 +2956,28 @@ def vista_consultorio():
                             cc1, cc2, cc3 = st.columns([2, 2, 1])
                             n_f = cc1.date_input("Fecha", datetime.now(TZ_MX), key=f"nf_{rowid}", label_visibility="collapsed")
                             n_h = cc2.selectbox("Hora", generar_slots_tiempo(), key=f"nh_{rowid}", label_visibility="collapsed")
+                            # Sugerencias del motor de ocupación (la propia cita no cuenta si se mueve dentro del mismo día)
+                            excluir_mov = rowid if format_date_latino(n_f) == fecha_ver_str else None
+                            libres_mov = sugerir_horarios(format_date_latino(n_f), r['duracion'], excluir=excluir_mov, doctor=texto_o_none(r['doctor_atendio']))
+                            st.caption(f"🕒 Libres: {', '.join(libres_mov) if libres_mov else 'Sin espacio este día'}")
+                            # El doctor se conserva; el sillón se mantiene si sigue libre, si no se reasigna
+                            sillon_mov = asignar_sillon(format_date_latino(n_f), n_h, r['duracion'], r['doctor_atendio'], r['sillon'], excluir_mov)
+                            ocupado_mov = verificar_disponibilidad(format_date_latino(n_f), n_h, r['duracion'], r['doctor_atendio'], excluir=excluir_mov) or not sillon_mov
+                            urgencia_mov = st.checkbox("🚨 Mover como Urgencia (Permitir cruce)", key=f"urg_mov_{rowid}") if ocupado_mov else False
                             if cc3.button("💾", key=f"sv_{rowid}"):
-                                c = conn.cursor()
-                                # Limpiamos estatus al mover
-                                c.execute("UPDATE citas SET fecha=?, hora=?, estatus_asistencia='Programada' WHERE rowid=?", (format_date_latino(n_f), n_h, rowid))
-                                conn.commit()
-                                del st.session_state[f"edit_mode_{rowid}"] # Limpiar estado visual
-                                st.success("Movido")
-                                time.sleep(0.5); st.rerun()
+                                if ocupado_mov and not urgencia_mov:
+                                    st.error("⚠️ Horario OCUPADO (doctor o sillón). Marque 'Urgencia' para empalmar.")
+                                else:
+                                    c = conn.cursor()
+                                    # Limpiamos estatus al mover (si la fila tiene dinero, el resumen la cambia de día)
+                                    resumen_aplicar_cita(c, rowid, -1)
+                                    c.execute("UPDATE citas SET fecha=?, hora=?, sillon=?, estatus_asistencia='Programada' WHERE rowid=?", (format_date_latino(n_f), n_h, sillon_mov or texto_o_none(r['sillon']), rowid))
+                                    resumen_aplicar_cita(c, rowid)
+                                    conn.commit()
+                                    agenda_cita_movida(rowid, fecha_ver_str, format_date_latino(n_f), n_h, r['duracion'], r['doctor_atendio'], sillon_mov or texto_o_none(r['sillon']))
+                                    del st.session_state[f"edit_mode_{rowid}"] # Limpiar estado visual
+                                    st.success("Movido")
+                                    time.sleep(0.5); st.rerun()
                     
                     st.markdown("<div style='margin-bottom: 8px;'></div>", unsafe_allow_html=True) # Pequeño separador real
 
@@ -1239,17 +3000,21 @@ def vista_consultorio():
                 q_cita = st.text_input("Nombre del paciente:", key="search_global_v471")
                 if q_cita:
 # 🛡️ CORRECCIÓN #2: BÚSQUEDA PARAMETRIZADA (Blindaje Crítico)
-                    query = """
+                    # Pacientes por FTS5 (top 50) y sus citas por índice; los prospectos (PROS-*) solo existen en citas
+                    ids_encontrados = [e.split(" - ")[0] for e in buscar_pacientes(q_cita, 50)[0]]
+                    marcas = ",".join("?" * len(ids_encontrados)) or "NULL"
+                    query = f"""
                         SELECT rowid, fecha, hora, tratamiento, nombre_paciente, estatus_asistencia 
                         FROM citas 
-                        WHERE nombre_paciente LIKE ? 
+                        WHERE id_paciente IN ({marcas})
+                           OR (id_paciente >= 'PROS-' AND id_paciente < 'PROS.' AND nombre_paciente LIKE ?)
                         ORDER BY timestamp DESC 
                         LIMIT 50
                     """
                     # El truco de seguridad: Los % van en Python, NO en el SQL
                     search_param = f"%{formato_nombre_legal(q_cita)}%"
                     
-                    df = pd.read_sql(query, conn, params=(search_param,))
+                    df = pd.read_sql(query, conn, params=(*ids_encontrados, search_param))
                     st.dataframe(df, use_container_width=True, hide_index=True)
 
 # [AGENDAR CITA NUEVA - CON SELECTOR SEGURO]
@@ -1259,10 +3024,7 @@ def vista_consultorio():
                 # --- TAB REGISTRADO ---
                 with tab_reg:
                     servicios = pd.read_sql("SELECT * FROM servicios", conn); cats = servicios['categoria'].unique()
-                    pacientes_raw = pd.read_sql("SELECT id_paciente, nombre, apellido_paterno FROM pacientes", conn)
-                    lista_pac = pacientes_raw.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist() if not pacientes_raw.empty else []
-                    
-                    p_sel_r = st.selectbox("Paciente*", ["Seleccionar..."] + lista_pac, key=f"p_reg_{reset_id}")
+                    p_sel_r = selector_paciente("Paciente*", f"p_reg_{reset_id}")
                     
                     # --- CAMBIO: FECHA SEGURA (Bloquea Pasado) ---
                     c_f1, c_f2 = st.columns(2)
@@ -1281,9 +3043,13 @@ def vista_consultorio():
                         row_dur = servicios[servicios['nombre_tratamiento'] == trat_sel_r]
                         if not row_dur.empty: dur_default_r = int(row_dur.iloc[0]['duracion'])
                     
-                    c_d1, c_d2 = st.columns(2)
+                    c_d1, c_d2, c_d3 = st.columns(3)
                     duracion_cita_r = c_d1.number_input("Minutos", value=dur_default_r, step=30, key=f"dur_reg_{reset_id}")
                     d_sel_r = c_d2.selectbox("Doctor", LISTA_DOCTORES, key=f"doc_reg_{reset_id}")
+                    s_sel_r = c_d3.selectbox("Sillón", ["Automático"] + LISTA_SILLONES, key=f"sil_reg_{reset_id}")
+                    s_pref_r = None if s_sel_r == "Automático" else s_sel_r
+                    libres_r = sugerir_horarios(format_date_latino(f_agenda_r), duracion_cita_r, doctor=d_sel_r, sillon=s_pref_r)
+                    st.caption(f"🕒 Horarios libres ({duracion_cita_r} min): {', '.join(libres_r) if libres_r else 'Sin espacio este día'}")
                     
                     urgencia_r = st.checkbox("🚨 Agendar como Urgencia (Permitir cruce)", key=f"urg_reg_{reset_id}")
                     
@@ -1292,16 +3058,21 @@ def vista_consultorio():
                              # Convertimos la fecha segura a string latino
                              f_agenda_str_r = format_date_latino(f_agenda_r)
                              
-                             ocupado = verificar_disponibilidad(f_agenda_str_r, h_sel_r, duracion_cita_r)
+                             # Conflicto por recurso: el doctor no puede estar en dos citas y el sillón tampoco
+                             sillon_r = asignar_sillon(f_agenda_str_r, h_sel_r, duracion_cita_r, d_sel_r, s_pref_r)
+                             if s_pref_r and sillon_r != s_pref_r: sillon_r = None
+                             ocupado = verificar_disponibilidad(f_agenda_str_r, h_sel_r, duracion_cita_r, d_sel_r) or not sillon_r
                              if ocupado and not urgencia_r: 
-                                 st.error("⚠️ Horario OCUPADO. Marque 'Urgencia' para empalmar.")
+                                 st.error("⚠️ Horario OCUPADO (doctor o sillón). Marque 'Urgencia' para empalmar.")
                              else:
                                  id_p = p_sel_r.split(" - ")[0]; nom_p = p_sel_r.split(" - ")[1]
+                                 sillon_r = sillon_r or s_pref_r or LISTA_SILLONES[0]
                                  c = conn.cursor()
                                  # Usamos f_agenda_str_r en el INSERT
-                                 c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, categoria, tratamiento, doctor_atendio, estado_pago, estatus_asistencia, duracion, notas) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', 
-                                           (int(time.time()), f_agenda_str_r, h_sel_r, id_p, nom_p, cat_sel_r, trat_sel_r, d_sel_r, "Pendiente", "Programada", duracion_cita_r, f"Cita: {trat_sel_r}"))
+                                 c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, categoria, tratamiento, doctor_atendio, sillon, estado_pago, estatus_asistencia, duracion, notas) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
+                                           (int(time.time()), f_agenda_str_r, h_sel_r, id_p, nom_p, cat_sel_r, trat_sel_r, d_sel_r, sillon_r, "Pendiente", "Programada", duracion_cita_r, f"Cita: {trat_sel_r}"))
                                  conn.commit()
+                                 agenda_cita_agregada(f_agenda_str_r, c.lastrowid, h_sel_r, duracion_cita_r, d_sel_r, sillon_r)
                                  st.success("Agendado")
                                  st.session_state.form_reset_id += 1 # Limpieza
                                  time.sleep(1); st.rerun()
@@ -1332,9 +3103,13 @@ def vista_consultorio():
                         row_dur_p = servicios_p[servicios_p['nombre_tratamiento'] == trat_sel_p]
                         if not row_dur_p.empty: dur_default_p = int(row_dur_p.iloc[0]['duracion'])
                     
-                    c_tp1, c_tp2 = st.columns(2)
+                    c_tp1, c_tp2, c_tp3 = st.columns(3)
                     duracion_cita_p = c_tp1.number_input("Minutos", value=dur_default_p, step=30, key=f"dur_pros_{reset_id}")
                     doc_pros = c_tp2.selectbox("Doctor", LISTA_DOCTORES, key=f"doc_pros_{reset_id}")
+                    sil_pros = c_tp3.selectbox("Sillón", ["Automático"] + LISTA_SILLONES, key=f"sil_pros_{reset_id}")
+                    s_pref_p = None if sil_pros == "Automático" else sil_pros
+                    libres_p = sugerir_horarios(format_date_latino(f_agenda_p), duracion_cita_p, doctor=doc_pros, sillon=s_pref_p)
+                    st.caption(f"🕒 Horarios libres ({duracion_cita_p} min): {', '.join(libres_p) if libres_p else 'Sin espacio este día'}")
                     
                     urgencia_p = st.checkbox("🚨 Es Urgencia / Sobrecupo", key=f"urg_pros_{reset_id}")
                     
@@ -1343,16 +3118,20 @@ def vista_consultorio():
                              # Convertimos fecha segura a string
                              f_agenda_str_p = format_date_latino(f_agenda_p)
                              
-                             ocupado = verificar_disponibilidad(f_agenda_str_p, hora_pros, duracion_cita_p)
+                             sillon_p = asignar_sillon(f_agenda_str_p, hora_pros, duracion_cita_p, doc_pros, s_pref_p)
+                             if s_pref_p and sillon_p != s_pref_p: sillon_p = None
+                             ocupado = verificar_disponibilidad(f_agenda_str_p, hora_pros, duracion_cita_p, doc_pros) or not sillon_p
                              if ocupado and not urgencia_p: 
-                                 st.error("⚠️ Horario OCUPADO. Marque 'Urgencia' para empalmar.")
+                                 st.error("⚠️ Horario OCUPADO (doctor o sillón). Marque 'Urgencia' para empalmar.")
                              else:
                                  id_temp = f"PROS-{int(time.time())}"
+                                 sillon_p = sillon_p or s_pref_p or LISTA_SILLONES[0]
                                  c = conn.cursor()
                                  # Usamos f_agenda_str_p en el INSERT
-                                 c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, tipo, tratamiento, doctor_atendio, estado_pago, estatus_asistencia, notas, duracion) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', 
-                                           (int(time.time()), f_agenda_str_p, hora_pros, id_temp, formato_nombre_legal(nom_pros), "Primera Vez", trat_sel_p, doc_pros, "Pendiente", "Programada", f"Tel: {tel_pros}", duracion_cita_p))
+                                 c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, tipo, tratamiento, doctor_atendio, sillon, estado_pago, estatus_asistencia, notas, duracion) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
+                                           (int(time.time()), f_agenda_str_p, hora_pros, id_temp, formato_nombre_legal(nom_pros), "Primera Vez", trat_sel_p, doc_pros, sillon_p, "Pendiente", "Programada", f"Tel: {tel_pros}", duracion_cita_p))
                                  conn.commit()
+                                 agenda_cita_agregada(f_agenda_str_p, c.lastrowid, hora_pros, duracion_cita_p, doc_pros, sillon_p)
                                  st.success("Prospecto Agendado")
                                  st.session_state.form_reset_id += 1 # Limpieza
                                  time.sleep(1); st.rerun()
@@ -1361,59 +3140,32 @@ def vista_consultorio():
         # === COLUMNA DERECHA: VISUALIZADOR ===
         with col_cal2:
             st.markdown(f"#### 🗓️ Visual: {fecha_ver_str}")
-            df_c = pd.read_sql("SELECT * FROM citas", conn)
-            df_dia = df_c[df_c['fecha'] == fecha_ver_str]
+            df_dia = citas_dia.set_index('rowid', drop=False)  # Misma consulta cacheada de la Gestión Rápida
             slots = generar_slots_tiempo()
-            ocupacion_map = {} 
-            if not df_dia.empty:
-                for _, r in df_dia.iterrows():
-                    if r['estado_pago'] == 'CANCELADO': continue
-                    h_inicio = r['hora']
-                    try: dur = int(r['duracion']) if r['duracion'] and r['duracion'] > 0 else 30
-                    except: dur = 30
-                    try:
-                        start_dt = datetime.strptime(h_inicio, "%H:%M")
-                        for i in range(0, dur, 30):
-                            bloque_time = start_dt + timedelta(minutes=i)
-                            bloque_str = bloque_time.strftime("%H:%M")
-                            if bloque_str not in ocupacion_map:
-                                if i == 0: ocupacion_map[bloque_str] = {"tipo": "inicio", "data": r, "dur": dur}
-                                else: ocupacion_map[bloque_str] = {"tipo": "bloqueado", "parent": r['nombre_paciente']}
-                    except: pass
-            
-            # HTML LIST JOIN
-            html_parts = []
-            html_parts.append("<div style='height: 600px; overflow-y: auto; padding: 5px; background-color: white; border: 1px solid #eee; border-radius: 8px;'>")
-            
-            for slot in slots:
-                if slot in ocupacion_map:
-                    info = ocupacion_map[slot]
-                    if info["tipo"] == "inicio": 
-                        r = info["data"]
-                        color_border = "#FF5722" if "PROS" in str(r['id_paciente']) else "#002B5B"
-                        bg_c = "#e3f2fd" if r['estatus_asistencia'] == 'Asistió' else "#f8f9fa"
-                        
-                        item = f"<div style='padding:8px; margin-bottom:4px; background-color:{bg_c}; border-left:5px solid {color_border}; border-radius:4px; font-size:0.9em; box-shadow: 0 1px 2px rgba(0,0,0,0.1);'><b>{slot}</b> | {r['nombre_paciente']}<br><span style='color:#666; font-size:0.85em;'>{r['tratamiento']} ({info['dur']}m)</span></div>"
-                        html_parts.append(item)
-                    else: 
-                        item = f"<div style='padding:4px; margin-bottom:4px; background-color:#f1f1f1; color:#aaa; font-size:0.8em; margin-left: 15px; border-left: 2px solid #ddd;'>⬇️ <i>En tratamiento ({info['parent']})</i></div>"
-                        html_parts.append(item)
-                else: 
-                    item = f"<div style='padding:8px; margin-bottom:2px; border-bottom:1px dashed #eee; display:flex; align-items:center;'><span style='font-weight:bold; color:#4CAF50; width:60px;'>{slot}</span><span style='color:#81C784; font-size:0.9em;'>Disponible</span></div>"
-                    html_parts.append(item)
+            ocupacion = obtener_ocupacion_dia(fecha_ver_str)
+            # Un calendario por recurso: columnas por doctor o por sillón
+            ver_por = st.radio("Ver por", ["Doctor", "Sillón"], horizontal=True, key="visual_recurso", label_visibility="collapsed")
+            tipo_rec = "doctor" if ver_por == "Doctor" else "sillon"
+            recursos = list(LISTA_DOCTORES if tipo_rec == "doctor" else LISTA_SILLONES)
+            en_uso = ocupacion.recursos_en_uso(tipo_rec)
+            recursos += sorted(x for x in en_uso if x and x not in recursos)
+            if None in en_uso: recursos.append(None)
             
-            html_parts.append("</div>")
-            st.markdown("".join(html_parts), unsafe_allow_html=True)
+            cols_rec = st.columns(len(recursos))
+            for col_rec, recurso in zip(cols_rec, recursos):
+                with col_rec:
+                    st.markdown(f"**{recurso or 'Sin asignar'}**")
+                    ocupacion_map = ocupacion.bloques(slots, recurso=(tipo_rec, recurso))
+                    st.markdown(html_columna_agenda(slots, ocupacion_map, df_dia), unsafe_allow_html=True)
     
     elif menu == "2. Gestión de Pacientes":
         st.title(" 📇 Expediente Clínico Digital"); tab_b, tab_n, tab_e, tab_odo, tab_img = st.tabs(["🔍 BUSCAR", "➕ ALTA", "✏️ EDITAR", "🦷 ODONTOGRAMA", "📸 IMÁGENES"])
         with tab_b:
             # [V46.0] RESTAURACIÓN COMPLETA VISUAL ROYAL CARD
-            pacientes_raw = pd.read_sql("SELECT * FROM pacientes", conn)
-            if not pacientes_raw.empty:
-                lista_busqueda = pacientes_raw.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist(); seleccion = st.selectbox("Seleccionar:", ["..."] + lista_busqueda)
+            if obtener_etiquetas_pacientes():
+                seleccion = selector_paciente("Seleccionar:", "pac_buscar", vacia="...")
                 if seleccion != "...":
-                    id_sel_str = seleccion.split(" - ")[0]; p_data = pacientes_raw[pacientes_raw['id_paciente'] == id_sel_str].iloc[0]; st.session_state.id_paciente_activo = id_sel_str; edad, tipo_pac = calcular_edad_completa(p_data.get('fecha_nacimiento', '')); antecedentes = str(p_data.get('app', '')).strip()
+                    id_sel_str = seleccion.split(" - ")[0]; p_data = obtener_paciente(id_sel_str); st.session_state.id_paciente_activo = id_sel_str; edad, tipo_pac = calcular_edad_completa(p_data.get('fecha_nacimiento', '')); antecedentes = str(p_data.get('app', '')).strip()
                     if antecedentes and len(antecedentes) > 2 and "NEGADO" not in antecedentes.upper(): st.markdown(f"""<div class='alerta-medica'><span>🚨</span><span>ATENCIÓN CLÍNICA: {antecedentes}</span></div>""", unsafe_allow_html=True)
                     
                     # LAYOUT ASIMÉTRICO 1:2 (FOTO / DATOS)
@@ -1430,63 +3182,17 @@ def vista_consultorio():
                         </div>
                         """, unsafe_allow_html=True)
                         
-                        hoy = datetime.now(TZ_MX).date(); df_raw_notas = pd.read_sql(f"SELECT fecha, tratamiento, notas FROM citas WHERE id_paciente='{id_sel_str}' ORDER BY timestamp DESC", conn); df_raw_notas['fecha_dt'] = pd.to_datetime(df_raw_notas['fecha'], format="%d/%m/%Y", errors='coerce').dt.date; hist_notas = df_raw_notas[df_raw_notas['fecha_dt'] <= hoy].drop(columns=['fecha_dt'])
+                        clave_notas = f"notas_{id_sel_str}"
+                        hist_notas, hay_mas_notas = historial_paginado(clave_notas, obtener_notas_clinicas, id_sel_str, get_fecha_iso_mx())
+                        clave_doc_hist = f"doc_hist_{id_sel_str}"
+                        hoy_d = datetime.now(TZ_MX).date()
+                        hist_al = st.date_input("Historia al:", hoy_d, max_value=hoy_d, format="DD/MM/YYYY", key=f"hist_al_{id_sel_str}")
                         if st.button("🖨️ Descargar Historia (PDF)"): 
-                            # 1. CONSULTA SQL (ORDEN CRONOLÓGICO ASCENDENTE)
-                            # 🛡️ CORRECCIÓN #3: HISTORIAL PARAMETRIZADO
-                            query_historia = """
-                                SELECT fecha, tratamiento, notas, categoria, estatus_asistencia 
-                                FROM citas 
-                                WHERE id_paciente = ? 
-                                ORDER BY timestamp ASC
-                            """
-                            # Aquí pasamos el ID como parámetro seguro
-                            df_raw = pd.read_sql(query_historia, conn, params=(id_sel_str,))
-                            
-                            # 2. FILTRADO ESTRICTO DE EJECUCIÓN (MOTOR V47.6)
-                            if not df_raw.empty:
-                                # A) Normalización
-                                df_raw['fecha_dt'] = pd.to_datetime(df_raw['fecha'], format="%d/%m/%Y", errors='coerce')
-                                hoy_date = datetime.now(TZ_MX).date()
-                                
-                                # B) LISTA NEGRA (Términos Administrativos)
-                                palabras_prohibidas = ['ABONO', 'PAGO', 'MENSUALIDAD', 'ANTICIPO', 'DEUDA', 'SALDO', 'COTIZACION', 'PRESUPUESTO']
-                                pattern_prohibido = '|'.join(palabras_prohibidas)
-                                
-                                # --- REGLAS DE BLINDAJE ---
-                                # 1. Nada Financiero
-                                mask_cat = (df_raw['categoria'] != 'Financiero')
-                                # 2. Nada con palabras de dinero
-                                mask_txt = (~df_raw['tratamiento'].str.contains(pattern_prohibido, case=False, na=False))
-                                # 3. Fechas válidas (Pasado/Presente)
-                                mask_time = (df_raw['fecha_dt'].dt.date <= hoy_date)
-                                
-                                # 4. [CRÍTICO] SOLO TRATAMIENTOS COMPLETADOS
-                                # Esto elimina "Programada", "Pendiente" y cualquier cita futura no realizada.
-                                # Solo pasa si el doctor presionó el botón verde "Asistió" o "Llegó".
-                                mask_status = (df_raw['estatus_asistencia'] == 'Asistió')
-
-                                # Aplicar Filtros
-                                df_clean = df_raw[mask_cat & mask_txt & mask_time & mask_status].copy()
-                                
-                                # C) LIMPIEZA DE TEXTO (Relleno de notas vacías)
-                                df_clean['notas'] = df_clean['notas'].fillna("Procedimiento realizado sin incidencias.")
-                                df_clean.loc[df_clean['notas'] == "", 'notas'] = "Procedimiento realizado sin incidencias."
-                                
-                                # Selección Final
-                                hist_notas_final = df_clean[['fecha', 'tratamiento', 'notas']]
-                            else:
-                                hist_notas_final = pd.DataFrame(columns=['fecha', 'tratamiento', 'notas'])
-
-                            # 3. GENERACIÓN DEL PDF
-                            try:
-                                odo_data = obtener_estado_dientes(id_sel_str)
-                                pdf_bytes = crear_pdf_historia(p_data, hist_notas_final, odo_data)
-                            except TypeError:
-                                pdf_bytes = crear_pdf_historia(p_data, hist_notas_final)
-                                
-                            clean_name = f"{p_data['id_paciente']}_HISTORIAL_CLINICO.pdf"
-                            st.download_button("📥 Bajar PDF Historial", pdf_bytes, clean_name, "application/pdf")
+                            # Se arma en la cola de documentos: una historia larga no congela la pantalla.
+                            # Al día de hoy sale del estado vigente; a otra fecha, notas y odontograma salen del historial
+                            hasta = None if hist_al == hoy_d else hist_al.strftime("%Y-%m-%d")
+                            st.session_state[clave_doc_hist] = get_cola_documentos().enviar("historia", {"id_paciente": id_sel_str, "hasta": hasta}, f"Historia {id_sel_str}")
+                        if clave_doc_hist in st.session_state: panel_trabajo_documento(st.session_state[clave_doc_hist], "📥 Bajar PDF Historial")
                     
                     with c_hist:
                         st.markdown("#### 📜 Notas Clínicas")
@@ -1494,12 +3200,13 @@ def vista_consultorio():
                             df_notes = hist_notas[['fecha', 'tratamiento', 'notas']].copy()
                             df_notes.index = range(1, len(df_notes) + 1); df_notes.index.name = "CVO"; df_notes.columns = ["FECHA", "TRATAMIENTO", "NOTAS"]
                             st.dataframe(df_notes, use_container_width=True, hide_index=False)
+                            boton_cargar_mas(clave_notas, hay_mas_notas, len(df_notes))
                         else: st.info("Sin notas registradas.")
 
         # [V46.0] ODONTOGRAMA SIN EMOJIS
         with tab_odo:
             if 'id_paciente_activo' in st.session_state and st.session_state.id_paciente_activo:
-                p = pd.read_sql(f"SELECT * FROM pacientes WHERE id_paciente='{st.session_state.id_paciente_activo}'", conn).iloc[0]
+                p = obtener_paciente(st.session_state.id_paciente_activo)
                 edad, _ = calcular_edad_completa(p['fecha_nacimiento'])
                 st.subheader(f"Odontograma ({edad} años)")
                 if edad < 12:
@@ -1509,19 +3216,10 @@ def vista_consultorio():
                     st.info("DENTICIÓN PERMANENTE (ADULTO)")
                     dientes_sup = [18,17,16,15,14,13,12,11,21,22,23,24,25,26,27,28]; dientes_inf = [48,47,46,45,44,43,42,41,31,32,33,34,35,36,37,38]
 
-                colores = {"Sano": "⚪", "Caries": "🔴", "Resina": "🔵", "Ausente": "⚫", "Corona": "🟡"}
-                estados_pac = obtener_estado_dientes(st.session_state.id_paciente_activo)
-                
-                cols_sup = st.columns(len(dientes_sup))
-                for idx, d in enumerate(dientes_sup):
-                    est = estados_pac.get(str(d), "Sano")
-                    if cols_sup[idx].button(f"{colores[est]}\n{d}", key=f"d_{d}"): actualizar_diente(st.session_state.id_paciente_activo, str(d)); st.rerun()
+                editor_odontograma(st.session_state.id_paciente_activo, dientes_sup, dientes_inf)
                 st.divider()
-                cols_inf = st.columns(len(dientes_inf))
-                for idx, d in enumerate(dientes_inf):
-                    est = estados_pac.get(str(d), "Sano")
-                    if cols_inf[idx].button(f"{colores[est]}\n{d}", key=f"d_{d}"): actualizar_diente(st.session_state.id_paciente_activo, str(d)); st.rerun()
-                st.caption("Clic para cambiar: ⚪Sano -> 🔴Caries -> 🔵Resina -> ⚫Ausente -> 🟡Corona")
+                if edad < 12: st.caption("El periodontograma se registra solo en dentición permanente.")
+                else: panel_periodontograma(st.session_state.id_paciente_activo)
             else: st.warning("Seleccione un paciente primero.")
 
         # ... (Resto de tabs Alta/Editar/Imagenes V41 intactos) ...
@@ -1551,13 +3249,12 @@ def vista_consultorio():
                     else: base_10 = calcular_rfc_10(nombre, paterno, materno, nacimiento); homo_sufijo = formato_nombre_legal(homoclave) if homoclave else "XXX"; rfc_final = base_10 + homo_sufijo
                     nuevo_id = generar_id_unico(nombre, paterno, nacimiento); c = conn.cursor()
                     c.execute("INSERT INTO pacientes (id_paciente, fecha_registro, nombre, apellido_paterno, apellido_materno, telefono, email, rfc, regimen, uso_cfdi, cp, nota_fiscal, sexo, estado, fecha_nacimiento, antecedentes_medicos, ahf, app, apnp, ocupacion, estado_civil, domicilio, tutor, contacto_emergencia, motivo_consulta, exploracion_fisica, diagnostico, parentesco_tutor, telefono_emergencia) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", (nuevo_id, get_fecha_mx(), formato_nombre_legal(nombre), formato_nombre_legal(paterno), formato_nombre_legal(materno), tel, limpiar_email(email), rfc_final, regimen, uso_cfdi, cp, "", sexo, "Activo", format_date_latino(nacimiento), "", formato_oracion(ahf), formato_oracion(app), formato_oracion(apnp), formato_titulo(ocupacion), estado_civil, formato_titulo(domicilio), formato_nombre_legal(tutor), formato_nombre_legal(contacto_emer_nom), formato_oracion(motivo_consulta), formato_oracion(exploracion), formato_oracion(diagnostico), parentesco, contacto_emer_tel))
-                    conn.commit(); st.success(f"✅ Paciente {nombre} guardado."); time.sleep(1.5); st.rerun()
+                    conn.commit(); paciente_actualizado(nuevo_id); st.success(f"✅ Paciente {nombre} guardado."); time.sleep(1.5); st.rerun()
         with tab_e:
-            pacientes_raw = pd.read_sql("SELECT * FROM pacientes", conn)
-            if not pacientes_raw.empty:
-                lista_edit = pacientes_raw.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist(); sel_edit = st.selectbox("Buscar Paciente:", ["Select..."] + lista_edit)
+            if obtener_etiquetas_pacientes():
+                sel_edit = selector_paciente("Buscar Paciente:", "pac_editar", vacia="Select...")
                 if sel_edit != "Select...":
-                    id_target = sel_edit.split(" - ")[0]; p = pacientes_raw[pacientes_raw['id_paciente'] == id_target].iloc[0]
+                    id_target = sel_edit.split(" - ")[0]; p = obtener_paciente(id_target)
                     with st.form("form_editar_full"):
                         st.info("Editando a: " + p['nombre']); ec1, ec2, ec3 = st.columns(3); e_nom = ec1.text_input("Nombre", p['nombre']); e_pat = ec2.text_input("A. Paterno", p['apellido_paterno']); e_mat = ec3.text_input("A. Materno", p['apellido_materno']); ec4, ec5 = st.columns(2); e_tel = ec4.text_input("Teléfono", p['telefono']); e_email = ec5.text_input("Email", p['email']); st.markdown("**Médico & Contacto**"); e_app = st.text_area("APP", p['app'] if p['app'] else ""); e_ahf = st.text_area("AHF", p['ahf'] if p['ahf'] else ""); e_apnp = st.text_area("APNP", p['apnp'] if p['apnp'] else ""); cem1, cem2 = st.columns(2); e_cont_nom = cem1.text_input("Nombre Contacto Emergencia", p.get('contacto_emergencia', '')); e_cont_tel = cem2.text_input("Tel Emergencia", p.get('telefono_emergencia', '')); st.markdown("**Fiscal**"); ec6, ec7, ec8 = st.columns(3); e_rfc = ec6.text_input("RFC Completo", p['rfc']); e_cp = ec7.text_input("C.P.", p['cp']); idx_reg = 0; reg_list = get_regimenes_fiscales()
                         if p['regimen'] in reg_list: idx_reg = reg_list.index(p['regimen'])
@@ -1567,37 +3264,25 @@ def vista_consultorio():
                             with db_transaction() as conn:
                                 c = conn.cursor()
                                 c.execute("INSERT INTO pacientes (id_paciente, fecha_registro, nombre, apellido_paterno, apellido_materno, telefono, email, rfc, regimen, uso_cfdi, cp, nota_fiscal, sexo, estado, fecha_nacimiento, antecedentes_medicos, ahf, app, apnp, ocupacion, estado_civil, domicilio, tutor, contacto_emergencia, motivo_consulta, exploracion_fisica, diagnostico, parentesco_tutor, telefono_emergencia) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", (nuevo_id, get_fecha_mx(), formato_nombre_legal(nombre), formato_nombre_legal(paterno), formato_nombre_legal(materno), tel, limpiar_email(email), rfc_final, regimen, uso_cfdi, cp, "", sexo, "Activo", format_date_latino(nacimiento), "", formato_oracion(ahf), formato_oracion(app), formato_oracion(apnp), formato_titulo(ocupacion), estado_civil, formato_titulo(domicilio), formato_nombre_legal(tutor), formato_nombre_legal(contacto_emer_nom), formato_oracion(motivo_consulta), formato_oracion(exploracion), formato_oracion(diagnostico), parentesco, contacto_emer_tel))
-                            
+                            paciente_actualizado(nuevo_id); paciente_actualizado(id_target)
                             st.success(f"✅ Paciente {nombre} guardado (Blindado)."); time.sleep(1.5); st.rerun()
                                                         
                             #PENDIENTE POR CUALQUIER COSA c = conn.cursor(); c.execute("UPDATE pacientes SET nombre=?, apellido_paterno=?, apellido_materno=?, telefono=?, email=?, app=?, ahf=?, apnp=?, rfc=?, cp=?, regimen=?, contacto_emergencia=?, telefono_emergencia=? WHERE id_paciente=?", (formato_nombre_legal(e_nom), formato_nombre_legal(e_pat), formato_nombre_legal(e_mat), formatear_telefono_db(e_tel), limpiar_email(e_email), formato_oracion(e_app), formato_oracion(e_ahf), formato_oracion(e_apnp), formato_nombre_legal(e_rfc), e_cp, e_reg, formato_nombre_legal(e_cont_nom), e_cont_tel, id_target)); conn.commit(); st.success("Datos actualizados."); time.sleep(1.5); st.rerun()
 
         with tab_img:
-            if 'id_paciente_activo' in st.session_state:
-                id_p = str(st.session_state.id_paciente_activo)
-                uploaded = st.file_uploader("Subir Archivo", type=['png','jpg','jpeg','pdf'])
-                if uploaded:
-                    path = os.path.join(CARPETA_PACIENTES, id_p)
-                    if not os.path.exists(path): os.makedirs(path)
-                    with open(os.path.join(path, uploaded.name), "wb") as f: f.write(uploaded.getbuffer())
-                    st.success("Guardado"); time.sleep(1); st.rerun()
-                
-                path = os.path.join(CARPETA_PACIENTES, id_p)
-                if os.path.exists(path):
-                    for f in os.listdir(path): st.image(os.path.join(path,f), caption=f, width=200)
+            if 'id_paciente_activo' in st.session_state and st.session_state.id_paciente_activo:
+                galeria_archivos(str(st.session_state.id_paciente_activo))
 
     elif menu == "5. Recetas":
         # ... (Mantener V44 que funciona) ...
         st.title("📝 Prescripción Clínica")
-        pacientes = pd.read_sql("SELECT id_paciente, nombre, apellido_paterno FROM pacientes", conn)
-        if not pacientes.empty:
-            lista_pacientes = pacientes.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist()
-            paciente_sel_farm = st.selectbox("Seleccionar Paciente para Receta:", ["Seleccionar..."] + lista_pacientes)
+        if obtener_etiquetas_pacientes():
+            paciente_sel_farm = selector_paciente("Seleccionar Paciente para Receta:", "pac_receta")
             
             if paciente_sel_farm != "Seleccionar...":
                 id_p = paciente_sel_farm.split(" - ")[0]
                 st.session_state.id_paciente_activo = id_p 
-                p = pd.read_sql(f"SELECT * FROM pacientes WHERE id_paciente='{id_p}'", conn).iloc[0]
+                p = obtener_paciente(id_p)
                 edad, _ = calcular_edad_completa(p['fecha_nacimiento'])
                 with st.container(border=True):
                     c1, c2 = st.columns(2)
@@ -1606,6 +3291,7 @@ def vista_consultorio():
                     texto_medicamentos = st.text_area("Cuerpo de la Receta (Editable)", value=MEDICAMENTOS_DB[combo_sel], height=150)
                     indicacion_sel = st.selectbox("Hoja de Cuidados (Página 2)", list(INDICACIONES_DB.keys()))
                     texto_indicaciones = INDICACIONES_DB[indicacion_sel] 
+                    clave_doc_receta = f"doc_receta_{id_p}"
                     if st.button("🖨️ Generar Receta + Indicaciones (PDF)"):
                         info_doc = DOCS_INFO[doc_sel]
                         datos_receta = {
@@ -1613,15 +3299,17 @@ def vista_consultorio():
                             "paciente_nombre": f"{p['nombre']} {p['apellido_paterno']} {p['apellido_materno']}", "edad": edad, "fecha": get_fecha_mx(),
                             "medicamentos": texto_medicamentos, "indicaciones": texto_indicaciones
                         }
-                        pdf_bytes = crear_pdf_receta(datos_receta); st.download_button("Descargar PDF Receta", pdf_bytes, f"RECETA_{p['nombre']}.pdf", "application/pdf")
+                        # Como la historia: el PDF se arma en la cola de documentos, no en el hilo de la sesión
+                        st.session_state[clave_doc_receta] = get_cola_documentos().enviar("receta", {"datos": datos_receta, "nombre_archivo": f"RECETA_{p['nombre']}.pdf"}, f"Receta {id_p}")
+                    if clave_doc_receta in st.session_state: panel_trabajo_documento(st.session_state[clave_doc_receta], "Descargar PDF Receta")
             else: st.info("Seleccione un paciente para comenzar.")
 
     elif menu == "4. Tratamientos":
         st.title(" 🩺 Ejecución Clínica & Cobros")
-        pacientes = pd.read_sql("SELECT * FROM pacientes", conn); servicios = pd.read_sql("SELECT * FROM servicios", conn)
+        servicios = pd.read_sql("SELECT * FROM servicios", conn)
+        sel = selector_paciente("Paciente:", "pac_trat", vacia=None) if obtener_etiquetas_pacientes() else None
         
-        if not pacientes.empty:
-            sel = st.selectbox("Paciente:", pacientes.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist())
+        if sel:
             id_p = sel.split(" - ")[0]; nom_p = sel.split(" - ")[1]; st.session_state.id_paciente_activo = id_p
             
             # --- SEMÁFORO FINANCIERO PROFESIONAL ---
@@ -1629,9 +3317,9 @@ def vista_consultorio():
             
             # Calcular deuda real
             # 🛡️ CORRECCIÓN #4: CÁLCULO DE DEUDA PARAMETRIZADO
-            query_deuda = "SELECT SUM(saldo_pendiente) FROM citas WHERE id_paciente = ? AND estado_pago != 'CANCELADO'"
-            deuda_total = pd.read_sql(query_deuda, conn, params=(id_p,)).iloc[0,0]
-            if deuda_total is None: deuda_total = 0.0
+            # Libro de saldos: una búsqueda por llave en lugar de SUM sobre todas sus citas
+            saldo_p = obtener_saldo_paciente(id_p)
+            deuda_total = saldo_p['saldo']
             
             # Semáforo
             if deuda_total > 0:
@@ -1640,7 +3328,7 @@ def vista_consultorio():
                 st.success("🎉 **CUENTA AL CORRIENTE:** El paciente no tiene adeudos pendientes.")
             
             # --- CAJÓN DE OBSERVACIONES ADMINISTRATIVAS (PERSISTENTE) ---
-            p_actual = pacientes[pacientes['id_paciente'] == id_p].iloc[0]
+            p_actual = obtener_paciente(id_p)
             nota_actual = p_actual.get('nota_administrativa', '')
             if nota_actual is None: nota_actual = ""
             
@@ -1653,7 +3341,7 @@ def vista_consultorio():
                     if st.form_submit_button("💾 Actualizar Observaciones"):
                         c = conn.cursor()
                         c.execute("UPDATE pacientes SET nota_administrativa = ? WHERE id_paciente = ?", (obs_admin_persistent, id_p))
-                        conn.commit()
+                        conn.commit(); paciente_actualizado(id_p)
                         st.success("Observaciones actualizadas.")
                         time.sleep(0.5); st.rerun()
             # ------------------------------------------------
@@ -1668,7 +3356,8 @@ def vista_consultorio():
                         cat_sel = col_up1.selectbox("Categoría", servicios['categoria'].unique()); filt = servicios[servicios['categoria'] == cat_sel]
                         trat_sel = col_up2.selectbox("Tratamiento", filt['nombre_tratamiento'].unique())
                         item = filt[filt['nombre_tratamiento'] == trat_sel].iloc[0]; precio_sug = float(item['precio_lista']); costo_lab = float(item['costo_laboratorio_base'])
-                    else: cat_sel = "Manual"; trat_sel = col_up2.text_input("Tratamiento"); precio_sug = 0.0; costo_lab = 0.0
+                        dur_cita = duracion_valida(item['duracion'])
+                    else: cat_sel = "Manual"; trat_sel = col_up2.text_input("Tratamiento"); precio_sug = 0.0; costo_lab = 0.0; dur_cita = 30
                     doc_name = col_up3.selectbox("Doctor", ["Dr. Emmanuel", "Dra. Mónica"])
 
                     st.divider()
@@ -1676,11 +3365,16 @@ def vista_consultorio():
                     # Lógica de Agendar Próxima Cita (Fuera del form)
                     c_ag1, c_ag2 = st.columns([1, 3])
                     agendar = c_ag1.checkbox("¿Agendar Próxima Cita?", key="check_agendar_dinamico") 
-                    f_cita = datetime.now(TZ_MX); h_cita = "00:00"
+                    f_cita = datetime.now(TZ_MX); h_cita = "00:00"; sillon_futura = None; bloquear_cobro = False
                     if agendar:
                         c7, c8 = c_ag2.columns(2)
                         f_cita = c7.date_input("Fecha Cita", datetime.now(TZ_MX), min_value=datetime.now(TZ_MX).date())
                         h_cita = c8.selectbox("Hora Cita", generar_slots_tiempo())
+                        # Misma regla que la agenda: duración del tratamiento, doctor y sillón sin empalmes (salvo urgencia)
+                        sillon_futura = asignar_sillon(format_date_latino(f_cita), h_cita, dur_cita, doc_name)
+                        if verificar_disponibilidad(format_date_latino(f_cita), h_cita, dur_cita, doc_name) or not sillon_futura:
+                            c_ag2.error(f"⚠️ Horario OCUPADO para la próxima cita ({dur_cita} min, doctor o sillón). Elija otra hora o marque 'Urgencia'.")
+                            bloquear_cobro = not c_ag2.checkbox("🚨 Agendar como Urgencia (Permitir cruce)", key="urg_cita_cobro")
 
                     # 2. FORMULARIO DE COBRO (Todo debe estar indentado dentro del 'with')
                     with st.form("cobro", clear_on_submit=True):
@@ -1721,7 +3415,7 @@ def vista_consultorio():
                         obs_admin = col_nota2.text_area("👁️ Observación (Interno)", height=80, placeholder="Ej: Autorización especial...")
 
                         # --- BOTÓN DE ENVÍO (DENTRO DEL FORM) ---
-                        submitted = st.form_submit_button("Registrar Cobro y Evolución")
+                        submitted = st.form_submit_button("Registrar Cobro y Evolución", disabled=bloquear_cobro)
                         
                         if submitted:
                             # Validaciones Finales al presionar
@@ -1733,19 +3427,27 @@ def vista_consultorio():
                             # Insertamos Cobro
                             c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, categoria, tratamiento, doctor_atendio, precio_lista, precio_final, porcentaje, metodo_pago, estado_pago, notas, observaciones, monto_pagado, saldo_pendiente, fecha_pago, costo_laboratorio) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
                                       (int(time.time()), get_fecha_mx(), get_hora_mx(), id_p, nom_p, cat_sel, trat_sel, doc_name, precio_sug, precio, 0, metodo, estatus, formato_oracion(notas), formato_oracion(obs_admin), abono, saldo, get_fecha_mx(), costo_lab))
+                            resumen_aplicar_cita(c, c.lastrowid)
+                            saldo_aplicar(c, id_p, precio, abono, saldo, int(time.time()))
                             
                             # Insertamos Cita Futura si aplica
+                            rowid_futura = None
                             if agendar: 
-                                c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, tipo, tratamiento, doctor_atendio, estado_pago, categoria, estatus_asistencia, notas) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', 
-                                          (int(time.time())+1, format_date_latino(f_cita), h_cita, id_p, nom_p, "Tratamiento", trat_sel, doc_name, "Pendiente", cat_sel, "Programada", f"Cita agendada. Obs: {obs_admin}"))
+                                sillon_futura = sillon_futura or LISTA_SILLONES[0]  # Solo llega aquí sin sillón si se marcó urgencia
+                                c.execute('''INSERT INTO citas (timestamp, fecha, hora, id_paciente, nombre_paciente, tipo, tratamiento, doctor_atendio, sillon, estado_pago, categoria, estatus_asistencia, notas, duracion) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
+                                          (int(time.time())+1, format_date_latino(f_cita), h_cita, id_p, nom_p, "Tratamiento", trat_sel, doc_name, sillon_futura, "Pendiente", cat_sel, "Programada", f"Cita agendada. Obs: {obs_admin}", dur_cita))
+                                rowid_futura = c.lastrowid
                             
                             conn.commit()
+                            invalidar_agenda(get_fecha_mx())
+                            if rowid_futura: agenda_cita_agregada(format_date_latino(f_cita), rowid_futura, h_cita, dur_cita, doc_name, sillon_futura)
                             st.success("✅ Registrado correctamente")
                             time.sleep(1)
                             st.rerun()
             with tab_abono:
                  with st.container(border=True):
-                    deudas = pd.read_sql(f"SELECT rowid, fecha, tratamiento, saldo_pendiente FROM citas WHERE id_paciente='{id_p}' AND saldo_pendiente > 0 AND estado_pago != 'CANCELADO'", conn)
+                    # Solo se buscan cuentas abiertas si el libro dice que hay deuda
+                    deudas = pd.read_sql("SELECT rowid, fecha, tratamiento, saldo_pendiente FROM citas WHERE id_paciente = ? AND saldo_pendiente > 0 AND estado_pago != 'CANCELADO'", conn, params=(id_p,)) if deuda_total > 0 else pd.DataFrame()
                     if not deudas.empty:
                         lista_deudas = deudas.apply(lambda x: f"ID: {x['rowid']} | {x['fecha']} | {x['tratamiento']} | Resta: ${x['saldo_pendiente']}", axis=1).tolist()
                         deuda_sel = st.selectbox("Seleccionar Cuenta por Cobrar:", lista_deudas)
@@ -1763,41 +3465,47 @@ def vista_consultorio():
                                 st.error(mensaje)
                             else:
                                 try:
-                                    c = conn.cursor()
+                                    # Saldo, recibo del abono, libro de saldos y auditoría: todo o nada
+                                    with db_transaction() as conn_tx:
+                                        c = conn_tx.cursor()
                                     
-                                    # Calculamos nuevo saldo y estado
-                                    nuevo_saldo = saldo_actual - monto_abono
-                                    # Corrección para evitar saldos negativos por centavos (-0.0001)
-                                    if nuevo_saldo < 0: nuevo_saldo = 0
+                                        # Calculamos nuevo saldo y estado
+                                        nuevo_saldo = saldo_actual - monto_abono
+                                        # Corrección para evitar saldos negativos por centavos (-0.0001)
+                                        if nuevo_saldo < 0: nuevo_saldo = 0
                                     
-                                    nuevo_estado = "Pagado" if nuevo_saldo <= 0 else "Pendiente"
+                                        nuevo_estado = "Pagado" if nuevo_saldo <= 0 else "Pendiente"
                                     
-                                    # A. Actualizar la deuda original
-                                    c.execute("UPDATE citas SET saldo_pendiente = ?, estado_pago = ? WHERE rowid = ?", 
-                                              (nuevo_saldo, nuevo_estado, id_row_target))
+                                        # A. Actualizar la deuda original
+                                        resumen_aplicar_cita(c, id_row_target, -1)
+                                        c.execute("UPDATE citas SET saldo_pendiente = ?, estado_pago = ? WHERE rowid = ?", 
+                                                  (nuevo_saldo, nuevo_estado, id_row_target))
+                                        resumen_aplicar_cita(c, id_row_target)
                                     
-                                    # B. Insertar el registro del pago (Historial)
-                                    texto_concepto = f"ABONO A: {row_deuda['tratamiento']}"
+                                        # B. Insertar el registro del pago (Historial)
+                                        texto_concepto = f"ABONO A: {row_deuda['tratamiento']}"
                                     
-                                    c.execute('''INSERT INTO citas (
-                                        timestamp, fecha, hora, id_paciente, nombre_paciente, 
-                                        categoria, tratamiento, doctor_atendio, precio_lista, 
-                                        precio_final, porcentaje, metodo_pago, estado_pago, 
-                                        notas, observaciones, monto_pagado, saldo_pendiente, 
-                                        fecha_pago, costo_laboratorio
-                                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
-                                    (
-                                        int(time.time()), get_fecha_mx(), get_hora_mx(), id_p, nom_p, 
-                                        "Financiero", texto_concepto, "Caja", 0, 0, 0, metodo_abono, 
-                                        "Pagado", "", "Abono registrado", monto_abono, 0, get_fecha_mx(), 0
-                                    ))
+                                        c.execute('''INSERT INTO citas (
+                                            timestamp, fecha, hora, id_paciente, nombre_paciente, 
+                                            categoria, tratamiento, doctor_atendio, precio_lista, 
+                                            precio_final, porcentaje, metodo_pago, estado_pago, 
+                                            notas, observaciones, monto_pagado, saldo_pendiente, 
+                                            fecha_pago, costo_laboratorio
+                                        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
+                                        (
+                                            int(time.time()), get_fecha_mx(), get_hora_mx(), id_p, nom_p, 
+                                            "Financiero", texto_concepto, "Caja", 0, 0, 0, metodo_abono, 
+                                            "Pagado", "", "Abono registrado", monto_abono, 0, get_fecha_mx(), 0
+                                        ))
+                                        resumen_aplicar_cita(c, c.lastrowid)
+                                        saldo_aplicar(c, id_p, 0, monto_abono, nuevo_saldo - saldo_actual, int(time.time()))
                                     
-                                    # C. Auditoría de Seguridad
-                                    usuario_audit = st.session_state.get('perfil', 'SISTEMA')
-                                    detalle_audit = f"Paciente: {id_p} | Abono: ${monto_abono:,.2f} | Nuevo Saldo: ${nuevo_saldo:,.2f} | Método: {metodo_abono}"
-                                    registrar_auditoria(usuario_audit, "ABONO_REGISTRADO", detalle_audit)
+                                        # C. Auditoría de Seguridad
+                                        usuario_audit = st.session_state.get('perfil', 'SISTEMA')
+                                        detalle_audit = f"Paciente: {id_p} | Abono: ${monto_abono:,.2f} | Nuevo Saldo: ${nuevo_saldo:,.2f} | Método: {metodo_abono}"
+                                        registrar_auditoria(usuario_audit, "ABONO_REGISTRADO", detalle_audit, conn=conn_tx)
                                     
-                                    conn.commit()
+                                    invalidar_agenda(row_deuda['fecha'], get_fecha_mx())
                                     st.success("✅ Abono registrado y auditado correctamente")
                                     time.sleep(1.5)
                                     st.rerun()
@@ -1808,26 +3516,15 @@ def vista_consultorio():
             st.divider()
             with st.container(border=True):
                 st.markdown("#### 📊 Historial de Movimientos")
-                # 🛡️ CORRECCIÓN #5: HISTORIAL FINANCIERO PARAMETRIZADO
-                query_movs = """
-                    SELECT rowid, fecha, tratamiento, doctor_atendio, precio_final, 
-                            monto_pagado, saldo_pendiente, metodo_pago 
-                    FROM citas 
-                    WHERE id_paciente = ? 
-                        AND estado_pago != 'CANCELADO' 
-                        AND (precio_final > 0 OR monto_pagado > 0) 
-                    ORDER BY timestamp DESC
-                """
-                df_f = pd.read_sql(query_movs, conn, params=(id_p,))
+                # 🛡️ CORRECCIÓN #5: HISTORIAL FINANCIERO PARAMETRIZADO (paginado: primera página inmediata, 'Cargar más' bajo demanda)
+                clave_movs = f"movs_{id_p}"
+                df_f, hay_mas_movs = historial_paginado(clave_movs, obtener_movimientos_financieros, id_p)
                 if not df_f.empty:
                     # Preparar datos (copia para no afectar cálculos)
                     df_show = df_f[['rowid', 'fecha', 'tratamiento', 'precio_final', 'monto_pagado', 'saldo_pendiente', 'metodo_pago']].copy()
                     
-                    # FORMATO CONTABLE ESTRICTO (Con comas: $1,234.56)
-                    # Convertimos a texto para forzar la visualización exacta que pides
-                    df_show['precio_final'] = df_show['precio_final'].apply(lambda x: f"${x:,.2f}")
-                    df_show['monto_pagado'] = df_show['monto_pagado'].apply(lambda x: f"${x:,.2f}")
-                    df_show['saldo_pendiente'] = df_show['saldo_pendiente'].apply(lambda x: f"${x:,.2f}")
+                    # FORMATO CONTABLE ESTRICTO (Con comas: $1,234.56), columna completa a la vez
+                    for col in ['precio_final', 'monto_pagado', 'saldo_pendiente']: df_show[col] = formato_moneda(df_show[col])
                     
                     st.dataframe(
                         df_show,
@@ -1844,35 +3541,28 @@ def vista_consultorio():
                         }
                     )
                     
-                    # ... (Aquí sigue la lógica del PDF que ya tienes: opciones_recibo, etc.)
+                    boton_cargar_mas(clave_movs, hay_mas_movs, len(df_show))
                     
                     st.caption("🖨️ Generar Recibo de Pago")
-                    opciones_recibo = df_f.apply(lambda x: f"{x['fecha']} | {x['tratamiento']} | Abono: ${x['monto_pagado']:,.2f} ({x['metodo_pago']})", axis=1).tolist()
+                    opciones_recibo = (df_f['fecha'].fillna("").astype(str) + " | " + df_f['tratamiento'].fillna("").astype(str) + " | Abono: " + df_show['monto_pagado'] + " (" + df_f['metodo_pago'].fillna("-").astype(str) + ")").tolist()
                     sel_recibo = st.selectbox("Seleccionar Movimiento:", opciones_recibo)
+                    clave_doc_recibo = f"doc_recibo_{id_p}"
                     if st.button("Descargar Recibo Seleccionado"):
-                        index_sel = opciones_recibo.index(sel_recibo); row_sel = df_f.iloc[index_sel]; p_info = pacientes[pacientes['id_paciente'] == id_p].iloc[0]
-                        fecha_corte = row_sel['fecha']
-                        items_hoy = df_f[df_f['fecha'] == fecha_corte].to_dict('records')
-                        items_deuda = df_f[(df_f['saldo_pendiente'] > 0) & (df_f['fecha'] != fecha_corte)].to_dict('records')
-                        total_tratamiento_hoy = sum(item['precio_final'] for item in items_hoy)
-                        total_pagado_hoy = sum(item['monto_pagado'] for item in items_hoy)
-                        saldo_total_global = df_f['saldo_pendiente'].sum()
-                        datos_pdf = { "paciente": f"{p_info['nombre']} {p_info['apellido_paterno']} {p_info['apellido_materno']}", "rfc": p_info.get('rfc', 'XAXX010101000'), "folio": f"RD-{int(time.time())}-{row_sel['rowid']}", "fecha": fecha_corte, "items_hoy": items_hoy, "items_deuda": items_deuda, "total_tratamiento_hoy": total_tratamiento_hoy, "total_pagado_hoy": total_pagado_hoy, "saldo_total_global": saldo_total_global }
-                        pdf_bytes = crear_recibo_pago(datos_pdf); clean_name = f"RECIBO_{datos_pdf['folio']}.pdf"; st.download_button("📥 Bajar PDF", pdf_bytes, clean_name, "application/pdf")
+                        index_sel = opciones_recibo.index(sel_recibo); row_sel = df_f.iloc[index_sel]
+                        # El recibo no depende de cuántas páginas se cargaron: el día de corte y las deudas salen de SQL (en el proceso de la cola)
+                        st.session_state[clave_doc_recibo] = get_cola_documentos().enviar("recibo", {"id_paciente": id_p, "fecha": row_sel['fecha'], "rowid": int(row_sel['rowid']), "saldo_total": float(deuda_total)}, f"Recibo {id_p}")
+                    if clave_doc_recibo in st.session_state: panel_trabajo_documento(st.session_state[clave_doc_recibo], "📥 Bajar PDF")
                 else: st.info("No hay movimientos financieros registrados.")
                     
     elif menu == "3. Consentimientos":
         st.title(" ✒️  Autorización de Tratamientos")
-        df_p = pd.read_sql("SELECT * FROM pacientes", conn)
-        
-        if not df_p.empty:
+        if obtener_etiquetas_pacientes():
             # Selector de Paciente
-            lista_pacientes = df_p.apply(lambda x: f"{x['id_paciente']} - {x['nombre']} {x['apellido_paterno']}", axis=1).tolist()
-            sel = st.selectbox("Paciente:", ["..."] + lista_pacientes)
+            sel = selector_paciente("Paciente:", "pac_consent", vacia="...")
             
             if sel != "...":
                 id_target = sel.split(" - ")[0]
-                p_obj = df_p[df_p['id_paciente'] == id_target].iloc[0]
+                p_obj = obtener_paciente(id_target)
                 st.session_state.id_paciente_activo = id_target
                 
                 # Selector de Documento
@@ -2004,6 +3694,7 @@ RESPONSABLE: ROYAL DENTAL, con domicilio en {DIRECCION_CONSULTORIO}.
                                     t2_name = st.text_input("Nombre Testigo 2")
                                     canvas_t2 = st_canvas(stroke_width=2, height=150, width=300, drawing_mode="freedraw", key="firma_testigo2")
 
+                        clave_doc_consent = f"doc_consent_{p_obj['id_paciente']}"
                         if st.button("🖨️ Generar PDF Legal Firmado", type="primary"):
                             bloqueo = False
                             if "Consentimiento" in tipo_doc and nivel_riesgo == 'HIGH_RISK':
@@ -2014,12 +3705,9 @@ RESPONSABLE: ROYAL DENTAL, con domicilio en {DIRECCION_CONSULTORIO}.
                                 # Procesar Imagenes
                                 img_pac=None; img_doc=None; img_t1=None; img_t2=None
                                 
-                                # Helper para procesar firma
+                                # Helper para procesar firma: recorte y reducción en memoria, una vez por lienzo
                                 def procesar_canvas(cv):
-                                    if cv is not None and cv.image_data is not None and not np.all(cv.image_data[:,:,3] == 0):
-                                        img = Image.fromarray(cv.image_data.astype('uint8'), 'RGBA')
-                                        buf = io.BytesIO(); img.save(buf, format="PNG")
-                                        return base64.b64encode(buf.getvalue()).decode()
+                                    if cv is not None and cv.image_data is not None: return procesar_firma_digital(cv.image_data)
                                     return None
 
                                 img_pac = procesar_canvas(canvas_pac)
@@ -2036,12 +3724,15 @@ RESPONSABLE: ROYAL DENTAL, con domicilio en {DIRECCION_CONSULTORIO}.
                                 edad_actual, _ = calcular_edad_completa(p_obj['fecha_nacimiento'])
                                 tutor_info = {'nombre': p_obj.get('tutor', ''), 'relacion': p_obj.get('parentesco_tutor', '')}
                                 
-                                # Generar PDF
-                                pdf_bytes = crear_pdf_consentimiento(nombre_paciente_full, doc_full, cedula_full, tipo_doc, tratamiento_legal, riesgo_legal, img_pac, img_doc, testigos_dict, nivel_riesgo, edad_actual, tutor_info)
+                                # Generar PDF en la cola de documentos (las firmas ya recortadas viajan como imágenes PIL)
                                 prefix = "CONSENTIMIENTO" if "Consentimiento" in tipo_doc else "AVISO_PRIVACIDAD"
                                 clean_filename = f"{prefix}_{formato_nombre_legal(p_obj['nombre'])}_{formato_nombre_legal(p_obj['apellido_paterno'])}.pdf".replace(" ", "_")
-                                st.success("✅ Documento generado y firmado legalmente.")
-                                st.download_button("📥 Descargar PDF Firmado", pdf_bytes, clean_filename, "application/pdf")
+                                argumentos = {"paciente_full": nombre_paciente_full, "nombre_doctor": doc_full, "cedula_doctor": cedula_full, "tipo_doc": tipo_doc,
+                                              "tratamientos_str": tratamiento_legal, "riesgos_str": riesgo_legal, "firma_pac": img_pac, "firma_doc": img_doc,
+                                              "testigos_data": testigos_dict, "nivel_riesgo": nivel_riesgo, "edad_paciente": edad_actual, "tutor_info": tutor_info}
+                                st.session_state[clave_doc_consent] = get_cola_documentos().enviar("consentimiento", {"argumentos": argumentos, "nombre_archivo": clean_filename}, f"{prefix} {p_obj['id_paciente']}")
+                                st.success("✅ Documento firmado legalmente; generando PDF...")
+                        if clave_doc_consent in st.session_state: panel_trabajo_documento(st.session_state[clave_doc_consent], "📥 Descargar PDF Firmado")
                 
     elif menu == "6. Control Asistencia":
         st.title("🆔 Asistencia")
@@ -2059,9 +3750,127 @@ RESPONSABLE: ROYAL DENTAL, con domicilio en {DIRECCION_CONSULTORIO}.
     
     conn.close()
 
+# ==========================================
+# 7. VISTA ADMINISTRACIÓN
+# ==========================================
+@st.fragment
+def tablero_financiero():
+    """Producción, cobranza, saldo, costo de laboratorio y margen desde resumen_financiero (nunca recorre citas)"""
+    st.subheader("📊 Tablero Financiero")
+    hoy = datetime.now(TZ_MX).date()
+    f1, f2, f3 = st.columns([2, 1, 1])
+    rango = f1.date_input("Rango", (hoy.replace(day=1) - timedelta(days=180), hoy), format="DD/MM/YYYY", key="tab_fin_rango")
+    periodo = f2.selectbox("Periodo", list(PERIODOS_TABLERO), index=1, key="tab_fin_periodo")
+    desglose = f3.selectbox("Desglose", ["Total"] + list(DESGLOSES_TABLERO), index=1, key="tab_fin_desglose")
+    if len(rango) != 2: st.info("Seleccione fecha inicial y final."); return
+    df = obtener_resumen_financiero(rango[0].strftime("%Y-%m-%d"), rango[1].strftime("%Y-%m-%d"), periodo, desglose)
+    if df.empty: st.info("Sin movimientos en el rango."); return
+    tot = df[COLUMNAS_RESUMEN + ['margen']].sum()
+    k1, k2, k3, k4, k5 = st.columns(5)
+    k1.metric("Producción", f"${tot['cargos']:,.2f}"); k2.metric("Cobrado", f"${tot['cobrado']:,.2f}")
+    k3.metric("Saldo pendiente", f"${tot['saldo']:,.2f}"); k4.metric("Costo laboratorio", f"${tot['costo_lab']:,.2f}")
+    k5.metric("Margen", f"${tot['margen']:,.2f}")
+    por_periodo = df.groupby('periodo')[COLUMNAS_RESUMEN + ['margen']].sum().reset_index()
+    st.plotly_chart(px.line(por_periodo, x="periodo", y=["cargos", "cobrado", "saldo", "costo_lab", "margen"], markers=True,
+                            labels={"periodo": periodo, "value": "$", "variable": ""}, title=f"Flujo por {periodo.lower()}"), use_container_width=True)
+    col = DESGLOSES_TABLERO.get(desglose)
+    if col:
+        g1, g2 = st.columns(2)
+        g1.plotly_chart(px.bar(df, x="periodo", y="cargos", color=col, labels={"periodo": periodo, "cargos": "Producción $"},
+                               title=f"Producción por {desglose.lower()}"), use_container_width=True)
+        g2.plotly_chart(px.bar(df, x="periodo", y="cobrado", color=col, labels={"periodo": periodo, "cobrado": "Cobrado $"},
+                               title=f"Cobrado por {desglose.lower()}"), use_container_width=True)
+        tabla = df.groupby(col)[COLUMNAS_RESUMEN + ['margen']].sum().reset_index().sort_values('cargos', ascending=False)
+        st.dataframe(tabla, use_container_width=True, hide_index=True)
+    st.caption("Cobrado incluye los abonos (categoría Financiero, doctor Caja) en la fecha en que se recibieron.")
+
+def vista_administracion():
+    st.title("Admin")
+    tablero_financiero()
+    st.subheader("📒 Cuentas por Cobrar")
+    total, deudores, df_cxc = reporte_cuentas_por_cobrar()
+    c1, c2 = st.columns(2); c1.metric("Total por cobrar", f"${total:,.2f}"); c2.metric("Pacientes con saldo", deudores)
+    if not df_cxc.empty:
+        df_cxc['ultimo_movimiento'] = pd.to_datetime(df_cxc['ultimo_movimiento'], unit='s', utc=True).dt.tz_convert(TZ_MX).dt.strftime("%d/%m/%Y")
+        st.dataframe(df_cxc, use_container_width=True, hide_index=True)
+    with st.expander("🧮 Verificar libro de saldos"):
+        if st.button("Verificar contra citas"):
+            diferencias = verificar_saldos()
+            if diferencias.empty: st.success("✅ El libro de saldos cuadra con las citas.")
+            else: st.error(f"{len(diferencias)} pacientes con diferencias."); st.dataframe(diferencias, use_container_width=True, hide_index=True)
+            diferencias = verificar_resumen_financiero()
+            if diferencias.empty: st.success("✅ El resumen financiero cuadra con las citas.")
+            else: st.error(f"{len(diferencias)} días/grupos con diferencias en el resumen."); st.dataframe(diferencias, use_container_width=True, hide_index=True)
+        if st.button("Reconstruir desde citas"):
+            reconstruir_saldos(); reconstruir_resumen_financiero(); st.success("Libro de saldos y resumen financiero reconstruidos."); time.sleep(1); st.rerun()
+    with st.expander("💾 Respaldos"):
+        respaldos = listar_respaldos()
+        if respaldos:
+            df_resp = pd.DataFrame(respaldos)[['nombre', 'fecha', 'bytes', 'bytes_nuevos', 'integridad', 'segundos']]
+            df_resp['bytes'] = (df_resp['bytes'] / 1e6).round(2); df_resp['bytes_nuevos'] = (df_resp['bytes_nuevos'] / 1e6).round(2)
+            st.dataframe(df_resp.rename(columns={'bytes': 'MB', 'bytes_nuevos': 'MB nuevos'}), use_container_width=True, hide_index=True)
+        else: st.info("Aún no hay respaldos.")
+        if st.button("Respaldar ahora"):
+            # Lo corre el planificador: la copia y el integrity_check no bloquean esta pantalla
+            get_planificador().ejecutar_ahora("respaldo"); st.success("Respaldo iniciado en segundo plano.")
+    with st.expander("🛡️ Auditoría"):
+        estado_aud = get_escritor_auditoria().estado()
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("En cola", estado_aud['en_cola']); c2.metric("Escritos", estado_aud['escritos'])
+        c3.metric("Descartados", estado_aud['descartados']); c4.metric("Fallidos", estado_aud['fallidos'])
+        if not estado_aud['activo']: st.error("El escritor de auditoría no está activo.")
+        if estado_aud['ultimo_error']: st.warning(f"Último error: {estado_aud['ultimo_error']}")
+        if st.button("Verificar cadena de auditoría"):
+            with st.spinner("Recalculando la cadena..."): revisados, roto = verificar_cadena_auditoria()
+            if roto is None: st.success(f"✅ {revisados} eventos íntegros.")
+            else: st.error(f"La cadena se rompe en el evento {roto} (después de {revisados} eventos válidos).")
+    st.subheader("🛡️ Bitácora de Auditoría")
+    f1, f2, f3, f4 = st.columns(4)
+    usuario_f = f1.selectbox("Usuario", ["Todos"] + valores_auditoria("usuario"))
+    accion_f = f2.selectbox("Acción", ["Todas"] + valores_auditoria("accion"))
+    desde_f = f3.date_input("Desde", value=None, format="DD/MM/YYYY"); hasta_f = f4.date_input("Hasta", value=None, format="DD/MM/YYYY")
+    filtros = (usuario_f, accion_f, desde_f, hasta_f)
+    # Pila de cursores (fecha_evento, id_evento) por página; se reinicia si cambian los filtros
+    if st.session_state.get("aud_filtros") != filtros: st.session_state.aud_filtros = filtros; st.session_state.aud_cursores = [None]
+    cursores = st.session_state.aud_cursores
+    df_aud, hay_mas = consultar_auditoria(None if usuario_f == "Todos" else usuario_f, None if accion_f == "Todas" else accion_f,
+                                          format_date_iso(desde_f) if desde_f else None, format_date_iso(hasta_f) if hasta_f else None, cursores[-1])
+    st.dataframe(df_aud, use_container_width=True, hide_index=True)
+    p1, p2, p3 = st.columns([1, 2, 1])
+    if p1.button("◂ Anteriores", disabled=len(cursores) == 1): cursores.pop(); st.rerun()
+    p2.caption(f"Página {len(cursores)} · {len(df_aud)} eventos")
+    if p3.button("Siguientes ▸", disabled=not hay_mas): cursores.append((df_aud['fecha_evento'].iloc[-1], int(df_aud['id_evento'].iloc[-1]))); st.rerun()
+    with st.expander("🗂️ Documentos por lote"):
+        cola = get_cola_documentos(); lotes = st.session_state.setdefault("docs_lote", [])
+        hoy = get_fecha_mx()
+        if st.button(f"Recibos de hoy ({hoy}) en ZIP"):
+            conn = get_db_connection()
+            try: filas = conn.execute(f"SELECT id_paciente, MAX(rowid) FROM citas WHERE fecha = ? AND {FILTRO_MOVIMIENTOS} GROUP BY id_paciente", (hoy,)).fetchall()
+            finally: conn.close()
+            if filas: lotes.append(cola.enviar_lote([("recibo", {"id_paciente": i, "fecha": hoy, "rowid": r}) for i, r in filas], f"Recibos {hoy}", f"RECIBOS_{hoy.replace('/', '-')}.zip"))
+            else: st.info("Hoy no hay movimientos para recibo.")
+        sel_hist = st.multiselect("Pacientes", obtener_etiquetas_pacientes(), placeholder="Historias clínicas de...")
+        if st.button("Historias seleccionadas en ZIP", disabled=not sel_hist):
+            ids = [e.split(" - ")[0] for e in sel_hist]
+            lotes.append(cola.enviar_lote([("historia", {"id_paciente": i}) for i in ids], f"Historias ({len(ids)})", f"HISTORIAS_{get_fecha_iso_mx()}.zip"))
+        for id_trabajo in lotes[-3:]: panel_trabajo_documento(id_trabajo, "📥 Bajar ZIP")
+        st.dataframe(cola.tabla(), use_container_width=True, hide_index=True)
+    with st.expander("⏱️ Tareas programadas"):
+        planificador = get_planificador()
+        if not planificador.activo(): st.error("El hilo del planificador no está activo.")
+        st.dataframe(planificador.estado(), use_container_width=True, hide_index=True)
+        st.caption(f"Arranque de BD: {ARRANQUE_BD['fecha']} · esquema v{ARRANQUE_BD['esquema']} · {ARRANQUE_BD['migraciones']} migraciones · {ARRANQUE_BD['segundos']} s")
+        c1, c2 = st.columns([3, 1])
+        tarea_sel = c1.selectbox("Tarea", [t[0] for t in TAREAS_PROGRAMADAS], label_visibility="collapsed")
+        if c2.button("Ejecutar ahora"): planificador.ejecutar_ahora(tarea_sel); st.toast(f"Tarea '{tarea_sel}' en cola")
+    st.button("Salir", on_click=lambda: st.session_state.update(perfil=None))
+
+# INICIAR TAREAS PERIÓDICAS (respaldos, integridad, retención, cachés): una sola vez por proceso.
+# Solo con el servidor de Streamlit corriendo: importar app desde datos_prueba.py o benchmark.py (para migrar o medir)
+# no debe respaldar una base de prueba en la carpeta de respaldos de la clínica
+if not PROCESO_TRABAJADOR and st.runtime.exists(): get_planificador()
+
 if __name__ == "__main__":
     if st.session_state.perfil is None: pantalla_login()
     elif st.session_state.perfil == "Consultorio": vista_consultorio()
-    elif st.session_state.perfil == "Administracion": 
-        st.title("Admin")
-        st.button("Salir", on_click=lambda: st.session_state.update(perfil=None))
+    elif st.session_state.perfil == "Administracion": vista_administracion()
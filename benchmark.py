@@ -0,0 +1,199 @@
+"""
+BENCHMARK ROYAL DENTAL
+Genera una clínica sintética del tamaño que se pida directamente en el esquema de app.py
+y mide las rutas críticas sin levantar Streamlit. El resultado queda en un JSON para
+comparar versiones.
+
+Uso:
+    python benchmark.py --pacientes 10000 --anios 5
+    python benchmark.py --pacientes 100000 --salida bench_100k.json --comparar bench_base.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import datos_prueba
+
+# ==========================================
+# 1. CONFIGURACIÓN
+# ==========================================
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark de rutas críticas de app.py sobre una clínica sintética")
+    ap.add_argument("--pacientes", type=int, default=1000, help="Pacientes a generar (1000, 10000, 100000...)")
+    ap.add_argument("--anios", type=int, default=5, help="Años de historia hacia atrás")
+    ap.add_argument("--visitas-anuales", type=float, default=2.0, help="Visitas promedio por paciente por año")
+    ap.add_argument("--db", default=None, help="Archivo SQLite (por defecto bench_<pacientes>.sqlite)")
+    ap.add_argument("--regenerar", action="store_true", help="Borra y vuelve a generar la base aunque ya exista")
+    ap.add_argument("--reps", type=int, default=30, help="Repeticiones por medición")
+    ap.add_argument("--semilla", type=int, default=42)
+    ap.add_argument("--salida", default=None, help="Reporte JSON (por defecto bench_<pacientes>.json)")
+    ap.add_argument("--comparar", default=None, help="Reporte JSON anterior para comparar medianas")
+    ap.add_argument("--tolerancia", type=float, default=1.5, help="Razón de mediana a partir de la cual se marca regresión")
+    return ap.parse_args()
+
+
+# ==========================================
+# 2. MEDICIONES
+# ==========================================
+def medir(fn, reps, preparar=None):
+    """Corre fn() reps veces (preparar() antes de cada una, fuera del cronómetro). Tiempos en ms."""
+    tiempos = []
+    for _ in range(reps):
+        args = preparar() if preparar else ()
+        t0 = time.perf_counter(); fn(*args); tiempos.append((time.perf_counter() - t0) * 1000)
+    tiempos.sort()
+    return {"reps": reps, "min_ms": round(tiempos[0], 3), "mediana_ms": round(statistics.median(tiempos), 3),
+            "p95_ms": round(tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))], 3), "max_ms": round(tiempos[-1], 3)}
+
+
+def datos_recibo(app, id_p):
+    """Mismo armado que el botón 'Descargar Recibo Seleccionado' de Tratamientos"""
+    df_f, _, _ = app.obtener_movimientos_financieros(id_p)
+    if df_f.empty: return None
+    row_sel = df_f.iloc[0]
+    return app.armar_datos_recibo(id_p, row_sel['fecha'], row_sel['rowid'])
+
+
+def correr_mediciones(app, reps, rng):
+    conn = app.get_db_connection()
+    try:
+        ids = [r[0] for r in conn.execute("SELECT id_paciente FROM pacientes")]
+        con_cobros = [r[0] for r in conn.execute("SELECT DISTINCT id_paciente FROM citas WHERE precio_final > 0 LIMIT 2000")]
+        fechas = [r[0] for r in conn.execute("SELECT DISTINCT fecha FROM citas")]
+    finally: conn.close()
+    slots = app.generar_slots_tiempo(); hoy = app.get_fecha_mx()
+    azar = lambda lista: lista[int(rng.integers(0, len(lista)))]
+    limpiar_cache = lambda: app.st.cache_data.clear()
+    r = {}
+
+    # Agenda del día: consulta fría (sin caché) y servida desde caché
+    r["agenda_dia_frio"] = medir(app.obtener_citas_dia, reps, lambda: (limpiar_cache(), azar(fechas))[1:])
+    app.obtener_citas_dia(hoy)
+    r["agenda_dia_cache"] = medir(lambda: app.obtener_citas_dia(hoy), reps)
+
+    # Disponibilidad: construir la ocupación del día y consultas con el día ya en memoria
+    r["disponibilidad_fria"] = medir(app.verificar_disponibilidad, reps,
+                                     lambda: (limpiar_cache(), app.get_agenda_ocupacion.clear(), azar(fechas), azar(slots), 60)[2:])
+    app.verificar_disponibilidad(hoy, "10:00", 30)
+    r["disponibilidad_caliente"] = medir(app.verificar_disponibilidad, reps * 20,
+                                         lambda: (hoy, azar(slots), 30 * int(rng.integers(1, 4)), azar(app.LISTA_DOCTORES), azar(app.LISTA_SILLONES)))
+    r["sugerir_horarios"] = medir(lambda: app.sugerir_horarios(azar(fechas), 60, doctor=azar(app.LISTA_DOCTORES)), reps)
+
+    # Deuda: libro de saldos vs. la suma que hacía el semáforo antes
+    r["saldo_paciente"] = medir(app.obtener_saldo_paciente, reps * 20, lambda: (azar(ids),))
+    def suma_legada(id_p):
+        conn = app.get_db_connection()
+        try: conn.execute("SELECT SUM(saldo_pendiente) FROM citas WHERE id_paciente = ? AND estado_pago != 'CANCELADO'", (id_p,)).fetchone()
+        finally: conn.close()
+    r["saldo_suma_citas"] = medir(suma_legada, reps * 20, lambda: (azar(ids),))
+    r["cuentas_por_cobrar"] = medir(app.reporte_cuentas_por_cobrar, reps)
+
+    # Tablero financiero: un año del resumen por semana y doctor (lo que pinta la pantalla de Admin)
+    hasta_iso = app.get_fecha_iso_mx(); desde_iso = f"{int(hasta_iso[:4]) - 1}{hasta_iso[4:]}"
+    r["tablero_financiero"] = medir(lambda: app.obtener_resumen_financiero(desde_iso, hasta_iso, "Semana", "Doctor"), reps)
+
+    # Selector de pacientes: construir el directorio y búsqueda type-ahead
+    r["directorio_pacientes"] = medir(lambda: app.get_directorio_pacientes().etiquetas(), reps, lambda: (app.get_directorio_pacientes().invalidar(), ())[1])
+    r["busqueda_pacientes"] = medir(app.buscar_pacientes, reps * 5, lambda: (azar(datos_prueba.APELLIDOS)[:int(rng.integers(3, 7))],))
+
+    # Historial del paciente: primera página de movimientos (con formato de moneda) y de notas
+    def historial_movimientos(id_p):
+        df, _, _ = app.obtener_movimientos_financieros(id_p)
+        for col in ("precio_final", "monto_pagado", "saldo_pendiente"): app.formato_moneda(df[col])
+    r["historial_movimientos"] = medir(historial_movimientos, reps * 5, lambda: (azar(con_cobros),))
+    r["notas_clinicas"] = medir(app.obtener_notas_clinicas, reps * 5, lambda: (azar(con_cobros),))
+
+    # Documentos
+    def pdf_historia(id_p):
+        p = app.obtener_paciente(id_p)
+        app.crear_pdf_historia(p, app.obtener_historia_clinica(id_p))
+    r["pdf_historia"] = medir(pdf_historia, reps, lambda: (azar(con_cobros),))
+    def pdf_recibo(id_p):
+        datos = datos_recibo(app, id_p)
+        if datos: app.crear_recibo_pago(datos)
+    r["pdf_recibo"] = medir(pdf_recibo, reps, lambda: (azar(con_cobros),))
+
+    # Respaldo completo de la base (a una carpeta temporal); si el planificador está respaldando, se espera
+    while app.get_lock_respaldo().locked(): time.sleep(0.1)
+    r["respaldo"] = medir(app.auto_backup_db, max(3, reps // 10))
+    return r
+
+
+# ==========================================
+# 3. REPORTE
+# ==========================================
+def version_git():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception: return None
+
+
+def conteos(app):
+    conn = app.get_db_connection()
+    try: return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("pacientes", "citas", "odontograma", "auditoria", "saldos_pacientes", "resumen_financiero")}
+    finally: conn.close()
+
+
+def comparar(actual, ruta_base, tolerancia):
+    """Imprime la razón de medianas contra un reporte anterior. Regresa True si hubo regresiones."""
+    with open(ruta_base, encoding="utf-8") as f: base = json.load(f)
+    regresion = False
+    print(f"\n📊 Comparación contra {ruta_base} (versión {base.get('version_git')})")
+    for nombre, res in actual["resultados"].items():
+        anterior = base.get("resultados", {}).get(nombre)
+        if not anterior: print(f"   {nombre:<26} (nuevo) {res['mediana_ms']:.3f} ms"); continue
+        razon = res["mediana_ms"] / anterior["mediana_ms"] if anterior["mediana_ms"] else float("inf")
+        marca = "❌" if razon > tolerancia else ("✅" if razon < 1 / tolerancia else "  ")
+        regresion |= razon > tolerancia
+        print(f"{marca} {nombre:<26} {anterior['mediana_ms']:>10.3f} -> {res['mediana_ms']:>10.3f} ms  (x{razon:.2f})")
+    return regresion
+
+
+def main():
+    args = parse_args()
+    db = os.path.abspath(args.db or f"bench_{args.pacientes}.sqlite")
+    salida = args.salida or f"bench_{args.pacientes}.json"
+    if args.regenerar:
+        for sufijo in ("", "-wal", "-shm"):
+            if os.path.exists(db + sufijo): os.remove(db + sufijo)
+    # app.py lee estas variables al importarse: la base de benchmark y respaldos en una carpeta temporal
+    os.environ["ROYAL_DENTAL_DB"] = db
+    os.environ["ROYAL_DENTAL_BACKUPS"] = tempfile.mkdtemp(prefix="royal_bench_")
+    import app
+
+    rng = np.random.default_rng(args.semilla)
+    generacion_seg = None
+    if conteos(app)["pacientes"] == 0:
+        print(f"🏗️ Generando clínica: {args.pacientes} pacientes, {args.anios} años...")
+        # Mismo generador vectorizado que datos_prueba.py, escalado a años de operación
+        t0 = time.perf_counter()
+        datos_prueba.generar_clinica(db, app, args.pacientes, 365 * args.anios, args.pacientes * args.visitas_anuales / 365, 30, rng)
+        generacion_seg = round(time.perf_counter() - t0, 2)
+        print(f"   listo en {generacion_seg} s")
+
+    print("⏱️ Midiendo rutas críticas...")
+    resultados = correr_mediciones(app, args.reps, rng)
+    reporte = {
+        "fecha": datetime.now().isoformat(timespec="seconds"), "version_git": version_git(),
+        "python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "plataforma": platform.platform(),
+        "parametros": {"pacientes": args.pacientes, "anios": args.anios, "visitas_anuales": args.visitas_anuales, "reps": args.reps, "semilla": args.semilla},
+        "filas": conteos(app), "db_bytes": os.path.getsize(db), "generacion_seg": generacion_seg, "resultados": resultados,
+    }
+    with open(salida, "w", encoding="utf-8") as f: json.dump(reporte, f, indent=2, ensure_ascii=False)
+    for nombre, res in resultados.items():
+        print(f"   {nombre:<26} mediana {res['mediana_ms']:>10.3f} ms   p95 {res['p95_ms']:>10.3f} ms")
+    print(f"✅ Reporte: {salida}")
+    if args.comparar and comparar(reporte, args.comparar, args.tolerancia): sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,160 +1,236 @@
+import argparse
+import os
 import sqlite3
-import random
+import tempfile
 import time
 from datetime import datetime, timedelta
 
-# CONFIGURACIÓN
-DB_NAME = "dental.db"
-NUM_PACIENTES = 20  # <--- CAMBIO A 20 PACIENTES
+import numpy as np
+
+# CONFIGURACIÓN (valores por defecto; todos se pueden cambiar por línea de comandos)
+DB_NAME = os.environ.get("ROYAL_DENTAL_DB", "royal_dental_db.sqlite")  # La misma base que lee app.py
+NUM_PACIENTES = 20
 DIAS_HISTORIA = 60  # Generar datos de hace 2 meses para acá
+DIAS_FUTURO = 7     # Agenda de la próxima semana
+CITAS_POR_DIA = 1.5 # Promedio de visitas por día en el historial
+BLOQUE = 200_000    # Filas que se generan y escriben por lote
 
 # Nombres ficticios para generar variedad
-NOMBRES = ["Ana", "Carlos", "Beatriz", "David", "Elena", "Fernando", "Gabriela", "Hugo", "Isabel", "Juan", "Karla", "Luis", "Mariana", "Pedro", "Rosa", "Sergio", "Teresa", "Victor", "Ximena", "Yolanda"]
-APELLIDOS = ["García", "López", "Martínez", "Rodríguez", "Pérez", "Sánchez", "Ramírez", "Flores", "Gómez", "Díaz", "Hernández", "Vargas", "Castillo", "Jiménez", "Moreno"]
-TRATAMIENTOS_BASE = [
-    # (Categoria, Nombre, Precio, CostoLab, Riesgo, Duracion)
-    ("Preventivo", "Limpieza Dental (Profilaxis)", 800, 0, "LOW_RISK", 30),
-    ("Preventivo", "Aplicación de Flúor", 400, 0, "LOW_RISK", 15),
-    ("Operatoria", "Resina Simple", 1200, 50, "LOW_RISK", 45),
-    ("Operatoria", "Resina Compuesta", 1800, 80, "LOW_RISK", 60),
-    ("Cirugía", "Extracción Simple", 1500, 100, "HIGH_RISK", 45),
-    ("Cirugía", "Cirugía Tercer Molar", 3500, 200, "HIGH_RISK", 90),
-    ("Endodoncia", "Endodoncia Unirradicular", 2800, 150, "HIGH_RISK", 60),
-    ("Protesis", "Corona Zirconia", 4500, 1200, "LOW_RISK", 60),
-    ("Protesis", "Prótesis Total Acrílico", 6000, 1500, "LOW_RISK", 60),
-    ("Ortodoncia", "Pago Mensualidad Brackets", 1000, 0, "LOW_RISK", 30)
-]
-
-DOCTORES = ["Dr. Emmanuel", "Dra. Mónica"]
-
-def conectar():
-    return sqlite3.connect(DB_NAME)
-
-def inicializar_catalogos(c):
-    # Inyectar servicios si está vacío
-    c.execute("SELECT count(*) FROM servicios")
-    if c.fetchone()[0] == 0:
-        print("🛠️ Creando catálogo de servicios...")
-        for cat, nom, prec, cost, risk, dur in TRATAMIENTOS_BASE:
-            c.execute("INSERT INTO servicios (categoria, nombre_tratamiento, precio_lista, costo_laboratorio_base, consent_level, duracion) VALUES (?,?,?,?,?,?)",
-                      (cat, nom, prec, cost, risk, dur))
-
-def generar_pacientes(c):
-    print(f"👥 Generando {NUM_PACIENTES} pacientes...")
-    ids_generados = []
-    for _ in range(NUM_PACIENTES):
-        nom = random.choice(NOMBRES)
-        ape1 = random.choice(APELLIDOS)
-        ape2 = random.choice(APELLIDOS)
-        nombre_completo = f"{nom} {ape1}"
-        
-        # ID Paciente estilo: ANA-GAR-123
-        id_p = f"{nom[:3].upper()}-{ape1[:3].upper()}-{random.randint(100,999)}"
-        ids_generados.append((id_p, nombre_completo))
-        
-        # Fecha nacimiento random (entre 18 y 60 años)
-        dias_vividos = random.randint(18*365, 60*365)
-        f_nac = (datetime.now() - timedelta(days=dias_vividos)).strftime("%Y-%m-%d")
-        
-        try:
-            c.execute("""INSERT INTO pacientes (id_paciente, nombre, apellido_paterno, apellido_materno, fecha_nacimiento, telefono, antecedentes, alergias, nota_administrativa) 
-                         VALUES (?,?,?,?,?,?,?,?,?)""",
-                      (id_p, nom, ape1, ape2, f_nac, "5512345678", "Ninguno", "Penicilina" if random.random() > 0.8 else "Negadas", ""))
-        except sqlite3.IntegrityError:
-            pass # Si ya existe el ID (muy raro), lo saltamos
-            
-    return ids_generados
-
-def generar_historial_financiero(c, pacientes):
-    print("💰 Generando historial financiero y citas pasadas...")
-    
-    # Vamos día por día desde hace 60 días hasta ayer
-    fecha_cursor = datetime.now() - timedelta(days=DIAS_HISTORIA)
-    
-    while fecha_cursor < datetime.now():
-        # 40% de probabilidad de tener citas en un día cualquiera
-        if random.random() < 0.6: 
-            # 1 a 4 citas por día
-            num_citas = random.randint(1, 4)
-            for _ in range(num_citas):
-                paciente = random.choice(pacientes)
-                servicio = random.choice(TRATAMIENTOS_BASE) # (Cat, Nom, Prec, Cost, Risk, Dur)
-                doctor = random.choice(DOCTORES)
-                
-                # Desempaquetar servicio
-                cat, trat, precio, costo_lab, _, dur = servicio
-                
-                # Lógica de Pago (80% pagan todo, 20% dejan deuda)
-                es_pagado = random.random() < 0.8
-                monto_pagado = precio if es_pagado else precio / 2
-                saldo = precio - monto_pagado
-                estado_pago = "Pagado" if saldo == 0 else "Pendiente"
-                
-                fecha_str = fecha_cursor.strftime("%d/%m/%Y")
-                hora_str = f"{random.randint(9,19)}:00"
-                ts = int(fecha_cursor.timestamp())
-                
-                # INSERTAR CITA/TRANSACCIÓN
-                c.execute('''INSERT INTO citas 
-                (timestamp, fecha, hora, id_paciente, nombre_paciente, categoria, tratamiento, doctor_atendio, 
-                 precio_lista, precio_final, porcentaje, metodo_pago, estado_pago, notas, observaciones, 
-                 monto_pagado, saldo_pendiente, fecha_pago, costo_laboratorio, estatus_asistencia, tipo) 
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                (ts, fecha_str, hora_str, paciente[0], paciente[1], cat, trat, doctor,
-                 precio, precio, 0, random.choice(["Efectivo", "Tarjeta", "Transferencia"]), estado_pago,
-                 "Nota clínica generada automáticamente por seed.", "", monto_pagado, saldo, fecha_str, costo_lab, "Asistió", "Tratamiento"))
-                
-        fecha_cursor += timedelta(days=1)
-
-def generar_agenda_futura(c, pacientes):
-    print("📅 Agendando citas futuras...")
-    fecha_cursor = datetime.now() + timedelta(days=1) # Mañana
-    fin_agenda = datetime.now() + timedelta(days=7)   # Una semana
-    
-    while fecha_cursor < fin_agenda:
-        # 3 citas por día futuro
-        for _ in range(3):
-            paciente = random.choice(pacientes)
-            servicio = random.choice(TRATAMIENTOS_BASE)
-            doctor = random.choice(DOCTORES)
-            
-            fecha_str = fecha_cursor.strftime("%d/%m/%Y")
-            hora_str = f"{random.randint(10,18)}:00"
-            ts = int(fecha_cursor.timestamp())
-            
-            # Cita Programada (Sin cobro aún)
-            c.execute('''INSERT INTO citas 
-            (timestamp, fecha, hora, id_paciente, nombre_paciente, categoria, tratamiento, doctor_atendio, 
-             estado_pago, estatus_asistencia, notas, tipo, duracion) 
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-            (ts, fecha_str, hora_str, paciente[0], paciente[1], servicio[0], servicio[1], doctor, 
-             "Pendiente", "Programada", "Cita futura generada.", "Tratamiento", servicio[5]))
-            
-        fecha_cursor += timedelta(days=1)
+NOMBRES = ["ANA", "CARLOS", "BEATRIZ", "DAVID", "ELENA", "FERNANDO", "GABRIELA", "HUGO", "ISABEL", "JUAN", "KARLA", "LUIS", "MARIANA", "PEDRO", "ROSA", "SERGIO", "TERESA", "VICTOR", "XIMENA", "YOLANDA", "JOSE", "MARIA", "SOFIA", "ZOE"]
+APELLIDOS = ["GARCIA", "LOPEZ", "MARTINEZ", "RODRIGUEZ", "PEREZ", "SANCHEZ", "RAMIREZ", "FLORES", "GOMEZ", "DIAZ", "HERNANDEZ", "VARGAS", "CASTILLO", "JIMENEZ", "MORENO", "NUÑEZ", "MUÑOZ", "ALVAREZ", "ROMERO", "TORRES"]
+METODOS_PAGO = ["Efectivo", "Tarjeta", "Transferencia"]
+ESTADOS_DIENTE = ["Sano", "Caries", "Resina", "Ausente", "Corona"]
+DIENTES = [str(c * 10 + d) for c in (1, 2, 3, 4) for d in range(1, 9)]
 
-def main():
-    conn = conectar()
-    c = conn.cursor()
-    
+# Carga masiva: la durabilidad se relaja SOLO en la conexión del generador
+PRAGMAS_CARGA = ["PRAGMA synchronous=OFF", "PRAGMA temp_store=MEMORY", "PRAGMA cache_size=-262144", "PRAGMA busy_timeout=15000"]
+
+COLUMNAS_CITA = ("timestamp, fecha, hora, id_paciente, nombre_paciente, tipo, categoria, tratamiento, doctor_atendio, sillon, "
+                 "precio_lista, precio_final, costo_laboratorio, metodo_pago, estado_pago, estatus_asistencia, duracion, notas, "
+                 "monto_pagado, saldo_pendiente, fecha_pago, observaciones")
+INSERT_CITA = f"INSERT INTO citas ({COLUMNAS_CITA}) VALUES ({','.join('?' * 22)})"
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Pobla la base de Royal Dental con una clínica sintética")
+    ap.add_argument("--db", default=DB_NAME, help="Archivo SQLite destino (por defecto el de app.py)")
+    ap.add_argument("--pacientes", type=int, default=NUM_PACIENTES)
+    ap.add_argument("--dias-historia", type=int, default=DIAS_HISTORIA)
+    ap.add_argument("--dias-futuro", type=int, default=DIAS_FUTURO)
+    ap.add_argument("--citas-dia", type=float, default=CITAS_POR_DIA, help="Promedio de visitas por día en el historial")
+    ap.add_argument("--semilla", type=int, default=None)
+    return ap.parse_args()
+
+
+def preparar_esquema(db_path):
+    """Aplica las migraciones de app.py sobre la base destino (crea tablas, índices y catálogo de servicios)"""
+    os.environ["ROYAL_DENTAL_DB"] = db_path
+    # Como en benchmark.py: nada de lo que haga app al importarse toca la carpeta de respaldos de la clínica
+    os.environ.setdefault("ROYAL_DENTAL_BACKUPS", tempfile.mkdtemp(prefix="royal_datos_"))
+    import app
+    return app
+
+
+def _calendario(hoy, desde_dias, hasta_dias):
+    """Arreglos por día: dd/mm/YYYY, YYYY-MM-DD y timestamp de medianoche"""
+    dias = [hoy + timedelta(days=d) for d in range(desde_dias, hasta_dias)]
+    return (np.array([d.strftime("%d/%m/%Y") for d in dias]), np.array([d.strftime("%Y-%m-%d") for d in dias]),
+            np.array([int(datetime(d.year, d.month, d.day).timestamp()) for d in dias], dtype=np.int64))
+
+
+def generar_pacientes(rng, n, fechas_txt):
+    nom = rng.integers(0, len(NOMBRES), n); pat = rng.integers(0, len(APELLIDOS), n); mat = rng.integers(0, len(APELLIDOS), n)
+    anio = rng.integers(1950, 2020, n); registro = fechas_txt[rng.integers(0, len(fechas_txt), n)]
+    nombres = [NOMBRES[i] for i in nom]; paternos = [APELLIDOS[i] for i in pat]; maternos = [APELLIDOS[i] for i in mat]
+    ids = [f"{p[:3]}{no[0]}-{a}-{i:06d}" for i, (no, p, a) in enumerate(zip(nombres, paternos, anio.tolist()))]
+    rfcs = [f"{p[:2]}{m[0]}{no[0]}{str(a)[2:]}0101XXX" for no, p, m, a in zip(nombres, paternos, maternos, anio.tolist())]
+    alergias = np.where(rng.random(n) > 0.8, "Penicilina", "Negados").tolist()
+    filas = list(zip(ids, registro.tolist(), nombres, paternos, maternos, [f"55{i:08d}" for i in range(n)],
+                     [f"paciente{i}@correo.mx" for i in range(n)], rfcs, [f"01/01/{a}" for a in anio.tolist()], alergias, ["Activo"] * n))
+    return ids, [f"{no} {p}" for no, p in zip(nombres, paternos)], filas
+
+
+def _bloque_historial(rng, n, ctx):
+    """n visitas pasadas: fila de agenda (Asistió / No Asistió / Canceló) + cobro del mismo día para las atendidas,
+    abonos posteriores para parte de las deudas y auditoría de abonos y cancelaciones"""
+    serv = rng.integers(0, len(ctx["servicios"]), n); dia = rng.integers(0, ctx["dias_historia"], n)
+    slot = rng.integers(0, len(ctx["slots"]), n); pac = rng.integers(0, len(ctx["ids"]), n)
+    estatus = rng.choice(3, n, p=[0.85, 0.10, 0.05])  # 0 Asistió, 1 No Asistió, 2 Canceló
+    precio = ctx["precios"][serv]; deuda = rng.random(n) < 0.2
+    pagado = np.where(deuda, np.round(precio / 2, 2), precio)
+    d_abono = dia + rng.integers(1, 60, n)
+    con_abono = deuda & (rng.random(n) < 0.6) & (d_abono < ctx["dias_historia"])
+    abono = np.where(con_abono, np.round((precio - pagado) / 2, 2), 0.0)
+    saldo = np.round(precio - pagado - abono, 2)
+
+    fecha = ctx["fechas_txt"][dia]; hora = ctx["slots_arr"][slot]; ts = ctx["fechas_ts"][dia] + ctx["slots_min"][slot] * 60
+    ids = ctx["ids_arr"][pac]; nombres = ctx["nombres_arr"][pac]; cat = ctx["categorias"][serv]; trat = ctx["tratamientos"][serv]
+    doc = ctx["doctores"][rng.integers(0, len(ctx["doctores"]), n)]; sil = ctx["sillones"][rng.integers(0, len(ctx["sillones"]), n)]
+    metodo = np.array(METODOS_PAGO)[rng.integers(0, len(METODOS_PAGO), n)]
+    nulos = [None] * n
+
+    # Agenda (las canceladas quedan como en la app: estado_pago CANCELADO + estatus Canceló)
+    est_txt = np.array(["Asistió", "No Asistió", "Canceló"])[estatus]
+    estado_agenda = np.where(estatus == 2, "CANCELADO", "Pendiente")
+    notas_agenda = np.where(estatus == 2, " [CANCELADA: Paciente reagendó]", np.char.add("Cita: ", trat))
+    filas = list(zip(ts.tolist(), fecha.tolist(), hora.tolist(), ids.tolist(), nombres.tolist(), ["Tratamiento"] * n, cat.tolist(), trat.tolist(),
+                     doc.tolist(), sil.tolist(), nulos, nulos, nulos, nulos, estado_agenda.tolist(), est_txt.tolist(),
+                     ctx["duraciones"][serv].tolist(), notas_agenda.tolist(), nulos, nulos, nulos, nulos))
+
+    # Cobro del tratamiento para las visitas atendidas
+    a = np.flatnonzero(estatus == 0); m = len(a); nulos = [None] * m
+    filas += zip((ts[a] + 1).tolist(), fecha[a].tolist(), hora[a].tolist(), ids[a].tolist(), nombres[a].tolist(), nulos, cat[a].tolist(), trat[a].tolist(),
+                 doc[a].tolist(), nulos, precio[a].tolist(), precio[a].tolist(), ctx["costos_lab"][serv[a]].tolist(), metodo[a].tolist(),
+                 np.where(saldo[a] <= 0, "Pagado", "Pendiente").tolist(), nulos, nulos, ["Procedimiento realizado sin incidencias."] * m,
+                 pagado[a].tolist(), saldo[a].tolist(), fecha[a].tolist(), nulos)
+
+    # Abonos posteriores (fila Financiero, como la pestaña de abonos)
+    b = np.flatnonzero(con_abono & (estatus == 0)); m = len(b); nulos = [None] * m
+    f_ab = ctx["fechas_txt"][d_abono[b]]
+    filas += zip((ctx["fechas_ts"][d_abono[b]] + 12 * 3600).tolist(), f_ab.tolist(), ["12:00"] * m, ids[b].tolist(), nombres[b].tolist(), nulos,
+                 ["Financiero"] * m, np.char.add("ABONO A: ", trat[b]).tolist(), ["Caja"] * m, nulos, [0.0] * m, [0.0] * m, [0.0] * m,
+                 metodo[b].tolist(), ["Pagado"] * m, nulos, nulos, [""] * m, abono[b].tolist(), [0.0] * m, f_ab.tolist(), ["Abono registrado"] * m)
+
+    c = np.flatnonzero(estatus == 2)
+    auditoria = list(zip(np.char.add(np.char.add(ctx["fechas_iso"][dia[c]], " "), np.char.add(hora[c], ":00")).tolist(), ["Consultorio"] * len(c),
+                         ["CANCELACION_CITA"] * len(c), [f"CITA DE {i} | MOTIVO: PACIENTE REAGENDO" for i in ids[c].tolist()]))
+    auditoria += zip(np.char.add(ctx["fechas_iso"][d_abono[b]], " 12:00:00").tolist(), ["Consultorio"] * m, ["ABONO_REGISTRADO"] * m,
+                     [f"PACIENTE: {i} | ABONO: ${x:,.2f}" for i, x in zip(ids[b].tolist(), abono[b].tolist())])
+    return filas, auditoria
+
+
+def _bloque_futuro(rng, n, ctx):
+    """n citas programadas (sin cobro) en los próximos días"""
+    serv = rng.integers(0, len(ctx["servicios"]), n); pac = rng.integers(0, len(ctx["ids"]), n)
+    dia = rng.integers(ctx["dias_historia"] + 1, len(ctx["fechas_txt"]), n); slot = rng.integers(0, len(ctx["slots"]), n)
+    nulos = [None] * n; trat = ctx["tratamientos"][serv]
+    return list(zip((ctx["fechas_ts"][dia] + ctx["slots_min"][slot] * 60).tolist(), ctx["fechas_txt"][dia].tolist(), ctx["slots_arr"][slot].tolist(),
+                    ctx["ids_arr"][pac].tolist(), ctx["nombres_arr"][pac].tolist(), ["Tratamiento"] * n, ctx["categorias"][serv].tolist(), trat.tolist(),
+                    ctx["doctores"][rng.integers(0, len(ctx["doctores"]), n)].tolist(), ctx["sillones"][rng.integers(0, len(ctx["sillones"]), n)].tolist(),
+                    nulos, nulos, nulos, nulos, ["Pendiente"] * n, ["Programada"] * n, ctx["duraciones"][serv].tolist(),
+                    np.char.add("Cita: ", trat).tolist(), nulos, nulos, nulos, nulos))
+
+
+def _odontograma(rng, ids, fechas_txt):
+    """30% de los pacientes con 1 a 6 dientes registrados"""
+    filas = []
+    for i in np.flatnonzero(rng.random(len(ids)) < 0.3).tolist():
+        for diente in rng.choice(DIENTES, int(rng.integers(1, 7)), replace=False).tolist():
+            filas.append((ids[i], diente, ESTADOS_DIENTE[int(rng.integers(1, len(ESTADOS_DIENTE)))], fechas_txt[int(rng.integers(0, len(fechas_txt)))]))
+    return filas
+
+
+def _suspender_indices(conn, tabla):
+    """Quita índices y triggers de la tabla (dentro de la transacción) y regresa su SQL para recrearlos.
+    Reconstruir un índice al final (ordenando una vez) es varias veces más rápido que mantenerlo fila por fila."""
+    objetos = conn.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL", (tabla,)).fetchall()
+    for tipo, nombre, _ in objetos: conn.execute(f"DROP {tipo.upper()} {nombre}")
+    return [sql for _, _, sql in objetos]
+
+def generar_clinica(db_path, app, n_pacientes, dias_historia, citas_por_dia, dias_futuro, rng, bloque=BLOQUE):
+    """Escribe la clínica completa en UNA transacción con executemany por lotes. Regresa los conteos insertados."""
+    conn = sqlite3.connect(db_path, timeout=app.DB_TIMEOUT_SEG)
+    for pragma in PRAGMAS_CARGA: conn.execute(pragma)
+    servicios = conn.execute("SELECT categoria, nombre_tratamiento, precio_lista, costo_laboratorio_base, duracion FROM servicios WHERE precio_lista > 0").fetchall()
+    hoy = datetime.now(app.TZ_MX).replace(tzinfo=None)
+    fechas_txt, fechas_iso, fechas_ts = _calendario(hoy, -dias_historia, dias_futuro + 1)
+    slots = app.generar_slots_tiempo()
+
+    ids, nombres, filas_pac = generar_pacientes(rng, n_pacientes, fechas_txt[:dias_historia])
+    ctx = {"servicios": servicios, "ids": ids, "ids_arr": np.array(ids), "nombres_arr": np.array(nombres), "dias_historia": dias_historia,
+           "fechas_txt": fechas_txt, "fechas_iso": fechas_iso, "fechas_ts": fechas_ts,
+           "slots": slots, "slots_arr": np.array(slots), "slots_min": np.array([int(s[:2]) * 60 + int(s[3:]) for s in slots], dtype=np.int64),
+           "categorias": np.array([s[0] for s in servicios]), "tratamientos": np.array([s[1] for s in servicios]),
+           "precios": np.array([s[2] for s in servicios], dtype=float), "costos_lab": np.array([s[3] or 0.0 for s in servicios], dtype=float),
+           "duraciones": np.array([s[4] or 30 for s in servicios], dtype=np.int64),
+           "doctores": np.array(app.LISTA_DOCTORES), "sillones": np.array(app.LISTA_SILLONES)}
+
+    conteo = {"pacientes": n_pacientes, "citas": 0, "auditoria": 0, "odontograma": 0}
+    n_visitas = int(round(citas_por_dia * dias_historia)); n_futuras = int(round(citas_por_dia * dias_futuro))
     try:
-        inicializar_catalogos(c)
-        pacientes = generar_pacientes(c)
-        if pacientes:
-            generar_historial_financiero(c, pacientes)
-            generar_agenda_futura(c, pacientes)
-            conn.commit()
-            print("\n✅ ¡Base de datos poblada con éxito!")
-            print(f"   - {len(pacientes)} Pacientes nuevos")
-            print("   - Historial de 60 días generado")
-            print("   - Agenda próxima semana llena")
-            print("   - Ahora puedes probar el Módulo Financiero con datos reales.")
-        else:
-            print("❌ Error generando pacientes.")
-            
-    except Exception as e:
-        print(f"❌ Ocurrió un error: {e}")
+        conn.execute("BEGIN")
+        # Carga grande frente a lo que ya existe: índices y triggers fuera, se recrean al final en la misma transacción
+        suspendidos = []
+        if n_visitas + n_futuras > conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0]:
+            suspendidos += _suspender_indices(conn, "citas")
+        rowid_pac = conn.execute("SELECT ifnull(MAX(rowid), 0) FROM pacientes").fetchone()[0]
+        if n_pacientes > conn.execute("SELECT COUNT(*) FROM pacientes").fetchone()[0]:
+            suspendidos += _suspender_indices(conn, "pacientes")
+        conn.executemany("""INSERT OR IGNORE INTO pacientes (id_paciente, fecha_registro, nombre, apellido_paterno, apellido_materno, telefono, email, rfc, fecha_nacimiento, app, estado)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?)""", filas_pac)
+        hash_auditoria = app.ultimo_hash_auditoria(conn)
+        for inicio in range(0, n_visitas, bloque):
+            filas, auditoria = _bloque_historial(rng, min(bloque, n_visitas - inicio), ctx)
+            conn.executemany(INSERT_CITA, filas)
+            # La bitácora es una cadena de hashes: los eventos sintéticos se encadenan igual que los reales
+            filas_aud, hash_auditoria = app.encadenar_eventos(hash_auditoria, auditoria)
+            conn.executemany(app.SQL_INSERT_AUDITORIA, filas_aud)
+            conteo["citas"] += len(filas); conteo["auditoria"] += len(auditoria)
+        if n_futuras:
+            filas = _bloque_futuro(rng, n_futuras, ctx); conn.executemany(INSERT_CITA, filas); conteo["citas"] += len(filas)
+        filas_odo = _odontograma(rng, ids, fechas_txt[:dias_historia].tolist())
+        conn.executemany("INSERT OR REPLACE INTO odontograma (id_paciente, diente, estado, fecha_actualizacion) VALUES (?,?,?,?)", filas_odo)
+        # Cada diente sembrado entra también como primer evento del historial (mismo formato que la migración 8),
+        # si no, el odontograma "al día" y la historia con fecha de corte salen vacíos
+        conn.executemany("INSERT INTO odontograma_historial (id_paciente, diente, estado, fecha_evento, usuario) VALUES (?,?,?,?,?)",
+                         [(i, d, e, f"{f[6:10]}-{f[3:5]}-{f[:2]} 00:00:00", "DATOS_PRUEBA") for i, d, e, f in filas_odo])
+        conteo["odontograma"] = len(filas_odo)
+        if any("pacientes_fts" in sql for sql in suspendidos):
+            # Sin el trigger, el índice de búsqueda se llena de una vez con los pacientes nuevos (misma expresión que la migración 5)
+            conn.execute(f"INSERT INTO pacientes_fts(rowid, id_paciente, nombre_completo, telefono, rfc, email) SELECT new.rowid, {app.SQL_FTS_PACIENTE} FROM pacientes AS new WHERE new.rowid > ?", (rowid_pac,))
+        for sql in suspendidos: conn.execute(sql)
+        # El libro de saldos y el resumen financiero se recalculan completos al final (mucho más barato que mantenerlo fila por fila)
+        conn.execute("DELETE FROM saldos_pacientes")
+        conn.execute(f"INSERT INTO saldos_pacientes (id_paciente, cargos, abonos, saldo, ultimo_movimiento) {app.SQL_SALDOS_DESDE_CITAS}")
+        conn.execute("DELETE FROM resumen_financiero")
+        conn.execute(f"INSERT INTO resumen_financiero (fecha_iso, doctor, categoria, metodo_pago, cargos, cobrado, saldo, costo_lab, movimientos) {app.SQL_RESUMEN_DESDE_CITAS}")
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
     finally:
         conn.close()
+    conn = sqlite3.connect(db_path, timeout=app.DB_TIMEOUT_SEG)
+    try: conn.execute("ANALYZE"); conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally: conn.close()
+    return conteo
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.semilla)
+    app = preparar_esquema(os.path.abspath(args.db))
+    print(f"🏗️ Generando {args.pacientes} pacientes y {args.dias_historia} días de historial en {args.db}...")
+    t0 = time.perf_counter()
+    try:
+        conteo = generar_clinica(os.path.abspath(args.db), app, args.pacientes, args.dias_historia, args.citas_dia, args.dias_futuro, rng)
+    except Exception as e:
+        print(f"❌ Ocurrió un error: {e}"); return
+    print(f"\n✅ ¡Base de datos poblada con éxito! ({time.perf_counter() - t0:.1f} s)")
+    print(f"   - {conteo['pacientes']} Pacientes nuevos")
+    print(f"   - {conteo['citas']} citas ({args.dias_historia} días de historial + {args.dias_futuro} días de agenda)")
+    print(f"   - {conteo['auditoria']} eventos de auditoría, {conteo['odontograma']} dientes en odontograma")
+    print("   - Ahora puedes probar el Módulo Financiero con datos reales.")
+
 
 if __name__ == "__main__":
     main()
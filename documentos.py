@@ -0,0 +1,27 @@
+"""
+TRABAJADOR DE DOCUMENTOS ROYAL DENTAL
+Punto de entrada de los procesos de la cola de documentos (ColaDocumentos en app.py).
+Vive en un módulo aparte porque el script de Streamlit corre como __main__ y un proceso hijo no puede
+resolver funciones de ahí. Cada proceso importa app.py una sola vez (sin planificador ni migraciones).
+"""
+import streamlit as st
+from streamlit import logger
+
+_app = None
+
+
+def inicializar():
+    """Se corre una vez al arrancar cada proceso del pool"""
+    global _app
+    # Fuera de una sesión cada lectura en caché avisa 'missing ScriptRunContext': aquí es lo esperado
+    logger.set_log_level("error")
+    import app
+    _app = app
+
+
+def generar(tipo, params):
+    """(nombre_archivo, bytes) del documento pedido"""
+    if _app is None: inicializar()
+    # Este proceso no ve las invalidaciones del servidor: cada trabajo lee el expediente fresco de la BD
+    st.cache_data.clear()
+    return _app.generar_documento(tipo, params)